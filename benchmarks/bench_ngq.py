@@ -0,0 +1,206 @@
+# This software is distributed under MIT license, https://mit-license.org
+# The newest verion can be downloaded at https://github.com/gvkolmakov/qml-api
+# Please email G.Kolmakov with any questions at german@ngq.io
+
+"""
+Benchmarks of ngq.py against the local stand-in server ngq_server.py.
+
+For each dataset size and scenario (upload in several transfer modes,
+labeling) it reports files/sec, bytes/sec, client CPU time per MB, p50/p99
+latency of the HTTP requests and the peak RSS of the client. Each run is a
+fresh process, so the RSS and the caches of one run do not leak into the next.
+
+Usage (from the repository directory):
+    python3 benchmarks/bench_ngq.py
+    python3 benchmarks/bench_ngq.py --sizes 100,1000 --latency 0.005 --json now.json
+    python3 benchmarks/bench_ngq.py --json now.json --compare baseline.json --tolerance 0.2
+    python3 benchmarks/bench_ngq.py --sizes 50 --file-size 8388608 --scenarios upload,upload_mmap
+
+With --compare the exit status is 1 if a scenario got slower (files/sec,
+p99, CPU per MB) or bigger (peak RSS) than the baseline by more than the
+tolerance.
+"""
+
+import argparse, json, os, random, resource, subprocess, sys, tempfile, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USER_ID = 'bench'
+
+# scenario: (description, upload_dataset_to_server_api body keys)
+SCENARIOS = {
+    'upload':          ('upload, 1 worker', {}),
+    'upload_workers':  ('upload, 4 workers', {'upload_workers': 4}),
+    'upload_packed':   ('upload, tar chunks', {'transfer_mode': 'packed'}),
+    'upload_mmap':     ('upload, mmap reads', {'mmap': True}),
+    'upload_lean':     ('upload, lean client', {'lean': True}),
+    'labels':          ('labeling', {}),
+}
+
+def make_dataset(directory, n_files, file_size, seed=0):
+    """n_files files of random content, file_size bytes each."""
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    for i in range(n_files):
+        with open(os.path.join(directory, 'img_%06d.png' % i), 'wb') as f:
+            f.write(rng.getrandbits(8 * file_size).to_bytes(file_size, 'little'))
+    return directory
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def peak_rss_bytes():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+########## ONE RUN, IN A CHILD PROCESS ##########
+def run_scenario(scenario, server_url, dataset_dir, n_files, file_size):
+    """Run one scenario, return the result dict."""
+    sys.path.insert(0, ROOT)
+    import ngq
+    options = dict(SCENARIOS[scenario][1])
+    client = ngq.NgqClient(lean=options.pop('lean', False))
+    #the file reads: readinto() a reused buffer, or memory mapped (opt-in)
+    ngq.MMAP_READS = options.pop('mmap', False)
+    latencies = []
+    client.session.hooks['response'].append(lambda r, *args, **kwargs: latencies.append(r.elapsed.total_seconds()))
+    data_id = 'bench_%s_%d' % (scenario, n_files)
+
+    if scenario == 'labels':
+        #train on the dataset first, only the labeling is measured
+        ngq.upload_dataset_to_server_api({'endpoint': server_url + '/upload_data', 'user_id': USER_ID,
+                                          'dataset_dir': dataset_dir, 'data_id': data_id, 'client': client})
+        ngq.train_model_on_data_api({'endpoint': server_url + '/train_model_on_data', 'user_id': USER_ID,
+                                     'data_id': data_id, 'model_name': data_id, 'client': client})
+        ngq.check_model_ready_api({'endpoint': server_url + '/check_model_ready', 'user_id': USER_ID,
+                                   'model_name': data_id, 'keep_trying': 'True', 'client': client})
+        del latencies[:]
+        cpu_started = cpu_seconds()
+        started = time.perf_counter()
+        response = ngq.get_labels_api({'endpoint': server_url + '/get_labels', 'user_id': USER_ID,
+                                       'dataset_dir': dataset_dir, 'model_name': data_id, 'client': client})
+        ok = response.get('error') == 'None' and len(response.get('labels', {})) == n_files
+    else:
+        body = {'endpoint': server_url + '/upload_data', 'user_id': USER_ID,
+                'dataset_dir': dataset_dir, 'data_id': data_id, 'client': client}
+        body.update(options)
+        cpu_started = cpu_seconds()
+        started = time.perf_counter()
+        response = ngq.upload_dataset_to_server_api(body)
+        ok = response.get('error') == 'None'
+    seconds = time.perf_counter() - started
+    cpu = cpu_seconds() - cpu_started
+    client.close()
+    return {'scenario': scenario, 'files': n_files, 'file_size': file_size, 'ok': ok,
+            'seconds': seconds,
+            'files_per_sec': n_files / seconds,
+            'bytes_per_sec': n_files * file_size / seconds,
+            'cpu_ms_per_mb': 1000 * cpu / max(n_files * file_size / 2 ** 20, 1e-9),
+            'requests': len(latencies),
+            'p50_ms': 1000 * percentile(latencies, 0.50),
+            'p99_ms': 1000 * percentile(latencies, 0.99),
+            'peak_rss_mb': peak_rss_bytes() / 2 ** 20}
+
+########## DRIVER ##########
+def start_server(latency, bandwidth, fail_rate=0.0):
+    """Start ngq_server.py on a free port, return (process, url)."""
+    command = [sys.executable, os.path.join(ROOT, 'ngq_server.py'), '--port', '0',
+               '--latency', str(latency), '--bandwidth', str(bandwidth), '--train-seconds', '0',
+               '--fail-rate', str(fail_rate), '--retry-after', '0']
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    url = process.stdout.readline().split()[-1]
+    return process, url
+
+def run_child(scenario, server_url, dataset_dir, n_files, file_size, cache_dir):
+    command = [sys.executable, os.path.abspath(__file__), '--child', scenario, '--server', server_url,
+               '--dataset', dataset_dir, '--sizes', str(n_files), '--file-size', str(file_size)]
+    env = dict(os.environ, NGQ_CACHE_DIR=cache_dir, NGQ_SERVER_URL=server_url)
+    output = subprocess.run(command, env=env, cwd=cache_dir, stdout=subprocess.PIPE, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def compare(results, baseline, tolerance):
+    """Return the regressions of results against baseline, as text lines."""
+    old = {(r['scenario'], r['files']): r for r in baseline}
+    regressions = []
+    for r in results:
+        b = old.get((r['scenario'], r['files']))
+        if b is None:
+            continue
+        checks = [('files_per_sec', r['files_per_sec'] < b['files_per_sec'] * (1 - tolerance)),
+                  ('p99_ms', r['p99_ms'] > b['p99_ms'] * (1 + tolerance)),
+                  ('peak_rss_mb', r['peak_rss_mb'] > b['peak_rss_mb'] * (1 + tolerance))]
+        if 'cpu_ms_per_mb' in b:
+            checks.append(('cpu_ms_per_mb', r['cpu_ms_per_mb'] > b['cpu_ms_per_mb'] * (1 + tolerance)))
+        for key, regressed in checks:
+            if regressed:
+                regressions.append('%s %d files: %s %.1f -> %.1f' % (r['scenario'], r['files'], key, b[key], r[key]))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of ngq.py against the local stand-in server.')
+    parser.add_argument('--sizes', default='100,1000', help='dataset sizes, number of files')
+    parser.add_argument('--file-size', type=int, default=4096, help='bytes per file')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--latency', type=float, default=0.0, help='server latency per response, seconds')
+    parser.add_argument('--bandwidth', default='0', help='server bandwidth per connection, f.e. 10M')
+    parser.add_argument('--fail-rate', type=float, default=0.0,
+                        help='fraction of the requests the server fails with 503, to measure the retries')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per scenario, the fastest is kept')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='baseline results file written with --json')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--server', help=argparse.SUPPRESS)
+    parser.add_argument('--dataset', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run_scenario(args.child, args.server, args.dataset, int(args.sizes), args.file_size)))
+        return 0
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    scenarios = args.scenarios.split(',')
+    results = []
+    server, url = start_server(args.latency, args.bandwidth, args.fail_rate)
+    try:
+        with tempfile.TemporaryDirectory(prefix='ngq_bench_') as work:
+            print('%-22s %7s %10s %10s %9s %9s %9s %9s %5s' % ('scenario', 'files', 'files/s', 'MB/s', 'CPU ms/MB',
+                                                             'p50 ms', 'p99 ms', 'RSS MB', 'ok'))
+            for n_files in sizes:
+                dataset_dir = make_dataset(os.path.join(work, 'data_%d' % n_files), n_files, args.file_size) + '/'
+                for scenario in scenarios:
+                    runs = []
+                    for i in range(args.repeat):
+                        #fresh cache dir: no hashes, journals or predictions from an earlier run
+                        cache_dir = tempfile.mkdtemp(dir=work)
+                        runs.append(run_child(scenario, url, dataset_dir, n_files, args.file_size, cache_dir))
+                    r = max(runs, key=lambda run: run['files_per_sec'])
+                    results.append(r)
+                    print('%-22s %7d %10.1f %10.2f %9.2f %9.2f %9.2f %9.1f %5s' % (
+                        SCENARIOS[scenario][0], n_files, r['files_per_sec'], r['bytes_per_sec'] / 2 ** 20,
+                        r['cpu_ms_per_mb'], r['p50_ms'], r['p99_ms'], r['peak_rss_mb'], r['ok']))
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+    status = 0 if all(r['ok'] for r in results) else 1
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print('REGRESSION', line)
+        if regressions:
+            status = 1
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
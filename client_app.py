@@ -5,6 +5,9 @@
 import sys, time; sys.path.append('./')
 import ngq    
 
+# Optional: check the internet connection and the server in the background.
+# ngq.run_diagnostics(background=True)
+
 #######################################################
 # Also needs "requests" as a dependency.              #
 # One-liner to install from a terminal is:            #
@@ -15,239 +15,2855 @@ DEBUG = False # True or False
 # Do initial tests: True of False
 DO_TEST = True #False for localhost, True for DO testing
 
+# Run diagnostics (network, server, version, log upload) when ngq is imported.
+# Off by default: call run_diagnostics() explicitly, or set RUN_DIAGNOSTICS = True
+# or the environment variable NGQ_DIAGNOSTICS=1 to run them in the background.
+RUN_DIAGNOSTICS = False
+DIAGNOSTICS_BUDGET = 10.0 # seconds, total time diagnostics may take
+STARTUP_BUDGET = 0.05     # seconds, import of ngq should fit in it, see startup_time()
+
+from time import perf_counter as _perf_counter
+_IMPORT_STARTED = _perf_counter()
+
 if DO_TEST:
     my_host = "my-qml.org"; my_port = 443
 else:
     my_host = "127.0.0.1"; my_port = 5000
 
-### importing modules ##############
-# initializing
-import_error = False
-import_error_message = []
+### importing modules ##############
+# initializing
+import_error = False
+import_error_message = []
+
+try:
+    import socket
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'socket\' module in your python3.")
+
+try:
+    import logging
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'logging\' module in your python3.")
+
+try:
+    import json
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'json\' module in your python3.")
+    
+try:
+    import glob
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'glob\' module in your python3.")
+
+try:
+    import mmap
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'mmap\' module in your python3.")
+
+try:
+    import fnmatch
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'fnmatch\' module in your python3.")
+
+try:
+    import time
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'time\' module in your python3.")
+
+try:
+    import importlib
+    import importlib.util
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'importlib\' module in your python3.")
+
+# 'requests' is checked here but imported on first use, see _LazyModule below
+try:
+    if importlib.util.find_spec("requests") is None:
+        raise ImportError("No module named 'requests'")
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'requests\' module in your python3. ")
+    import_error_message.append("One-liner to install from a terminal is:")
+    import_error_message.append("python3 -m pip install requests")
+    
+try:
+    import os
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'os\' module in your python3. ")
+
+try:
+    import sys
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'sys\' module in your python3. ")
+
+try:
+    import heapq
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'heapq\' module in your python3. ")
+
+try:
+    import collections
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'collections\' module in your python3. ")
+
+try:
+    import io
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'io\' module in your python3. ")
+
+try:
+    import hashlib
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'hashlib\' module in your python3. ")
+
+try:
+    import zipfile
+    import tarfile
+    import weakref
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'zipfile\', \'tarfile\' and \'weakref\' modules in your python3. ")
+
+try:
+    import uuid
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'uuid\' module in your python3. ")
+
+try:
+    import shutil
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'shutil\' module in your python3. ")
+
+try:
+    import threading
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'threading\' module in your python3. ")
+
+try:
+    import concurrent.futures
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'concurrent.futures\' module in your python3. ")
+
+try:
+    import bisect, contextvars, functools
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'bisect\', \'contextvars\' and \'functools\' modules in your python3. ")
+
+try:
+    import atexit, queue
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'atexit\' and \'queue\' modules in your python3. ")
+
+try:
+    import zlib
+except ImportError as e:
+    import_error = True
+    import_error_message.append(e)
+    import_error_message.append("Please install \'zlib\' module in your python3. ")
+
+def log_import_errors():
+    """Print module import errors"""
+    with open("logfile.log", 'a') as f:
+        print("Log started.", file=f)
+        for i in range(len(import_error_message)):
+            print("my_import_errors::", import_error_message[i], file=f)
+            print(import_error_message[i])
+        print("Session finished", file=f)
+    exit()
+
+if import_error:
+    log_import_errors()
+    #Session will end here because of the import error
+
+# Server replicas of the default client, see ServerPool. The environment
+# variable NGQ_SERVER_URLS sets them, f.e.
+# NGQ_SERVER_URLS=http://10.0.0.1:5000,http://10.0.0.2:5000
+SERVER_URLS = [url.strip().rstrip('/') for url in os.environ.get("NGQ_SERVER_URLS", "").split(',') if url.strip()]
+
+# Server used by the diagnostics. The environment variable NGQ_SERVER_URL,
+# f.e. http://127.0.0.1:5000 for the local stand-in server ngq_server.py,
+# overrides the DO_TEST choice; else the first of SERVER_URLS is used.
+SERVER_URL = os.environ.get("NGQ_SERVER_URL", SERVER_URLS[0] if SERVER_URLS else
+                            "https://my-qml.org" if DO_TEST else "http://127.0.0.1:5000")
+if "NGQ_SERVER_URL" in os.environ or SERVER_URLS:
+    from urllib.parse import urlparse
+    my_host = urlparse(SERVER_URL).hostname
+    my_port = urlparse(SERVER_URL).port or (443 if SERVER_URL.startswith('https') else 80)
+
+########## LOGGING ##########
+# ngq logs to its own 'ngq' logger and leaves the root logger of the
+# application alone. The records go through a queue to a background thread
+# that writes LOG_FILE, so logging never blocks an upload; the file is
+# rotated at LOG_MAX_BYTES and at most LOG_BACKUP_COUNT old files are kept.
+# Subsystem loggers: ngq.diagnostics, ngq.upload, ngq.labels, ngq.cache,
+# ngq.preprocess, ngq.metrics, ngq.http, ngq.sweep; their levels are set with LOG_LEVELS or the
+# environment variable NGQ_LOG_LEVELS, f.e. NGQ_LOG_LEVELS=upload=DEBUG,cache=WARNING
+# Importing ngq has no side effects: the log file and its thread are set up
+# by configure_logging(), called on the first use of a client or an api
+# call if the application did not call it before.
+# Usage:
+#   ngq.configure_logging(filename='ngq.log', levels={'upload': 'DEBUG'})
+#   ngq.configure_logging(filename=None)      # no log file
+LOG_FILE = os.environ.get("NGQ_LOG_FILE", "logfile.log")    # "" or None = no log file
+LOG_LEVEL = logging.DEBUG if DEBUG else logging.INFO
+LOG_LEVELS = {}                 # {subsystem: level}
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+LOG_DATE_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+
+logger = logging.getLogger("ngq")
+_diagnostics_logger = logger.getChild("diagnostics")
+_upload_logger = logger.getChild("upload")
+_labels_logger = logger.getChild("labels")
+_cache_logger = logger.getChild("cache")
+_preprocess_logger = logger.getChild("preprocess")
+_metrics_logger = logger.getChild("metrics")
+_http_logger = logger.getChild("http")
+_sweep_logger = logger.getChild("sweep")
+
+_log_queue_handler = None   # logging.handlers.QueueHandler on the 'ngq' logger
+_log_listener = None        # logging.handlers.QueueListener writing the file
+_log_configured = False     # configure_logging() was called
+_log_lock = threading.Lock()
+
+#no "No handlers could be found" output until configure_logging() runs
+logger.addHandler(logging.NullHandler())
+
+def _parse_log_levels(text):
+    """'upload=DEBUG,cache=WARNING' -> {'upload': 'DEBUG', 'cache': 'WARNING'}"""
+    levels = {}
+    for item in text.split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+def configure_logging(filename=None, level=None, levels=None, max_bytes=None, backup_count=None):
+    """(Re)configure the 'ngq' logger: the log file (None or "" = no file),
+    the level of the 'ngq' logger and the {subsystem: level} dict of the
+    subsystem loggers. Arguments left None keep the LOG_* settings.
+    Returns the 'ngq' logger."""
+    global _log_queue_handler, _log_listener, _log_configured
+    import logging.handlers
+    filename = LOG_FILE if filename is None else filename
+    level = LOG_LEVEL if level is None else level
+    max_bytes = LOG_MAX_BYTES if max_bytes is None else max_bytes
+    backup_count = LOG_BACKUP_COUNT if backup_count is None else backup_count
+    if levels is None:
+        levels = dict(LOG_LEVELS)
+        levels.update(_parse_log_levels(os.environ.get("NGQ_LOG_LEVELS", "")))
+    with _log_lock:
+        if _log_listener is not None:
+            _log_listener.stop()
+            for handler in _log_listener.handlers:
+                handler.close()
+            _log_listener = None
+        if _log_queue_handler is not None:
+            logger.removeHandler(_log_queue_handler)
+            _log_queue_handler = None
+        logger.setLevel(level)
+        for name, subsystem_level in levels.items():
+            logger.getChild(name).setLevel(subsystem_level)
+        if filename:
+            file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes,
+                                                                backupCount=backup_count, delay=True)
+            file_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+            log_queue = queue.SimpleQueue()
+            _log_queue_handler = logging.handlers.QueueHandler(log_queue)
+            _log_listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+            _log_listener.start()
+            logger.addHandler(_log_queue_handler)
+        if not _log_configured:
+            _log_configured = True
+            atexit.register(_stop_logging)
+    return logger
+
+def _ensure_logging():
+    """configure_logging() with the LOG_* settings, unless it was called already."""
+    if not _log_configured:
+        configure_logging()
+        logger.info("Session started")
+
+def _log_filename():
+    """Path of the current log file, or None."""
+    if _log_listener is None:
+        return None
+    return _log_listener.handlers[0].baseFilename
+
+def flush_log():
+    """Wait until the queued log records are written to the log file."""
+    with _log_lock:
+        if _log_listener is not None:
+            _log_listener.stop()    # processes the queued records
+            _log_listener.handlers[0].flush()
+            _log_listener.start()
+
+def _stop_logging():
+    with _log_lock:
+        if _log_listener is not None:
+            _log_listener.stop()
+
+
+class _LazyModule:
+    """Module proxy, imports the module on first attribute access.
+    Keeps 'import ngq' fast: 'requests' alone takes ~0.1 s to import."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+requests = _LazyModule("requests")
+
+########## METRICS ##########
+# Optional instrumentation of the api calls. Each call is broken into phases:
+#   glob         listing the dataset files
+#   read         opening and reading the files
+#   encode       building the request bodies (multipart or tar headers)
+#   send         writing the request bodies to the connection
+#   server_wait  from the end of a request body to the response headers
+#   decode       parsing the JSON responses
+# Off by default; then an instrumented point costs a check of METRICS.
+# Usage:
+#   ngq.enable_metrics()                  # latency histograms in ngq.get_metrics()
+#   ngq.add_metrics_callback(my_function) # my_function(event) for each phase and call
+#   ...
+#   print(ngq.get_metrics().snapshot())
+METRICS = False
+PHASES = ('glob', 'read', 'encode', 'send', 'server_wait', 'decode')
+HISTOGRAM_BUCKETS = tuple(0.0001 * 2 ** i for i in range(24))   # seconds, upper bounds, 0.1 ms .. 14 min
+
+class _Histogram:
+    """Latency histogram with the fixed HISTOGRAM_BUCKETS."""
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(HISTOGRAM_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Upper bound of the bucket of the q-quantile, seconds."""
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(HISTOGRAM_BUCKETS, self.counts):
+            total += count
+            if total >= rank and total > 0:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'p50': self.quantile(0.50), 'p90': self.quantile(0.90), 'p99': self.quantile(0.99),
+                'buckets': dict(zip(HISTOGRAM_BUCKETS + (float('inf'),), self.counts))}
+
+class MetricsRegistry:
+    """In-process metrics: a latency histogram per phase and per api call,
+    and byte/file counters ('<name>.bytes', '<name>.files'). Thread safe.
+
+    Usage:
+        registry = ngq.enable_metrics()
+        ngq.upload_dataset_to_server_api(body)
+        registry.snapshot()['histograms']['send']['p99']
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = collections.Counter()
+
+    def observe(self, name, seconds, nbytes=0, files=0):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = _Histogram()
+            histogram.observe(seconds)
+            if nbytes:
+                self.counters[name + '.bytes'] += nbytes
+            if files:
+                self.counters[name + '.files'] += files
+
+    def snapshot(self):
+        """{'histograms': {name: {...}}, 'counters': {name: n}}"""
+        with self._lock:
+            return {'histograms': {name: h.as_dict() for name, h in self.histograms.items()},
+                    'counters': dict(self.counters)}
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+_metrics_registry = MetricsRegistry()
+_metrics_callbacks = []
+_current_call = contextvars.ContextVar('ngq_call', default=None)
+
+def enable_metrics(registry=None):
+    """Turn the instrumentation on, return the registry it records to."""
+    global METRICS, _metrics_registry
+    if registry is not None:
+        _metrics_registry = registry
+    METRICS = True
+    return _metrics_registry
+
+def disable_metrics():
+    global METRICS
+    METRICS = False
+
+def get_metrics():
+    """The MetricsRegistry the instrumentation records to."""
+    return _metrics_registry
+
+def add_metrics_callback(callback):
+    """Call callback(event) for each phase and api call while the metrics
+    are enabled. event is a dict with the keys
+        'kind'     'phase' or 'call'
+        'name'     the phase or the api call name
+        'call'     the api call a phase belongs to, or None
+        'seconds', 'bytes', 'files'
+    and for calls 'phases' {phase: seconds} and 'error' (the response
+    'error', or the exception). Callbacks run in the thread of the phase,
+    they should be quick."""
+    _metrics_callbacks.append(callback)
+
+def remove_metrics_callback(callback):
+    _metrics_callbacks.remove(callback)
+
+def _emit(event):
+    _metrics_registry.observe(event['name'], event['seconds'], event['bytes'], event['files'])
+    for callback in list(_metrics_callbacks):
+        try:
+            callback(event)
+        except Exception as e:
+            _metrics_logger.warning("[METRICS] callback failed: " + repr(e))
+
+class _CallSpan:
+    """Phase totals of one api call, shared by the threads working for it."""
+
+    def __init__(self, name):
+        self.name = name
+        self.phases = collections.Counter()
+        self.bytes = 0
+        self.files = 0
+        self._lock = threading.Lock()
+
+    def add(self, phase, seconds, nbytes, files):
+        with self._lock:
+            self.phases[phase] += seconds
+            if phase == 'send':
+                self.bytes += nbytes
+            elif phase == 'read':
+                self.files += files
+
+def _record(phase, seconds, nbytes=0, files=0):
+    """Record a phase of the current api call."""
+    span = _current_call.get()
+    if span is not None:
+        span.add(phase, seconds, nbytes, files)
+    _emit({'kind': 'phase', 'name': phase, 'call': span.name if span is not None else None,
+           'seconds': seconds, 'bytes': nbytes, 'files': files})
+
+class _Phase:
+    """Context manager timing a phase, see _phase."""
+
+    def __init__(self, name, nbytes, files):
+        self.name, self.nbytes, self.files = name, nbytes, files
+
+    def __enter__(self):
+        self.started = _perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        _record(self.name, _perf_counter() - self.started, self.nbytes, self.files)
+
+class _NoPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NO_PHASE = _NoPhase()
+
+def _phase(name, nbytes=0, files=0):
+    """with _phase('encode', files=n): ... times the block if METRICS is on."""
+    if not METRICS:
+        return _NO_PHASE
+    return _Phase(name, nbytes, files)
+
+def _traced(function):
+    """Decorator of the *_api calls: with METRICS on the call is recorded
+    with the totals of its phases."""
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        _ensure_logging()
+        if not METRICS:
+            return function(*args, **kwargs)
+        span = _CallSpan(name)
+        token = _current_call.set(span)
+        started = _perf_counter()
+        error = None
+        try:
+            response = function(*args, **kwargs)
+            if isinstance(response, dict):
+                error = response.get('error')
+            return response
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            _current_call.reset(token)
+            _emit({'kind': 'call', 'name': name, 'call': name,
+                   'seconds': _perf_counter() - started, 'bytes': span.bytes, 'files': span.files,
+                   'phases': dict(span.phases), 'error': error})
+    return wrapper
+
+def _in_context(executor, function, *args):
+    """executor.submit(function, *args) in a copy of the current context,
+    so the phases run by worker threads count for the current api call."""
+    return executor.submit(contextvars.copy_context().run, function, *args)
+
+class _TimedBody:
+    """Request body wrapper timing the send phase: the time the connection
+    spends writing each piece, not the time producing it (read, encode)."""
+
+    def __init__(self, body):
+        self.body = body
+        self.sent = 0
+        self.send_seconds = 0.0
+        self.finished = None    # perf_counter() after the last piece
+
+    def __iter__(self):
+        for piece in self.body:
+            started = _perf_counter()
+            yield piece
+            self.send_seconds += _perf_counter() - started
+            self.sent += len(piece)
+        self.finished = _perf_counter()
+
+class _TimedSizedBody(_TimedBody):
+    """_TimedBody of a body with a known length, sent with Content-Length."""
+
+    def __len__(self):
+        return len(self.body)
+
+def _timed_request(send, method, url, kwargs):
+    """send(method, url, **kwargs), recording the send, server_wait phases."""
+    kwargs = dict(kwargs)
+    data = kwargs.get('data')
+    body = None
+    if data is not None and not isinstance(data, (bytes, bytearray, str, dict, list, tuple)):
+        body = kwargs['data'] = (_TimedSizedBody if hasattr(data, '__len__') else _TimedBody)(data)
+    started = _perf_counter()
+    response = send(method, url, **kwargs)
+    finished = _perf_counter()
+    if body is not None and body.finished is not None:
+        _record('send', body.send_seconds, nbytes=body.sent)
+        _record('server_wait', finished - body.finished)
+    else:
+        #a small body is written at once, its send time is part of server_wait
+        _record('server_wait', finished - started)
+    return response
+
+def _decode(response):
+    """json.loads(response.content), timed as the decode phase."""
+    if not METRICS:
+        return json.loads(response.content)
+    with _phase('decode', nbytes=len(response.content)):
+        return json.loads(response.content)
+
+########## HTTP CLIENT ##########
+# Connection pool settings of the default client
+POOL_CONNECTIONS = 4     # number of hosts to keep connection pools for
+POOL_MAXSIZE = 16        # max keep-alive connections per host
+POOL_BLOCK = True        # True: wait for a free connection instead of opening more than POOL_MAXSIZE
+TIMEOUT = (30, None)     # (connect, read) timeouts in seconds, None = wait forever
+LEAN_PROTOCOL = False    # True: one request per upload chunk / labeling, readiness checked once per model
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+# Retries and circuit breaker of the default client, see RetryPolicy and CircuitBreaker
+RETRIES = 3                 # retries of a failed request, 0 = no retries
+RETRY_BACKOFF = 0.5         # seconds before the first retry, doubled for each next one
+RETRY_MAX_DELAY = 30.0      # seconds, also the limit of a Retry-After delay
+RETRY_JITTER = 0.5          # random part of a delay, fraction of it
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_NOT_PROCESSED = (429, 503)    # statuses of requests the server did not process
+BREAKER_FAILURES = 5        # consecutive failures that open the circuit of a server
+BREAKER_RESET = 30.0        # seconds the circuit stays open before a trial request
+
+class CircuitOpenError(ConnectionError):
+    """Raised instead of sending a request while the circuit of its server is open."""
+
+class LocalFileError(OSError):
+    """A file sent in a request body could not be read, or its size changed
+    while it was sent. The request is not retried, and the failure is not
+    counted against the server."""
+
+    def __init__(self, message, name=None):
+        super().__init__(message)
+        self.name = name        # the file name sent to the server
+
+def _local_error(exception, depth=0):
+    """The LocalFileError behind exception, else None. requests and urllib3
+    wrap an error raised by a body generator in a ConnectionError."""
+    if isinstance(exception, LocalFileError):
+        return exception
+    if not isinstance(exception, BaseException) or depth > 5:
+        return None
+    for inner in list(exception.args) + [exception.__cause__, exception.__context__]:
+        found = _local_error(inner, depth + 1)
+        if found is not None:
+            return found
+    return None
+
+class RetryPolicy:
+    """When and after which delay NgqClient retries a failed request.
+
+    A request is retried after a connection error, a timeout or a status in
+    RETRY_STATUSES, at most retries times, after backoff * 2**attempt
+    seconds plus jitter, or after the Retry-After the server sent (at most
+    max_delay). Requests that are not idempotent (f.e. starting a training)
+    are retried only if the server surely did not process them: a connect
+    timeout or a status in RETRY_NOT_PROCESSED. Request bodies that cannot
+    be sent again (open files) are not retried.
+
+    Usage:
+        client = ngq.NgqClient(retry=ngq.RetryPolicy(retries=5, backoff=1.0))
+        client = ngq.NgqClient(retry=ngq.RetryPolicy(retries=0))    # no retries
+    """
+
+    def __init__(self, retries=None, backoff=None, max_delay=None, jitter=None, statuses=None):
+        self.retries = RETRIES if retries is None else retries
+        self.backoff = RETRY_BACKOFF if backoff is None else backoff
+        self.max_delay = RETRY_MAX_DELAY if max_delay is None else max_delay
+        self.jitter = RETRY_JITTER if jitter is None else jitter
+        self.statuses = RETRY_STATUSES if statuses is None else tuple(statuses)
+
+    def retry_response(self, response, attempt, idempotent):
+        if attempt >= self.retries or response.status_code not in self.statuses:
+            return False
+        return idempotent or response.status_code in RETRY_NOT_PROCESSED
+
+    def retry_exception(self, exception, attempt, idempotent):
+        if attempt >= self.retries or _local_error(exception) is not None:
+            return False
+        if isinstance(exception, requests.exceptions.ConnectTimeout):
+            return True
+        if isinstance(exception, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return idempotent
+        return False
+
+    def delay(self, attempt, response=None):
+        """Seconds to wait before retry number attempt + 1."""
+        if response is not None:
+            retry_after = _retry_after(response.headers.get('Retry-After'))
+            if retry_after is not None:
+                return min(retry_after, self.max_delay)
+        import random
+        delay = min(self.backoff * 2 ** attempt, self.max_delay)
+        return delay * (1 + self.jitter * random.random())
+
+def _retry_after(value):
+    """Seconds of a Retry-After header, seconds or an HTTP date; None if absent or invalid."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+class CircuitBreaker:
+    """Circuit breaker of one server. After failures consecutive failed
+    requests (connection errors, timeouts, 5xx statuses) the circuit opens:
+    requests fail at once with CircuitOpenError instead of waiting for the
+    server, so callers do not pile up blocked threads. After reset seconds
+    one trial request is let through; its success closes the circuit, its
+    failure opens it again."""
+
+    def __init__(self, failures=None, reset=None):
+        self.failures = BREAKER_FAILURES if failures is None else failures
+        self.reset = BREAKER_RESET if reset is None else reset
+        self._lock = threading.Lock()
+        self._failed = 0
+        self._opened_at = None      # monotonic time, None while closed
+        self._trial = False         # a trial request is in flight
+
+    @property
+    def state(self):
+        """'closed', 'open' or 'half-open'"""
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            return 'half-open' if time.monotonic() - self._opened_at >= self.reset else 'open'
+
+    def allow(self):
+        """True if a request may be sent now."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset or self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def retry_in(self):
+        """Seconds until the circuit lets a trial request through."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self.reset - (time.monotonic() - self._opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self._failed = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failed += 1
+            if self._trial or self._failed >= self.failures:
+                self._opened_at = time.monotonic()
+            self._trial = False
+
+    def abandon(self):
+        """A request let through did not complete, f.e. it was cancelled:
+        it says nothing about the server, the next trial request may go."""
+        with self._lock:
+            self._trial = False
+
+# Server replicas, see ServerPool
+HEALTH_INTERVAL = 10.0          # seconds between the health checks of the replicas
+HEALTH_TIMEOUT = 3.0            # seconds, timeout of a health check
+HEALTH_ROUTE = '/server_version'
+LATENCY_SMOOTHING = 0.2         # weight of the newest latency in the average latency of a replica
+ROUTES_MAX = 10000              # sticky routes kept, the oldest ones are dropped
+
+def _health_request(session, server, timeout):
+    """POST HEALTH_ROUTE of server with the client version, as
+    check_server_version does; the server does not answer GET there."""
+    version_dict = {'client_major_version': VERSION, 'client_minor_version': MINOR_VERSION}
+    return session.post(server + HEALTH_ROUTE, json=version_dict, timeout=timeout)
+
+class ServerPool:
+    """Replicas of the server, with their health, latency and load.
+
+    A request to any of the servers goes to the least loaded healthy
+    replica: the one with the smallest (requests in flight + 1) * average
+    latency. A replica that fails a request (connection error, timeout,
+    5xx status) is not used until it passes a health check again; a
+    background thread checks all replicas every interval seconds
+    (POST HEALTH_ROUTE, see _health_request). A request that failed on one replica is retried on
+    another one, see NgqClient.request.
+
+    The files of a dataset and the models trained on it stay on the replica
+    that received them, so routing is sticky: the requests with a user_id
+    and a data_id or model_name in the query go to the replica that served
+    the last successful request of that data_id (first) or model_name. The
+    route is reserved by the first request of a key, so the parallel
+    requests of a new data_id (f.e. the chunks of an upload) all go to the
+    same replica; it is released if that request fails. Requests with a
+    route are not moved to another replica when it fails; the error is
+    returned instead. The routes are kept in memory, at most ROUTES_MAX.
+
+    Usage:
+        client = ngq.NgqClient(servers=['http://10.0.0.1:5000', 'http://10.0.0.2:5000'])
+        body['endpoint'] = 'http://10.0.0.1:5000/upload_data'   # any of the replicas
+        client.pool.status()                                    # health of the replicas
+    """
+
+    def __init__(self, servers, interval=None, timeout=None):
+        self.servers = [server.rstrip('/') for server in servers]
+        self.interval = HEALTH_INTERVAL if interval is None else interval
+        self.timeout = HEALTH_TIMEOUT if timeout is None else timeout
+        self._lock = threading.Lock()
+        self._healthy = {server: True for server in self.servers}
+        self._latency = {server: None for server in self.servers}     # seconds, moving average
+        self._in_flight = {server: 0 for server in self.servers}
+        self._routes = {}           # ('data' or 'model', user_id, name) -> server
+        self._thread = None
+        self._stop = threading.Event()
+
+    def server_of(self, url):
+        """The replica of url (scheme://host:port), None if it is not one of the pool."""
+        from urllib.parse import urlparse
+        parse_object = urlparse(url)
+        server = parse_object.scheme + '://' + parse_object.netloc
+        return server if server in self._healthy else None
+
+    @staticmethod
+    def route_keys(url):
+        """Sticky route keys of the query of url, the data_id one first."""
+        from urllib.parse import urlparse, parse_qs
+        query = parse_qs(urlparse(url).query)
+        if 'user_id' not in query:
+            return []
+        user_id = query['user_id'][0]
+        return [(kind, user_id, query[name][0]) for kind, name in (('data', 'data_id'), ('model', 'model_name'))
+                if name in query]
+
+    def bound(self, keys):
+        """The replica holding the first of keys that has a route, else None."""
+        with self._lock:
+            for key in keys:
+                if key in self._routes:
+                    return self._routes[key]
+        return None
+
+    def bind(self, keys, server):
+        """Route the requests of keys to server."""
+        with self._lock:
+            self._bind(keys, server)
+
+    def _bind(self, keys, server):
+        for key in keys:
+            self._routes.pop(key, None)
+            self._routes[key] = server
+        while len(self._routes) > ROUTES_MAX:
+            del self._routes[next(iter(self._routes))]
+
+    def link(self, user_id, data_id, model_name):
+        """Route the requests of data_id to the replica of model_name, f.e.
+        the files uploaded to be labeled by the model."""
+        server = self.bound([('model', str(user_id), str(model_name))])
+        if server is not None:
+            self.bind([('data', str(user_id), str(data_id))], server)
+
+    def pick(self, exclude=()):
+        """The least loaded healthy replica not in exclude; if there is none,
+        the least loaded of the others not in exclude, then of all."""
+        with self._lock:
+            return self._pick(exclude)
+
+    def _pick(self, exclude):
+        candidates = ([server for server in self.servers if self._healthy[server] and server not in exclude]
+                      or [server for server in self.servers if server not in exclude]
+                      or self.servers)
+        #a replica not measured yet is tried first
+        return min(candidates, key=lambda server: (self._in_flight[server] + 1) * (self._latency[server] or 0.0))
+
+    def route(self, keys, exclude=()):
+        """(replica, reserved) for a request of keys: the replica bound to the
+        first of keys with a route, reserved = False; else the least loaded
+        one not in exclude, bound to keys at once so that the parallel
+        requests of the same keys go there too, reserved = True. A reserved
+        route is released if the request fails, see release."""
+        with self._lock:
+            for key in keys:
+                if key in self._routes:
+                    return self._routes[key], False
+            server = self._pick(exclude)
+            if keys:
+                self._bind(keys, server)
+            return server, bool(keys)
+
+    def release(self, keys, server):
+        """Remove the routes of keys to server, reserved by a failed request."""
+        with self._lock:
+            for key in keys:
+                if self._routes.get(key) == server:
+                    del self._routes[key]
+
+    def started(self, server):
+        with self._lock:
+            self._in_flight[server] += 1
+
+    def finished(self, server, seconds, failed=True):
+        """A request to server finished; seconds = None if it failed, or with
+        failed = False if it was not sent to the end for a local reason."""
+        with self._lock:
+            self._in_flight[server] -= 1
+        if seconds is not None or failed:
+            self._update(server, seconds)
+
+    def _update(self, server, seconds):
+        with self._lock:
+            if seconds is None:
+                if self._healthy[server]:
+                    _http_logger.warning("[POOL] " + server + " is down")
+                self._healthy[server] = False
+                return
+            if not self._healthy[server]:
+                _http_logger.info("[POOL] " + server + " is up")
+            self._healthy[server] = True
+            latency = self._latency[server]
+            self._latency[server] = seconds if latency is None else (
+                                    (1 - LATENCY_SMOOTHING) * latency + LATENCY_SMOOTHING * seconds)
+
+    def check(self, session, callback=None, timeout=None):
+        """Health check of all replicas; callback(server, healthy) after each.
+        Returns the number of healthy replicas."""
+        timeout = self.timeout if timeout is None else timeout
+        healthy = 0
+        for server in self.servers:
+            started = time.monotonic()
+            try:
+                ok = _health_request(session, server, timeout).status_code == 200
+            except requests.exceptions.RequestException:
+                ok = False
+            self._update(server, time.monotonic() - started if ok else None)
+            healthy += ok
+            if callback is not None:
+                callback(server, ok)
+        return healthy
+
+    def start(self, session, callback=None):
+        """Start the background health checks, if they are not running."""
+        if self._thread is not None or self.interval is None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            def run():
+                while True:
+                    self.check(session, callback)
+                    if self._stop.wait(self.interval):
+                        return
+            self._thread = threading.Thread(target=run, name="ngq-health", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the background health checks."""
+        self._stop.set()
+
+    def status(self):
+        """[{'server', 'healthy', 'latency_ms', 'in_flight'}] of the replicas."""
+        with self._lock:
+            return [{'server': server, 'healthy': self._healthy[server],
+                     'latency_ms': None if self._latency[server] is None else round(1000 * self._latency[server], 1),
+                     'in_flight': self._in_flight[server]}
+                    for server in self.servers]
+
+def _replayable(kwargs):
+    """True if the request body can be sent again: no open files in it."""
+    data = kwargs.get('data')
+    if data is not None and hasattr(data, 'read'):
+        return False
+    if data is not None and not isinstance(data, (bytes, bytearray, str, dict, list, tuple, _MultipartStream, _TarStream, _CompressedBody)):
+        return False
+    files = kwargs.get('files') or []
+    for value in (files.values() if isinstance(files, dict) else [value for _, value in files]):
+        if isinstance(value, (list, tuple)):
+            value = value[1] if len(value) > 1 else None
+        if hasattr(value, 'read'):
+            return False
+    return True
+
+class NgqClient:
+    """HTTP client used by the ngq calls.
+    Owns a requests.Session with keep-alive connection pools, so that
+    consecutive requests to the server reuse the TCP and TLS connections.
+    The client can be shared between threads.
+
+    Usage:
+        client = ngq.NgqClient(pool_maxsize=32, timeout=(5, 600))
+        ngq.set_client(client)              # used by all *_api calls
+    or for a single call:
+        body['client'] = client
+
+    With lean = True the client uses the lean protocol: the status or labels
+    returned with a POST are used without the follow-up GET, and a model
+    found ready is not checked again (see _check_model_ready_once).
+
+    Failed requests are retried following retry (a RetryPolicy), and each
+    server gets a CircuitBreaker; circuit_breaker = False turns them off.
+
+    servers is a list of server replicas (base URLs, default SERVER_URLS)
+    or a ServerPool; the requests to any of them are balanced between them,
+    see ServerPool.
+    """
+
+    def __init__(self, pool_connections=None, pool_maxsize=None, pool_block=None, timeout=None, lean=None,
+                 retry=None, circuit_breaker=True, servers=None):
+        _ensure_logging()
+        self.pool_connections = POOL_CONNECTIONS if pool_connections is None else pool_connections
+        self.pool_maxsize = POOL_MAXSIZE if pool_maxsize is None else pool_maxsize
+        self.pool_block = POOL_BLOCK if pool_block is None else pool_block
+        self.timeout = TIMEOUT if timeout is None else timeout
+        self.lean = LEAN_PROTOCOL if lean is None else lean
+        self.retry = RetryPolicy() if retry is None else retry
+        self.circuit_breaker = circuit_breaker
+        self._breakers = {}         # server (scheme://host:port) -> CircuitBreaker
+        self._encodings = {}        # server -> encodings it accepts in request bodies
+        if servers is None:
+            servers = SERVER_URLS
+        self.pool = servers if isinstance(servers, ServerPool) else ServerPool(servers) if servers else None
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """The requests.Session, created on first use."""
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(
+                                    pool_connections=self.pool_connections,
+                                    pool_maxsize=self.pool_maxsize,
+                                    pool_block=self.pool_block)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+        return self._session
+
+    def breaker(self, url):
+        """The CircuitBreaker of the server of url, None if they are off."""
+        if not self.circuit_breaker:
+            return None
+        server = self._server(url)
+        with self._lock:
+            breaker = self._breakers.get(server)
+            if breaker is None:
+                breaker = self._breakers[server] = CircuitBreaker()
+        return breaker
+
+    def _send(self, method, url, kwargs):
+        if METRICS:
+            return _timed_request(self.session.request, method, url, kwargs)
+        return self.session.request(method, url, **kwargs)
+
+    @staticmethod
+    def _server(url):
+        from urllib.parse import urlparse
+        parse_object = urlparse(url)
+        return parse_object.scheme + '://' + parse_object.netloc
+
+    def _servers(self, url):
+        """The server of url, or all replicas if it is one of them."""
+        if self.pool is not None and self.pool.server_of(url) is not None:
+            return self.pool.servers
+        return [self._server(url)]
+
+    def accepted_encodings(self, url, probe=False):
+        """Encodings the server of url accepts in request bodies, as far as
+        its responses told; with server replicas, the ones all of them accept.
+        probe = True asks a server not heard from yet, see _health_request."""
+        servers = self._servers(url)
+        for server in servers if probe else []:
+            if server not in self._encodings:
+                try:
+                    response = _health_request(self.session, server, self.timeout)
+                    accept = response.headers.get('Accept-Encoding')
+                except requests.exceptions.RequestException:
+                    continue
+                with self._lock:
+                    self._encodings[server] = set() if accept is None else _parse_encodings(accept)
+        with self._lock:
+            known = [self._encodings[server] for server in servers if server in self._encodings]
+        return set.intersection(*known) if known else set()
+
+    def refuse_encoding(self, url, encoding):
+        """The server of url did not accept a request body compressed with encoding."""
+        with self._lock:
+            for server in self._servers(url):
+                self._encodings.get(server, set()).discard(encoding)
+
+    def _health_checked(self, server, healthy):
+        #a replica that passed a health check may be used at once
+        breaker = self.breaker(server)
+        if healthy and breaker is not None and breaker.state != 'closed':
+            breaker.record_success()
+
+    def request(self, method, url, idempotent=None, retry=None, **kwargs):
+        """Send a request through the pooled session, see requests.Session.request.
+        Failed requests are retried (see RetryPolicy); idempotent = True
+        marks a request that may be repeated, by default the GET-like methods.
+        retry, a RetryPolicy, replaces the retry policy of the client for this request.
+        A request to one of the server replicas goes to the replica chosen by
+        the ServerPool, and is retried on another one if it fails there.
+        Raises CircuitOpenError while the circuit of the server is open."""
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        if retry is None:
+            retry = self.retry
+        if not _replayable(kwargs):
+            retry = RetryPolicy(retries=0)
+        server = self.pool.server_of(url) if self.pool is not None else None
+        if server is not None:
+            self.pool.start(self.session, self._health_checked)
+            path = url[len(server):]
+            keys = self.pool.route_keys(url)
+            failed = set()          # replicas this request failed on
+        attempt = 0
+        while True:
+            reserved = False
+            if server is not None:
+                #sticky route, else the least loaded replica, reserved for keys
+                server, reserved = self.pool.route(keys, failed)
+                sticky = server if keys and not reserved else None
+                url = server + path
+            breaker = self.breaker(url)
+            if breaker is not None and not breaker.allow():
+                if reserved:
+                    self.pool.release(keys, server)
+                if server is not None and sticky is None and len(failed) + 1 < len(self.pool.servers):
+                    failed.add(server)
+                    continue
+                raise CircuitOpenError("The server of " + url + " is not available, next try in "
+                                       + str(round(breaker.retry_in(), 1)) + " s.")
+            if server is not None:
+                self.pool.started(server)
+                started = time.monotonic()
+            try:
+                response = self._send(method, url, kwargs)
+            except requests.exceptions.RequestException as ex:
+                local = _local_error(ex)
+                if local is not None:
+                    #a file of the body, not the server, failed
+                    if server is not None:
+                        self.pool.finished(server, None, failed=False)
+                    if reserved:
+                        self.pool.release(keys, server)
+                    raise local
+                if server is not None:
+                    self.pool.finished(server, None)
+                if breaker is not None:
+                    breaker.record_failure()
+                if reserved:
+                    self.pool.release(keys, server)
+                if not retry.retry_exception(ex, attempt, idempotent):
+                    if server is not None and sticky is not None:
+                        _http_logger.error("[POOL] the data or model of " + url + " is on " + server + ", which failed")
+                    raise
+                delay = retry.delay(attempt)
+                _http_logger.warning("[RETRY] " + method + " " + url + " failed: " + repr(ex) + ", retry in %.2f s", delay)
+            else:
+                if server is not None:
+                    self.pool.finished(server, time.monotonic() - started if response.status_code < 500 else None)
+                accept = response.headers.get('Accept-Encoding')
+                if accept is not None:
+                    encodings = _parse_encodings(accept)
+                    with self._lock:
+                        self._encodings[self._server(url)] = encodings
+                if breaker is not None:
+                    if response.status_code >= 500:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                if not retry.retry_response(response, attempt, idempotent):
+                    if server is not None and keys and response.status_code == 200:
+                        self.pool.bind(keys, server)
+                    elif reserved:
+                        self.pool.release(keys, server)
+                    return response
+                if reserved:
+                    self.pool.release(keys, server)
+                delay = retry.delay(attempt, response)
+                _http_logger.warning("[RETRY] " + method + " " + url + " answered " + str(response.status_code)
+                               + ", retry in %.2f s", delay)
+                response.close()
+            if server is not None and sticky is None:
+                failed.add(server)
+                if len(failed) < len(self.pool.servers):
+                    #another replica is tried at once
+                    delay = 0
+                else:
+                    failed.clear()
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        """Close the pooled connections, stop the health checks of the replicas."""
+        if self.pool is not None:
+            self.pool.stop()
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _http_error(response):
+    """None for a 200 response, else an error response dict with the status."""
+    if response.status_code == 200:
+        return None
+    return {"error": "Error",
+            "message": "The server answered " + str(response.status_code) + " " + str(response.reason) + " to " + response.url,
+            "status_code": response.status_code}
+
+def _lean_response(client, response, require=None):
+    """With a lean client, the JSON status dict sent with a POST response,
+    so the follow-up GET can be skipped. None if there is no status in it,
+    or if it is a success without the require key."""
+    if not client.lean:
+        return None
+    try:
+        data = _decode(response)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or 'error' not in data:
+        return None
+    if require is not None and data['error'] == "None" and require not in data:
+        return None
+    return data
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Return the default NgqClient, create it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = NgqClient()
+    return _client
+
+def set_client(client):
+    """Make client the default NgqClient. Returns the previous default client."""
+    global _client
+    with _client_lock:
+        previous, _client = _client, client
+    return previous
+
+
+# Checking internet
+# basic connection:
+def check_internet(host="8.8.8.8", port=53, timeout=3):
+    """
+    Host: 8.8.8.8 (google-public-dns-a.google.com)
+    OpenPort: 53/tcp
+    Service: domain (DNS/TCP)
+    Returns True if the connection succeeded.
+    """
+    try:
+        socket.create_connection((host, port), timeout=timeout).close()
+        _diagnostics_logger.info("[NETWORK] Internet is working")
+        return True
+    except socket.error as ex:
+        print(ex)
+        print("[NETWORK] Please check your internet network\n")
+        _diagnostics_logger.error(ex)
+        _diagnostics_logger.error("[NETWORK] Please check your internet network")
+        #_diagnostics_logger.info("Session finished")
+        return False
+
+def check_server(host=None, port=None, timeout=3, exit_on_error=False):
+    """ Checking DO server.
+    Returns True if the server is reachable, else False; with
+    exit_on_error = True raises ConnectionError instead of returning False.
+    If the default client has server replicas and no host is given, all of
+    them are checked and True means that at least one of them is healthy."""
+    _diagnostics_logger.info("[SERVER] Start checking DO server.")
+    client = get_client()
+    if host is None and client.pool is not None:
+        healthy = client.pool.check(client.session, client._health_checked, timeout)
+        for status in client.pool.status():
+            _diagnostics_logger.info("[SERVER] " + status['server'] + (" is healthy." if status['healthy'] else " is down."))
+        if healthy or not exit_on_error:
+            return healthy > 0
+        raise ConnectionError("None of the server replicas is reachable.")
+    if host is None:
+        host, port = my_host, my_port
+    try:
+        socket.create_connection((host, port), timeout=timeout).close()
+        _diagnostics_logger.info("[SERVER] Server is reacheable.")
+        return True
+    except socket.error as ex:
+        print(ex)
+        print("[SERVER] Cannot establish connection with the server.\n")
+        _diagnostics_logger.error(ex)
+        _diagnostics_logger.error("[SERVER] Cannot establish connection with the server.")
+        if not exit_on_error:
+            return False
+        raise ConnectionError("Cannot establish connection with the server " + str(host) + ":" + str(port) + ".")
+
+def check_server_version(timeout=None):
+    """Check if the server and clinet versions match.
+    Returns the server version dict. The request is sent once, not retried,
+    so that it ends within timeout."""
+    _diagnostics_logger.info("Client major version = " + VERSION)
+    _diagnostics_logger.info("Client minor version = " + MINOR_VERSION)
+    _diagnostics_logger.info("[SERVER VERSION] Start checking server version.")
+    url = SERVER_URL + '/server_version'
+    version_dict = {'client_major_version': VERSION, 'client_minor_version': MINOR_VERSION}
+    #response = requests.get(url=url)
+    response = get_client().post(url=url, json=version_dict, timeout=timeout, idempotent=True,
+                                 retry=RetryPolicy(retries=0))
+    response.raise_for_status()
+    data = json.loads(response.content)
+    SERVER_VERSION = data['server_version']
+    SERVER_MINOR_VERSION = data['server_minor_version']
+    #checking if the versions match
+    if VERSION == SERVER_VERSION:
+        _diagnostics_logger.info("[SERVER VERSION] Server and client major versions match")
+        _diagnostics_logger.warning("Server minor version = " + SERVER_MINOR_VERSION)
+        _diagnostics_logger.warning("Client minor version = " + MINOR_VERSION)
+    else:
+        _diagnostics_logger.warning("[SERVER VERSION] Server and client major versions NO NOT match")
+        _diagnostics_logger.warning("Server major version = " + SERVER_VERSION)
+        _diagnostics_logger.warning("Server minor version = " + SERVER_MINOR_VERSION)
+        print("[WARNING] Server and client major versions NO NOT match.")
+    return data
+    
+def get_dir_tree(starting_directory=".", deadline=None):
+    """ Getting the dir tree.
+    Stops walking at time.monotonic() > deadline, if the deadline is given."""
+    tree={}
+    for root, directories, files in os.walk(starting_directory):
+        dir_dict = {}
+        dir_dict['dirs'] = directories
+        dir_dict['files'] = files
+        tree.update({root: dir_dict })
+        if deadline is not None and time.monotonic() > deadline:
+            tree.update({'truncated': True})
+            break
+    return tree
+    
+def client_post_log(tree, timeout=None):
+    """Sending the log to the server, once, without retries"""
+    url = SERVER_URL + '/post_log'
+    flush_log()
+    filename = _log_filename()
+    files = [('tree', ('tree', json.dumps(tree), 'application/json'))]
+    if filename is None or not os.path.isfile(filename):
+        response = get_client().post(url, files=files, timeout=timeout, retry=RetryPolicy(retries=0))
+    else:
+        with open(filename, 'rb') as f:
+            files.insert(0, ('logfile', ('logfile.log', f, 'application/octet')))
+            response = get_client().post(url, files=files, timeout=timeout, retry=RetryPolicy(retries=0))
+    response.raise_for_status()
+    return
+    
+def check_client_os():
+    """ Check host system """
+    sys_platform = sys.platform
+    os_name = os.name
+    _diagnostics_logger.info("[OS] client sys platform = " + sys_platform)
+    _diagnostics_logger.info("[OS] client os name = " + os_name)
+    return {'sys_platform': sys_platform, 'os_name': os_name}
+
+########## DIAGNOSTICS ##########
+# Diagnostics are opt-in and run at most once per process. The results are
+# cached in _diagnostics, keyed by the process id so that forked workers
+# run their own.
+_diagnostics = {}
+_diagnostics_lock = threading.Lock()
+_diagnostics_thread = None
+
+def startup_time():
+    """Return the time in seconds spent importing ngq."""
+    return _IMPORT_FINISHED - _IMPORT_STARTED
+
+def _run_diagnostics(budget, post_log):
+    """Run the diagnostics checks within budget seconds, return the results dict.
+    A check is skipped once the budget is spent; network timeouts are cut to
+    the remaining budget."""
+    started = time.monotonic()
+    deadline = started + budget
+    results = {'skipped': []}
+
+    def remaining():
+        return deadline - time.monotonic()
+
+    checks = [
+        ('client_os', lambda: check_client_os()),
+        ('internet', lambda: check_internet(timeout=min(3, remaining()))),
+        ('server', lambda: check_server(timeout=min(3, remaining()), exit_on_error=False)),
+        ('server_version', lambda: check_server_version(timeout=remaining())),
+    ]
+    if post_log:
+        checks.append(('post_log', lambda: client_post_log(get_dir_tree(deadline=deadline), timeout=remaining())))
+
+    for name, check in checks:
+        if remaining() <= 0:
+            results['skipped'].append(name)
+            continue
+        try:
+            results[name] = check()
+        except Exception as ex:
+            _diagnostics_logger.error("[DIAGNOSTICS] " + name + " failed: " + repr(ex))
+            results[name] = {'error': 'Error', 'message': repr(ex)}
+        if name in ('server', 'internet') and results[name] is False:
+            #no network, the rest would only wait for timeouts
+            results['skipped'] += [c[0] for c in checks if c[0] not in results]
+            break
+
+    results['elapsed'] = time.monotonic() - started
+    _diagnostics_logger.info("[DIAGNOSTICS] finished in %.3f s, skipped: %s", results['elapsed'], results['skipped'])
+    return results
+
+def run_diagnostics(background=False, budget=None, post_log=True):
+    """Collect diagnostics data: internet, server, server version, client os
+    and, if post_log is True, send the log file to the server.
+    Results are cached for the process, repeated calls return the cache.
+    With background=True the checks run in a daemon thread and the function
+    returns at once; use get_diagnostics() to read the results.
+
+    Usage:
+        results = ngq.run_diagnostics()
+        ngq.run_diagnostics(background=True); ...; results = ngq.get_diagnostics(wait=True)
+    """
+    global _diagnostics_thread
+    _ensure_logging()
+    if budget is None:
+        budget = DIAGNOSTICS_BUDGET
+    pid = os.getpid()
+    with _diagnostics_lock:
+        if pid in _diagnostics:
+            return _diagnostics[pid]
+        if _diagnostics_thread is None or not _diagnostics_thread.is_alive():
+            def target():
+                results = _run_diagnostics(budget, post_log)
+                with _diagnostics_lock:
+                    _diagnostics[pid] = results
+            _diagnostics_thread = threading.Thread(target=target, name="ngq-diagnostics", daemon=True)
+            _diagnostics_thread.start()
+        running = _diagnostics_thread
+    if background:
+        return None
+    running.join()
+    return _diagnostics.get(pid)
+
+def get_diagnostics(wait=False, timeout=None):
+    """Return the cached diagnostics results, or None if they are not ready.
+    With wait=True block until the running diagnostics finish."""
+    thread = _diagnostics_thread
+    if wait and thread is not None:
+        thread.join(timeout)
+    return _diagnostics.get(os.getpid())
+
+def tests():
+    """ Collect diagnostics data """
+    return run_diagnostics()
+
+if RUN_DIAGNOSTICS or os.environ.get("NGQ_DIAGNOSTICS") == "1":
+    run_diagnostics(background=True)
+
+
+########## DATASET FILES ##########
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+class _DatasetFile:
+    """A file to upload: a file on disk or a member of an archive.
+    name is the file name sent to the server; path, size and mtime_ns
+    identify the content for the hash cache and the upload journal.
+    Archive members are read with opener(), or kept in data."""
+
+    __slots__ = ('path', 'name', 'size', 'mtime_ns', 'opener', 'data')
+
+    def __init__(self, path, name=None, size=None, mtime_ns=None, opener=None, data=None):
+        if size is None or mtime_ns is None:
+            stat = os.stat(path)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        self.path = path
+        self.name = os.path.basename(path) if name is None else name
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.opener = opener
+        self.data = data
+
+    def open(self):
+        """Binary file object with the content."""
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        if self.opener is not None:
+            return self.opener()
+        return open(self.path, 'rb')
+
+    def key(self):
+        """(path, size, mtime_ns), changes when the content may have changed."""
+        return (self.path, self.size, self.mtime_ns)
+
+def _is_archive(dataset_dir):
+    return os.path.isfile(dataset_dir) and dataset_dir.lower().endswith(ARCHIVE_EXTENSIONS)
+
+def _member_name(member_name):
+    """File name sent for an archive member: its path in the archive,
+    f.e. 'cats/img001.png', without a leading '/' or './'."""
+    return '/'.join(part for part in member_name.split('/') if part not in ('', '.'))
+
+def _archive_name_ok(member_name):
+    """Skip what glob(dataset_dir + '*') would skip: hidden files, and the
+    __MACOSX/ metadata zip tools on macOS add."""
+    name = os.path.basename(member_name)
+    return bool(name) and not name.startswith('.') and not member_name.startswith('__MACOSX/')
+
+class _ZipArchive:
+    """A zip archive, open while it is listed or one of its members is
+    read: open(info) opens the archive if it is closed, it is closed again
+    when the listing is finished and the last open member is closed."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._zf = None
+        self._users = 0
+
+    def acquire(self):
+        """The open zipfile.ZipFile, until release()."""
+        with self._lock:
+            if self._zf is None:
+                self._zf = zipfile.ZipFile(self.path)
+            self._users += 1
+            return self._zf
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            if self._users == 0:
+                self._zf.close()
+                self._zf = None
+
+    def open(self, info):
+        """Binary file object of the member info; closing it releases the archive."""
+        zf = self.acquire()
+        try:
+            with self._lock:
+                member = zf.open(info)
+        except BaseException:
+            self.release()
+            raise
+        return _ArchiveMember(member, self.release)
+
+# idle readers kept by a _TarArchive
+TAR_READERS = 8
+
+class _TarArchive:
+    """A tar archive whose members are read when they are sent, not when
+    they are listed. A member is read with the idle reader (a TarFile in
+    random access mode) closest before it in the archive, so a compressed
+    archive is decompressed about once per reader while the members are
+    read in order, as the chunks are sent. The readers are closed by
+    close(), or when the files listed from the archive are released."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._idle = []     # [position in the archive, TarFile] of the readers not in use
+        self._finalizer = weakref.finalize(self, _TarArchive._close_readers, self._idle, self._lock)
+
+    @staticmethod
+    def _close_readers(idle, lock):
+        with lock:
+            readers = [reader for _, reader in idle]
+            del idle[:]
+        for reader in readers:
+            reader.close()
+
+    def close(self):
+        self._finalizer()
+
+    def open(self, member):
+        """Binary file object of the member; closing it gives its reader back."""
+        with self._lock:
+            usable = [item for item in self._idle if item[0] <= member.offset_data]
+            item = max(usable, key=lambda item: item[0]) if usable else None
+            if item is not None:
+                self._idle.remove(item)
+        reader = item[1] if item is not None else tarfile.open(self.path, mode='r:*')
+        try:
+            f = reader.extractfile(member)
+        except BaseException:
+            reader.close()
+            raise
+        return _ArchiveMember(f, lambda: self._give_back(reader, member.offset_data + member.size))
+
+    def _give_back(self, reader, position):
+        with self._lock:
+            self._idle.append([position, reader])
+            if len(self._idle) <= TAR_READERS:
+                return
+            #the reader furthest back is the least likely to be of use
+            item = min(self._idle, key=lambda item: item[0])
+            self._idle.remove(item)
+        item[1].close()
+
+class _ArchiveMember:
+    """A member of an archive open for reading, see _ZipArchive.open and
+    _TarArchive.open."""
+
+    def __init__(self, member, release):
+        self._member = member
+        self._release = release
+
+    def __getattr__(self, name):
+        return getattr(self._member, name)
+
+    def close(self):
+        if self._release is not None:
+            self._member.close()
+            self._release()
+            self._release = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _archive_files(archive):
+    """Yield _DatasetFile for the files in a .zip or .tar(.gz/.bz2/.xz) archive,
+    named with their path in the archive (see _member_name). The members are
+    read from the archive when they are sent, see _ZipArchive and _TarArchive."""
+    path = os.path.abspath(archive)
+    mtime_ns = os.stat(path).st_mtime_ns
+    if path.lower().endswith('.zip'):
+        archive = _ZipArchive(path)
+        zf = archive.acquire()
+        try:
+            for info in zf.infolist():
+                if info.is_dir() or not _archive_name_ok(info.filename):
+                    continue
+                yield _DatasetFile(path + '::' + info.filename,
+                                   name=_member_name(info.filename),
+                                   size=info.file_size,
+                                   mtime_ns=mtime_ns,
+                                   opener=lambda info=info: archive.open(info))
+        finally:
+            archive.release()
+    else:
+        archive = _TarArchive(path)
+        with tarfile.open(path, mode='r:*') as tf:
+            for member in tf:
+                if not member.isfile() or not _archive_name_ok(member.name):
+                    continue
+                yield _DatasetFile(path + '::' + member.name,
+                                   name=_member_name(member.name),
+                                   size=member.size,
+                                   mtime_ns=mtime_ns,
+                                   opener=lambda member=member: archive.open(member))
+
+def _dataset_files(dataset_dir):
+    """Yield _DatasetFile for the files to upload from dataset_dir: a
+    directory (f.e. 'my_datasets/MNIST_1024_images/'), a path prefix for
+    glob, an archive (f.e. 'my_datasets/MNIST_1024_images.zip') or a
+    DatasetScan. Subdirectories are not files, they are skipped."""
+    if isinstance(dataset_dir, DatasetScan):
+        yield from dataset_dir
+        return
+    if _is_archive(dataset_dir):
+        yield from _archive_files(dataset_dir)
+        return
+    if dataset_dir.endswith(('/', os.sep)) and os.path.isdir(dataset_dir):
+        yield from DatasetScan(dataset_dir)
+        return
+    with _phase('glob') as phase:
+        paths = [path for path in glob.glob(dataset_dir + '*') if os.path.isfile(path)]
+        phase.files = len(paths)
+    for path in paths:
+        yield _DatasetFile(path)
+
+########## DATASET SCANNER ##########
+SCAN_RECURSIVE = False      # True: the files in the subdirectories are uploaded too
+SCAN_INDEX = False          # True: keep the listings in CACHE_DIR/scan_index.sqlite, see _ScanIndex
+SCAN_INDEX_BATCH = 1000     # entries written to the index at a time
+LABELS_FILE = 'labels.csv'  # labels file generated for the class_subdirs layout
+
+class DatasetScan:
+    """Files of a directory, listed with os.scandir while they are uploaded.
+
+    recursive = True goes into the subdirectories; the file names sent to
+    the server are then the paths relative to the directory, f.e.
+    'cats/img001.png'. include and exclude are lists of fnmatch patterns
+    (f.e. ['*.png']) matched against the relative path; a file is taken if
+    it matches an include pattern (or include is empty) and no exclude
+    pattern. An excluded subdirectory is not entered. Hidden files are
+    skipped, like glob does.
+
+    directory may also be a .zip or .tar(.gz/.bz2/.xz) archive: its members
+    are named and filtered by their path in the archive, the same way.
+
+    class_subdirs = True is the class-per-subdirectory layout: each
+    subdirectory of the directory is a class (f.e. cats/, dogs/), the files
+    in it are uploaded with a generated labels.csv (filename,label), like
+    the one of my_datasets/MNIST_1024_images.
+
+    use_index = True keeps the listing of each directory in an index in
+    CACHE_DIR. A directory whose mtime did not change since is not listed
+    again, its entries are read from the index, so a repeated scan of a
+    large dataset only lists the directories with added, removed or renamed
+    files. A file rewritten in place (same name) does not change the
+    directory mtime, so its size is the one of the last listing: its upload
+    fails with an error, and its directory is listed again by the next scan
+    (f.e. of the resumed upload), see _forget_listing.
+
+    Usage:
+        body['dataset_dir'] = ngq.DatasetScan('my_datasets/pets/', class_subdirs=True, include=['*.jpg'])
+    or the body keys 'recursive', 'include', 'exclude', 'class_subdirs' and
+    'scan_index' of the *_api calls.
+    """
+
+    def __init__(self, directory, recursive=None, include=None, exclude=None, class_subdirs=False, use_index=None):
+        self.directory = directory
+        self.recursive = SCAN_RECURSIVE if recursive is None else recursive
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        self.class_subdirs = class_subdirs
+        self.use_index = SCAN_INDEX if use_index is None else use_index
+
+    def __repr__(self):
+        return ('DatasetScan(' + repr(self.directory) + ', recursive=' + str(self.recursive)
+                + ', class_subdirs=' + str(self.class_subdirs) + ')')
+
+    def _wanted(self, relative_path):
+        if any(fnmatch.fnmatchcase(relative_path, pattern) for pattern in self.exclude):
+            return False
+        return not self.include or any(fnmatch.fnmatchcase(relative_path, pattern) for pattern in self.include)
+
+    def _selected(self, relative_path):
+        """Filter of an archive member, like _walk filters the files of a directory."""
+        parts = relative_path.split('/')
+        if any(part.startswith('.') for part in parts):
+            return False
+        depth = len(parts) - 1
+        if depth and not (self.recursive or (self.class_subdirs and depth == 1)):
+            return False
+        for i in range(1, len(parts)):
+            if any(fnmatch.fnmatchcase('/'.join(parts[:i]), pattern) for pattern in self.exclude):
+                return False
+        return self._wanted(relative_path)
+
+    def _files(self, index, stable_before_ns):
+        """Yield the _DatasetFile of the files taken, of the directory or the archive."""
+        if _is_archive(self.directory):
+            for file in _archive_files(self.directory):
+                if self._selected(file.name):
+                    yield file
+            return
+        for relative_path, path, size, mtime_ns in self._walk(self.directory, '', 0, index, stable_before_ns):
+            yield _DatasetFile(path, name=relative_path, size=size, mtime_ns=mtime_ns)
+
+    def _walk(self, directory, prefix, depth, index, stable_before_ns):
+        """Yield (relative path, path, size, mtime_ns) of the files, depth first."""
+        subdirs = []
+        for name, is_dir, size, mtime_ns in _list_directory(directory, index, stable_before_ns):
+            if name.startswith('.'):
+                continue
+            relative_path = prefix + name
+            if is_dir:
+                if (self.recursive or (self.class_subdirs and depth == 0)) and \
+                   not any(fnmatch.fnmatchcase(relative_path, pattern) for pattern in self.exclude):
+                    subdirs.append(name)
+            elif self._wanted(relative_path):
+                yield relative_path, os.path.join(directory, name), size, mtime_ns
+        #the listing is finished before going down, the index reads one directory at a time
+        for name in sorted(subdirs):
+            yield from self._walk(os.path.join(directory, name), prefix + name + '/', depth + 1,
+                                  index, stable_before_ns)
+
+    def __iter__(self):
+        index = _scan_index() if self.use_index and not _is_archive(self.directory) else None
+        #a directory changed less than 2 s before the scan may change again within its mtime tick
+        stable_before_ns = time.time_ns() - 2000000000
+        labels = io.BytesIO() if self.class_subdirs else None
+        seconds = 0.0
+        files = 0
+        started = _perf_counter() if METRICS else None
+        try:
+            for file in self._files(index, stable_before_ns):
+                if labels is not None:
+                    if '/' not in file.name:
+                        if file.name == LABELS_FILE:
+                            continue    # replaced by the generated one
+                    else:
+                        label = file.name.split('/', 1)[0]
+                        labels.write((file.name + ',' + label + '\n').encode('utf-8'))
+                files += 1
+                if started is not None:
+                    seconds += _perf_counter() - started
+                yield file
+                if started is not None:
+                    started = _perf_counter()
+        finally:
+            if index is not None:
+                index.commit()
+        if started is not None:
+            _record('glob', seconds, files=files)
+        if labels is not None:
+            data = b'filename,label\n' + labels.getvalue()
+            #the content hash in mtime_ns: the hash cache sees a new file when the labels change
+            digest = hashlib.blake2b(data, digest_size=8).digest()
+            yield _DatasetFile(os.path.join(os.path.abspath(self.directory), '::' + LABELS_FILE),
+                               name=LABELS_FILE, size=len(data),
+                               mtime_ns=int.from_bytes(digest, 'big') >> 1, data=data)
+
+def _scandir(directory):
+    """Yield (name, is_dir, size, mtime_ns) of the entries of directory."""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    yield entry.name, True, 0, 0
+                elif entry.is_file():
+                    stat = entry.stat()
+                    yield entry.name, False, stat.st_size, stat.st_mtime_ns
+            except OSError:
+                continue    # removed while listed
+
+def _list_directory(directory, index, stable_before_ns):
+    """_scandir(directory), from the index if the directory did not change
+    since it was indexed, else listed and written to the index."""
+    if index is None:
+        yield from _scandir(directory)
+        return
+    path = os.path.abspath(directory)
+    mtime_ns = os.stat(path).st_mtime_ns
+    if index.is_current(path, mtime_ns):
+        yield from index.entries(path)
+        return
+    index.clear(path)
+    batch = []
+    for entry in _scandir(directory):
+        batch.append(entry)
+        if len(batch) >= SCAN_INDEX_BATCH:
+            index.add(path, batch)
+            batch = []
+        yield entry
+    index.add(path, batch)
+    #reached only if the listing was complete
+    if mtime_ns < stable_before_ns:
+        index.set_current(path, mtime_ns)
+
+class _ScanIndex:
+    """Persistent listings of the scanned directories, an sqlite database
+    in CACHE_DIR. A listing is current while the directory mtime is the one
+    recorded after the listing was complete.
+
+    Usage:
+        index = _scan_index()
+        if index.is_current(path, mtime_ns): entries = index.entries(path)
+    """
+
+    def __init__(self, filename=None):
+        import sqlite3
+        self.filename = filename or os.path.join(CACHE_DIR, "scan_index.sqlite")
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.filename, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries (dir TEXT, name TEXT, is_dir INTEGER, size INTEGER, mtime_ns INTEGER)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_dir ON entries (dir)")
+        self._db.commit()
+
+    def is_current(self, path, mtime_ns):
+        with self._lock:
+            row = self._db.execute("SELECT mtime_ns FROM dirs WHERE path = ?", (path,)).fetchone()
+        return row is not None and row[0] == mtime_ns
+
+    def entries(self, path):
+        """Yield the (name, is_dir, size, mtime_ns) of the indexed listing."""
+        with self._lock:
+            rows = self._db.execute("SELECT name, is_dir, size, mtime_ns FROM entries WHERE dir = ?", (path,))
+        while True:
+            with self._lock:
+                batch = rows.fetchmany(SCAN_INDEX_BATCH)
+            if not batch:
+                return
+            for name, is_dir, size, mtime_ns in batch:
+                yield name, bool(is_dir), size, mtime_ns
+
+    def clear(self, path):
+        with self._lock:
+            self._db.execute("DELETE FROM dirs WHERE path = ?", (path,))
+            self._db.execute("DELETE FROM entries WHERE dir = ?", (path,))
+
+    def add(self, path, entries):
+        with self._lock:
+            self._db.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?)",
+                                 [(path, name, int(is_dir), size, mtime_ns) for name, is_dir, size, mtime_ns in entries])
+
+    def set_current(self, path, mtime_ns):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (path, mtime_ns))
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+
+_scan_index_instance = None
+_scan_index_lock = threading.Lock()
+
+def _scan_index():
+    """The _ScanIndex, None if sqlite3 is not available."""
+    global _scan_index_instance
+    if _scan_index_instance is None:
+        with _scan_index_lock:
+            if _scan_index_instance is None:
+                try:
+                    _scan_index_instance = _ScanIndex()
+                except Exception as ex:
+                    _cache_logger.warning("[SCAN] cannot open the scan index, scanning without it: " + repr(ex))
+                    return None
+    return _scan_index_instance
+
+def _forget_listing(path):
+    """Drop the indexed listing of the directory of path, f.e. when the
+    size of the file turned out to be out of date."""
+    index = _scan_index_instance
+    if index is not None:
+        index.clear(os.path.dirname(os.path.abspath(path)))
+        index.commit()
+
+def _patterns_from_body(body, key):
+    """body[key] as a list: a list, or a comma separated string."""
+    value = body.get(key) or []
+    if isinstance(value, str):
+        value = [pattern.strip() for pattern in value.split(',') if pattern.strip()]
+    return list(value)
+
+def _dataset_from_body(body, dataset_dir):
+    """dataset_dir, or a DatasetScan of it with the scan options of the body:
+    'recursive', 'include', 'exclude' (lists, or comma separated strings),
+    'class_subdirs' and 'scan_index'."""
+    keys = ('recursive', 'include', 'exclude', 'class_subdirs', 'scan_index')
+    if isinstance(dataset_dir, DatasetScan) or not any(key in body for key in keys):
+        return dataset_dir
+
+    def flag(key, default):
+        return str(body[key]) == 'True' if key in body else default
+
+    return DatasetScan(dataset_dir,
+                       recursive = flag('recursive', None),
+                       include = _patterns_from_body(body, 'include'),
+                       exclude = _patterns_from_body(body, 'exclude'),
+                       class_subdirs = flag('class_subdirs', False),
+                       use_index = flag('scan_index', None))
+
+########## MULTIPART STREAMING ##########
+UPLOAD_BLOCK_SIZE = 64 * 1024   # bytes read from a file at a time
+
+def _file_part(field, file):
+    """Multipart part (field, filename, size, opener) for a _DatasetFile or a path."""
+    if not isinstance(file, _DatasetFile):
+        file = _DatasetFile(file)
+    return (field, file.name, file.size, file.open)
+
+def _read_blocks(opener, size, filename):
+    """Yield the size bytes of opener() in blocks of up to UPLOAD_BLOCK_SIZE,
+    see _file_blocks."""
+    #with METRICS on, the time in open() and read() is the read phase
+    started = _perf_counter() if METRICS else None
+    seconds = 0.0
+    try:
+        with opener() as f:
+            for block in _file_blocks(f, size, filename):
+                if started is not None:
+                    seconds += _perf_counter() - started
+                yield block
+                if started is not None:
+                    started = _perf_counter()
+    except LocalFileError:
+        raise
+    except OSError as ex:
+        raise LocalFileError("File " + filename + " could not be read: " + str(ex), filename) from ex
+    if started is not None:
+        _record('read', seconds, nbytes=size, files=1)
+
+# File reads: a file is read with readinto() into one buffer reused for all
+# its blocks, so no new bytes object is allocated per block; in-memory
+# archive members are sent as memoryview slices of their data.
+# Zero-copy reads, opt-in: with MMAP_READS = True files of MMAP_MIN_BYTES or
+# more are memory mapped and sent as slices of the page cache. The socket
+# write (and the TLS encryption) still copies the bytes once; the body goes
+# through requests/urllib3 and TLS, so os.sendfile is not used. A mapped
+# file must not be truncated while it is sent: reading past its new end
+# kills the whole process with SIGBUS, so only turn it on if the dataset
+# files are not rewritten during an upload. benchmarks/bench_ngq.py
+# --scenarios upload,upload_mmap compares the CPU time per MB of both.
+MMAP_READS = False
+MMAP_MIN_BYTES = 1024 * 1024    # smaller files are read, mapping them costs more than it saves
+MMAP_WINDOW = 8 * 1024 * 1024   # bytes mapped at a time, bounds the mapped memory per file
+
+def _file_blocks(f, size, filename):
+    """Yield the size bytes of the binary file object f in blocks of up to
+    UPLOAD_BLOCK_SIZE: memoryview slices of the data of an io.BytesIO or of
+    a memory mapped file, or of a buffer filled with f.readinto(). A block
+    of the buffer is only valid until the next one is requested: the body
+    consumers send or compress each block before they ask for the next.
+    Raises LocalFileError if the file is not size bytes long: the size
+    was sent to the server before the content."""
+    short = "File " + filename + " is shorter than " + str(size) + " bytes, was it changed during the upload?"
+    longer = "File " + filename + " is longer than " + str(size) + " bytes, was it changed during the upload?"
+    if isinstance(f, io.BytesIO):
+        view = memoryview(f.getvalue())     # the BytesIO data, not a copy
+        if len(view) < size:
+            raise LocalFileError(short, filename)
+        if len(view) > size:
+            raise LocalFileError(longer, filename)
+        for offset in range(0, size, UPLOAD_BLOCK_SIZE):
+            yield view[offset:min(offset + UPLOAD_BLOCK_SIZE, size)]
+        return
+    fileno = None
+    if MMAP_READS and size >= MMAP_MIN_BYTES:
+        try:
+            fileno = f.fileno()
+        except (AttributeError, OSError, ValueError):
+            fileno = None   # f.e. a zip member
+    if fileno is not None:
+        actual = os.fstat(fileno).st_size
+        if actual != size:
+            raise LocalFileError(short if actual < size else longer, filename)
+        for window in range(0, size, MMAP_WINDOW):
+            length = min(MMAP_WINDOW, size - window)
+            #the window is unmapped when its last block is released
+            view = memoryview(mmap.mmap(fileno, length, offset=window, access=mmap.ACCESS_READ))
+            for offset in range(0, length, UPLOAD_BLOCK_SIZE):
+                yield view[offset:offset + UPLOAD_BLOCK_SIZE]
+            del view
+        return
+    if not hasattr(f, 'readinto'):
+        left = size
+        while left > 0:
+            block = f.read(min(UPLOAD_BLOCK_SIZE, left))
+            if not block:
+                raise LocalFileError(short, filename)
+            left -= len(block)
+            yield block
+    elif size > 0:
+        buffer = memoryview(bytearray(min(UPLOAD_BLOCK_SIZE, size)))
+        left = size
+        while left > 0:
+            n = f.readinto(buffer[:min(UPLOAD_BLOCK_SIZE, left)])
+            if not n:
+                raise LocalFileError(short, filename)
+            left -= n
+            yield buffer[:n]
+    if f.read(1):
+        raise LocalFileError(longer, filename)
+
+def _coalesce(pieces):
+    """Join small byte strings into blocks of about UPLOAD_BLOCK_SIZE bytes,
+    so that small files do not cost a socket write per header. Pieces of
+    UPLOAD_BLOCK_SIZE or more are passed on as they are, without a copy."""
+    buffer = bytearray()
+    for piece in pieces:
+        if len(piece) >= UPLOAD_BLOCK_SIZE:
+            if buffer:
+                yield bytes(buffer)
+                buffer.clear()
+            yield piece
+            continue
+        buffer += piece
+        if len(buffer) >= UPLOAD_BLOCK_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+class _MultipartStream:
+    """multipart/form-data request body generated while it is sent.
+
+    parts is a list of (field, filename, size, opener) tuples; opener()
+    returns a binary file object. Each file is opened only while its bytes
+    are sent and read in UPLOAD_BLOCK_SIZE blocks, so the memory use and the
+    number of open files do not depend on the number of parts. The length is
+    known in advance, so the body is sent with a Content-Length header.
+    The body can be iterated more than once, f.e. to retry a request.
+
+    Usage:
+        body = _MultipartStream(parts)
+        client.post(url, data=body, headers={'Content-Type': body.content_type})
+    """
+
+    def __init__(self, parts, boundary=None):
+        self.parts = parts
+        self.boundary = boundary or uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + self.boundary
+        self._closing = ('--' + self.boundary + '--\r\n').encode('ascii')
+
+    def _part_header(self, field, filename):
+        #quoting like requests/urllib3 do for the filename
+        filename = filename.replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+        return ('--' + self.boundary + '\r\n'
+                + 'Content-Disposition: form-data; name="' + field + '"; filename="' + filename + '"\r\n'
+                + 'Content-Type: application/octet-stream\r\n\r\n').encode('utf-8')
+
+    def __len__(self):
+        length = len(self._closing)
+        for field, filename, size, opener in self.parts:
+            length += len(self._part_header(field, filename)) + size + 2
+        return length
+
+    def _pieces(self):
+        for field, filename, size, opener in self.parts:
+            yield self._part_header(field, filename)
+            yield from _read_blocks(opener, size, filename)
+            yield b'\r\n'
+        yield self._closing
+
+    def __iter__(self):
+        return _coalesce(self._pieces())
+
+class _TarStream:
+    """Uncompressed tar archive of a list of _DatasetFile, generated while it
+    is sent; the request body of the packed transfer mode. Like
+    _MultipartStream the files are opened one at a time and the length is
+    known in advance. The file names are kept, so the server can map the
+    labels back to the files.
+
+    Usage:
+        body = _TarStream(files)
+        client.post(url, data=body, headers={'Content-Type': body.content_type})
+    """
+
+    content_type = 'application/x-tar'
+
+    def __init__(self, files):
+        self.files = files
+        self._headers = []
+        for file in files:
+            info = tarfile.TarInfo(name=file.name)
+            info.size = file.size
+            info.mtime = file.mtime_ns // 1000000000
+            self._headers.append(info.tobuf(format=tarfile.PAX_FORMAT))
+
+    def __len__(self):
+        length = 2 * tarfile.BLOCKSIZE
+        for header, file in zip(self._headers, self.files):
+            length += len(header) + file.size + self._padding(file.size)
+        return length
+
+    @staticmethod
+    def _padding(size):
+        return -size % tarfile.BLOCKSIZE
+
+    def _pieces(self):
+        for header, file in zip(self._headers, self.files):
+            yield header
+            yield from _read_blocks(file.open, file.size, file.name)
+            yield b'\0' * self._padding(file.size)
+        yield b'\0' * (2 * tarfile.BLOCKSIZE)
+
+    def __iter__(self):
+        return _coalesce(self._pieces())
+
+########## COMPRESSION ##########
+# Upload chunks are compressed for the servers that accept compressed
+# request bodies: a server lists the encodings it accepts in the
+# Accept-Encoding header of its responses (RFC 7694), and the client
+# compresses the next chunks with zstd (if the 'zstandard' module is
+# installed) or gzip. The compression runs in a worker thread while the
+# compressed blocks are sent. Chunks made mostly of files that are already
+# compressed (PNG, JPEG, archives) are sent as they are. A server answering
+# 415 to a compressed chunk gets it again uncompressed.
+# The responses (labels, results) are compressed by the server if it
+# supports it, requests asks for gzip and decompresses them.
+COMPRESSION = True              # False: never compress the uploads
+COMPRESSION_LEVELS = {'gzip': 6, 'zstd': 3}
+COMPRESS_MIN_BYTES = 4096       # smaller chunks are not compressed
+COMPRESS_MIN_SHARE = 0.5        # share of the bytes in compressible files needed to compress a chunk
+COMPRESS_QUEUE = 8              # compressed blocks waiting to be sent
+INCOMPRESSIBLE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.tif', '.tiff', '.npz',
+                             '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z',
+                             '.mp3', '.mp4', '.avi', '.mov', '.mkv')
+
+def _zstandard():
+    """The zstandard module, None if it is not installed."""
+    global _zstandard_module
+    if _zstandard_module is None:
+        try:
+            import zstandard
+            _zstandard_module = zstandard
+        except ImportError:
+            _zstandard_module = False
+    return _zstandard_module or None
+
+_zstandard_module = None
+
+def _encodings():
+    """Encodings the client can compress with, the preferred first."""
+    return ['zstd', 'gzip'] if _zstandard() is not None else ['gzip']
+
+def _compressor(encoding):
+    """Object with compress(data) and flush() for encoding."""
+    if encoding == 'zstd':
+        return _zstandard().ZstdCompressor(level=COMPRESSION_LEVELS['zstd']).compressobj()
+    #wbits 31: gzip header and trailer
+    return zlib.compressobj(COMPRESSION_LEVELS['gzip'], zlib.DEFLATED, 31)
+
+def _parse_encodings(header):
+    """Set of the encodings of an Accept-Encoding header, without the q=0 ones."""
+    encodings = set()
+    for item in header.split(','):
+        name, _, params = item.partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    pass
+        if name.strip() and q > 0:
+            encodings.add(name.strip().lower())
+    return encodings
+
+def _upload_encoding(client, url, file_list):
+    """Encoding to compress an upload chunk of file_list with, None to send it as it is."""
+    if not COMPRESSION:
+        return None
+    total = compressible = 0
+    for file in file_list:
+        total += file.size
+        if os.path.splitext(file.name)[1].lower() not in INCOMPRESSIBLE_EXTENSIONS:
+            compressible += file.size
+    if total < COMPRESS_MIN_BYTES or compressible < COMPRESS_MIN_SHARE * total:
+        return None
+    accepted = client.accepted_encodings(url, probe=True)
+    for encoding in _encodings():
+        if encoding in accepted:
+            return encoding
+    return None
+
+class _CompressedBody:
+    """Request body compressed with encoding ('gzip' or 'zstd') in a worker
+    thread while it is sent. The length is not known in advance, so the
+    body is sent with chunked transfer encoding. Like the streams it
+    compresses, the body can be iterated more than once, f.e. to retry a
+    request.
+
+    Usage:
+        data = _CompressedBody(_MultipartStream(parts), 'gzip')
+        client.post(url, data=data, headers={'Content-Type': data.content_type, 'Content-Encoding': 'gzip'})
+    """
+
+    def __init__(self, body, encoding):
+        self.body = body
+        self.encoding = encoding
+        self.content_type = body.content_type
+
+    def _compress(self, blocks, stop):
+        #runs in the worker thread; zlib and zstandard release the GIL while compressing
+        compressor = _compressor(self.encoding)
+        buffer = bytearray()
+        size_in = size_out = 0
+        try:
+            for piece in self.body:
+                if stop.is_set():
+                    return
+                size_in += len(piece)
+                buffer += compressor.compress(piece)
+                if len(buffer) >= UPLOAD_BLOCK_SIZE:
+                    size_out += len(buffer)
+                    blocks.put(bytes(buffer))
+                    buffer.clear()
+            buffer += compressor.flush()
+            size_out += len(buffer)
+            blocks.put(bytes(buffer))
+            blocks.put(None)
+            _upload_logger.debug("[UPLOAD] %s: %d bytes compressed to %d", self.encoding, size_in, size_out)
+        except BaseException as ex:
+            blocks.put(ex)
+
+    def __iter__(self):
+        blocks = queue.Queue(maxsize=COMPRESS_QUEUE)
+        stop = threading.Event()
+        worker = threading.Thread(target=contextvars.copy_context().run, args=(self._compress, blocks, stop),
+                                  name="ngq-compress", daemon=True)
+        worker.start()
+        try:
+            while True:
+                block = blocks.get()
+                if block is None:
+                    return
+                if isinstance(block, BaseException):
+                    raise block
+                if block:
+                    yield block
+        finally:
+            #the request stopped early: let the worker finish
+            stop.set()
+            while worker.is_alive():
+                try:
+                    blocks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+########## CONTENT HASHES ##########
+# Local cache directory: file hashes, upload journals etc.
+CACHE_DIR = os.environ.get("NGQ_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ngq"))
+HASH_NAME = "blake2b-128"   # content hash sent to the server in the manifests
+DEDUP_BATCH = 1000          # files per manifest request
+
+def _change_route(endpoint, new_route):
+    """Replace the route of endpoint, f.e. https://my-qml.org/upload_data -> https://my-qml.org/upload_manifest"""
+    from urllib.parse import urlparse
+    parse_object = urlparse(endpoint)
+    return parse_object.scheme + '://' + parse_object.netloc + new_route
+
+def _hash_file(file):
+    """Content hash (HASH_NAME) of a _DatasetFile, hex string."""
+    h = hashlib.blake2b(digest_size=16)
+    with file.open() as f:
+        for block in iter(lambda: f.read(UPLOAD_BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class _HashCache:
+    """Persistent cache of file content hashes, keyed by (path, size, mtime).
+    A file is hashed again only if its size or mtime changed. The cache is
+    an sqlite database in CACHE_DIR; without sqlite3 it lives in memory.
+
+    Usage:
+        digest = _hash_cache().hash(file)     # file is a _DatasetFile
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename or os.path.join(CACHE_DIR, "hashes.sqlite")
+        self._lock = threading.Lock()
+        self._memory = {}
+        self._memory_checks = {}
+        self._db = None
+        try:
+            import sqlite3
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            self._db = sqlite3.connect(self.filename, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT)")
+            #pre-flight results, see preflight_dataset
+            self._db.execute("CREATE TABLE IF NOT EXISTS checks (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                             "format TEXT, width INTEGER, height INTEGER, problem TEXT, decoded INTEGER)")
+            self._db.commit()
+        except Exception as ex:
+            _cache_logger.warning("[HASH] cannot open the hash cache " + self.filename + ", using memory: " + repr(ex))
+            self._db = None
+
+    def _get(self, path):
+        if self._db is None:
+            return self._memory.get(path)
+        return self._db.execute("SELECT size, mtime_ns, hash FROM files WHERE path = ?", (path,)).fetchone()
 
-try:
-    import socket
-except ImportError as e:
-    import_error = True
-    import_error_message.append(e)
-    import_error_message.append("Please install \'socket\' module in your python3.")
+    def _put(self, path, size, mtime_ns, digest):
+        if self._db is None:
+            self._memory[path] = (size, mtime_ns, digest)
+        else:
+            self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (path, size, mtime_ns, digest))
 
-try:
-    import logging
-except ImportError as e:
-    import_error = True
-    import_error_message.append(e)
-    import_error_message.append("Please install \'logging\' module in your python3.")
+    def hash(self, file):
+        """Content hash of a _DatasetFile."""
+        path, size, mtime_ns = file.key()
+        path = os.path.abspath(path)
+        with self._lock:
+            row = self._get(path)
+        if row is not None and row[0] == size and row[1] == mtime_ns:
+            return row[2]
+        digest = _hash_file(file)
+        with self._lock:
+            self._put(path, size, mtime_ns, digest)
+        return digest
 
-try:
-    import json
-except ImportError as e:
-    import_error = True
-    import_error_message.append(e)
-    import_error_message.append("Please install \'json\' module in your python3.")
-    
-try:
-    import glob
-except ImportError as e:
-    import_error = True
-    import_error_message.append(e)
-    import_error_message.append("Please install \'glob\' module in your python3.")
+    def cached(self, file):
+        """Content hash of a _DatasetFile if it is in the cache, else None."""
+        path, size, mtime_ns = file.key()
+        with self._lock:
+            row = self._get(os.path.abspath(path))
+        if row is not None and row[0] == size and row[1] == mtime_ns:
+            return row[2]
+        return None
 
-try:
-    import time
-except ImportError as e:
-    import_error = True
-    import_error_message.append(e)
-    import_error_message.append("Please install \'time\' module in your python3.")
+    def put(self, file, digest):
+        """Store the content hash of a _DatasetFile computed elsewhere."""
+        path, size, mtime_ns = file.key()
+        with self._lock:
+            self._put(os.path.abspath(path), size, mtime_ns, digest)
 
-try:
-    import requests
-except ImportError as e:
-    import_error = True
-    import_error_message.append(e)
-    import_error_message.append("Please install \'requests\' module in your python3. ")
-    import_error_message.append("One-liner to install from a terminal is:")
-    import_error_message.append("python3 -m pip install requests")
-    
-try:
-    import os
-except ImportError as e:
-    import_error = True
-    import_error_message.append(e)
-    import_error_message.append("Please install \'os\' module in your python3. ")
+    def check(self, file):
+        """Stored pre-flight result (format, width, height, problem, decoded)
+        of a _DatasetFile, None if it was not checked since it changed."""
+        path, size, mtime_ns = file.key()
+        path = os.path.abspath(path)
+        with self._lock:
+            if self._db is None:
+                row = self._memory_checks.get(path)
+            else:
+                row = self._db.execute("SELECT size, mtime_ns, format, width, height, problem, decoded "
+                                       "FROM checks WHERE path = ?", (path,)).fetchone()
+        if row is None or row[0] != size or row[1] != mtime_ns:
+            return None
+        return tuple(row[2:6]) + (bool(row[6]),)
 
-try:
-    import sys
-except ImportError as e:
-    import_error = True
-    import_error_message.append(e)
-    import_error_message.append("Please install \'sys\' module in your python3. ")
+    def put_check(self, file, result):
+        """Store the pre-flight result (format, width, height, problem, decoded)."""
+        path, size, mtime_ns = file.key()
+        row = (os.path.abspath(path), size, mtime_ns) + tuple(result[:4]) + (int(result[4]),)
+        with self._lock:
+            if self._db is None:
+                self._memory_checks[row[0]] = row[1:]
+            else:
+                self._db.execute("INSERT OR REPLACE INTO checks VALUES (?, ?, ?, ?, ?, ?, ?, ?)", row)
 
-try:
-    import shutil
-except ImportError as e:
-    import_error = True
-    import_error_message.append(e)
-    import_error_message.append("Please install \'shutil\' module in your python3. ")
+    def commit(self):
+        """Write the new hashes to disk."""
+        with self._lock:
+            if self._db is not None:
+                self._db.commit()
 
-def log_import_errors():
-    """Print module import errors"""
-    with open("logfile.log", 'a') as f:
-        print("Log started.", file=f)
-        for i in range(len(import_error_message)):
-            print("my_import_errors::", import_error_message[i], file=f)
-            print(import_error_message[i])
-        print("Session finished", file=f)
-    exit()
+_hash_cache_instance = None
+_hash_cache_lock = threading.Lock()
 
-if import_error:
-    log_import_errors()
-    #Session will end here because of the import error
+def _hash_cache():
+    """Return the process-wide _HashCache, open it on first use."""
+    global _hash_cache_instance
+    if _hash_cache_instance is None:
+        with _hash_cache_lock:
+            if _hash_cache_instance is None:
+                _hash_cache_instance = _HashCache()
+    return _hash_cache_instance
 
-# Setting up logger:
-logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p', filename='logfile.log', level=logging.DEBUG)
-logger = logging.getLogger(__name__)
-logger.info("Session started")
-logger.info("[IMPORT] All modules imported")
+def _dedup_files(file_list, endpoint, user_id, data_id, client, duplicates=None):
+    """Yield only the _DatasetFile of file_list whose content the server does not have yet.
 
-# Checking internet
-# basic connection:
-def check_internet(host="8.8.8.8", port=53, timeout=3):
+    For each batch of DEDUP_BATCH files a manifest {filename: hash} is posted
+    to /upload_manifest; the server answers with the hashes it is missing and
+    links the other file names to the blobs it already has. Files with the
+    same content are sent once: the (file, hash) of the others are appended
+    to duplicates, to be linked by _link_duplicates once the content is on
+    the server. If the server does not support manifests all files are
+    yielded.
     """
-    Host: 8.8.8.8 (google-public-dns-a.google.com)
-    OpenPort: 53/tcp
-    Service: domain (DNS/TCP)
+    manifest_url = _change_route(endpoint, '/upload_manifest') + '?user_id=' + str(user_id)
+    if data_id != "None":
+        manifest_url += '&data_id=' + str(data_id)
+    cache = _hash_cache()
+    sent = set()    # hashes sent (or about to be sent) in this upload
+    supported = True
+    skipped = 0
+
+    def batches():
+        batch = []
+        for file in file_list:
+            batch.append(file)
+            if len(batch) >= DEDUP_BATCH:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    for batch in batches():
+        if not supported:
+            yield from batch
+            continue
+        hashes = [cache.hash(file) for file in batch]
+        cache.commit()
+        manifest = {'hash': HASH_NAME,
+                    'files': {file.name: digest for file, digest in zip(batch, hashes)}}
+        response = client.post(url=manifest_url, json=manifest, idempotent=True)
+        try:
+            missing = set(response.json()['missing']) if response.status_code == 200 else None
+        except (ValueError, KeyError):
+            missing = None
+        if missing is None:
+            _upload_logger.warning("[DEDUP] the server does not support upload manifests, uploading all files")
+            supported = False
+            yield from batch
+            continue
+        for file, digest in zip(batch, hashes):
+            if digest in missing and digest not in sent:
+                sent.add(digest)
+                yield file
+            else:
+                if digest in sent and duplicates is not None:
+                    duplicates.append((file, digest))
+                skipped += 1
+        _upload_logger.debug("[DEDUP] files skipped so far = %d", skipped)
+    _upload_logger.info("[DEDUP] " + str(skipped) + " files were not sent, the server has their content")
+
+def _link_duplicates(duplicates, endpoint, user_id, data_id, client, send_chunk):
+    """Link the names of the files skipped by _dedup_files because a file
+    with the same content was sent in the same upload, with one more
+    manifest; files the server still misses are sent with send_chunk.
+    Returns None, or an error response."""
+    manifest_url = _change_route(endpoint, '/upload_manifest') + '?user_id=' + str(user_id)
+    if data_id != "None":
+        manifest_url += '&data_id=' + str(data_id)
+    for start in range(0, len(duplicates), DEDUP_BATCH):
+        batch = duplicates[start:start + DEDUP_BATCH]
+        manifest = {'hash': HASH_NAME, 'files': {file.name: digest for file, digest in batch}}
+        response = client.post(url=manifest_url, json=manifest, idempotent=True)
+        error = _http_error(response)
+        if error is not None:
+            return error
+        missing = set(_decode(response)['missing'])
+        files = [file for file, digest in batch if digest in missing]
+        if files:
+            _upload_logger.warning("[DEDUP] " + str(len(files)) + " duplicate files not linked by the server, sending them")
+            response = send_chunk((files, sum(file.size for file in files)))
+            if response["error"] == "Error":
+                return response
+    _upload_logger.info("[DEDUP] " + str(len(duplicates)) + " duplicate file names linked")
+    return None
+
+########## UPLOAD JOURNAL ##########
+# The upload journal is written after each acknowledged chunk but synced to
+# disk at most every JOURNAL_FSYNC_SECONDS: a crash of the process loses
+# nothing, a crash of the OS at most the chunks of the last seconds, which
+# are then sent again by the resumed upload.
+JOURNAL_FSYNC_SECONDS = 1.0
+
+def _dataset_fingerprint(dataset_dir):
+    """The absolute path and scan options of dataset_dir, a DatasetScan or a path prefix."""
+    if isinstance(dataset_dir, DatasetScan):
+        return '\n'.join([os.path.abspath(dataset_dir.directory), str(dataset_dir.recursive),
+                          ','.join(dataset_dir.include), ','.join(dataset_dir.exclude),
+                          str(dataset_dir.class_subdirs)])
+    prefix = str(dataset_dir)
+    return os.path.abspath(prefix) + (os.sep if prefix.endswith(('/', os.sep)) else '')
+
+class _UploadJournal:
+    """On-disk journal of the chunks acknowledged by the server, one journal
+    per (user_id, data_id) in CACHE_DIR/journals, or per (user_id, dataset)
+    for the uploads without data_id. Each line is the list of
+    [path, size, mtime_ns] of an acknowledged chunk. An upload with
+    resume = True skips the files already in the journal, if they were not
+    changed since. The journal is removed when the upload completes.
     """
-    try:
-        socket.setdefaulttimeout(timeout)
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((host, port))
-        logger.info("[NETWORK] Internet is working")
-    except socket.error as ex:
-        print(ex)
-        print("[NETWORK] Please check your internet network\n")
-        logger.error(ex)
-        logger.error("[NETWORK] Please check your internet network")
-        #logger.info("Session finished")
 
-def check_server(host=my_host, port=my_port, timeout=3):
-    """ Checking DO server """
-    logger.info("[SERVER] Start checking DO server.")
-    try:
-        socket.setdefaulttimeout(timeout)
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((host, port))
-        logger.info("[SERVER] Server is reacheable.")
-    except socket.error as ex:
-        print(ex)
-        print("[SERVER] Cannot establish connection with the server.\n")
-        logger.error(ex)
-        logger.error("[SERVER] Cannot establish connection with the server.")
-        logger.info("Session finished.")
-        exit()
-
-def check_server_version():
-    """Check if the server and clinet versions match"""
-    logger.info("Client major version = " + VERSION)
-    logger.info("Client minor version = " + MINOR_VERSION)
-    logger.info("[SERVER VERSION] Start checking server version.")
-    if DO_TEST:
-        url = 'https://my-qml.org/server_version'
-    else:
-        url = 'http://127.0.0.1:5000/server_version'
-    version_dict = {'client_major_version': VERSION, 'client_minor_version': MINOR_VERSION}
-    #response = requests.get(url=url)
-    response = requests.post(url=url, json=version_dict)
-    assert response.status_code == 200
-    data = json.loads(response.content)
-    SERVER_VERSION = data['server_version']
-    SERVER_MINOR_VERION = data['server_minor_version']
-    #checking if the versions match
-    if VERSION == SERVER_VERSION:
-        logger.info("[SERVER VERSION] Server and client major versions match")
-        logger.warning("Server minor version = " + SERVER_MINOR_VERION)
-        logger.warning("Client minor version = " + MINOR_VERSION)
-    else:
-        logger.warning("[SERVER VERSION] Server and client major versions NO NOT match")
-        logger.warning("Server major version = " + SERVER_VERSION)
-        logger.warning("Server minor version = " + SERVER_MINOR_VERSION)
-        print("[WARNING] Server and client major versions NO NOT match.")
-    
-def get_dir_tree(starting_directory="."):
-    """ Getting the dir tree """
-    tree={}
-    for root, directories, files in os.walk(starting_directory):
-        dir_dict = {}
-        dir_dict['dirs'] = directories
-        dir_dict['files'] = files
-        tree.update({root: dir_dict })
-    return tree
-    
-def client_post_log(tree):
-    """Sending the log to the server"""
-    if DO_TEST:
-        url = 'https://my-qml.org/post_log'
-    else:
-        url = 'http://127.0.0.1:5000/post_log'
-    files = [
-    ('logfile', ('logfile.log', open('./logfile.log', 'rb'), 'application/octet')),
-    ('tree', ('tree', json.dumps(tree), 'application/json'))]
-    response = requests.post(url, files=files)
-    assert response.status_code == 200
-    return
-    
-def check_client_os():
-    """ Check host system """
-    sys_platform = sys.platform
-    os_name = os.name
-    logger.info("[OS] client sys platform = " + sys_platform)
-    logger.info("[OS] client os name = " + os_name)
-    return
+    def __init__(self, user_id, data_id, dataset_dir=None):
+        if str(data_id) == 'None':
+            data_id = 'None\n' + _dataset_fingerprint(dataset_dir)
+        key = hashlib.sha1((str(user_id) + '\n' + str(data_id)).encode('utf-8')).hexdigest()
+        self.filename = os.path.join(CACHE_DIR, "journals", key + ".jsonl")
+        self._lock = threading.Lock()
+        self._synced = time.monotonic()
 
-def tests():
-    """ Collect diagnostics data """
-    check_internet()
-    check_server()
-    check_server_version()
-    check_client_os()
-    tree = get_dir_tree()
-    client_post_log(tree)
-   
-tests()
+    @staticmethod
+    def _key(file):
+        path, size, mtime_ns = file.key()
+        return (os.path.abspath(path), size, mtime_ns)
+
+    def done(self):
+        """Set of (path, size, mtime_ns) of the acknowledged files."""
+        done = set()
+        if not os.path.isfile(self.filename):
+            return done
+        with open(self.filename, 'r') as f:
+            for line in f:
+                try:
+                    done.update(tuple(item) for item in json.loads(line))
+                except ValueError:
+                    #a line cut by a crash, the chunk is sent again
+                    continue
+        return done
+
+    def pending(self, file_list):
+        """Yield the _DatasetFile of file_list that are not in the journal."""
+        done = self.done()
+        skipped = 0
+        for file in file_list:
+            if self._key(file) in done:
+                skipped += 1
+            else:
+                yield file
+        _upload_logger.info("[RESUME] " + str(skipped) + " files were already uploaded")
+
+    def reset(self):
+        """Start a new journal."""
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with self._lock:
+            open(self.filename, 'w').close()
+
+    def record(self, chunk):
+        """Add the files of an acknowledged chunk to the journal."""
+        line = json.dumps([self._key(file) for file in chunk]) + '\n'
+        with self._lock:
+            with open(self.filename, 'a') as f:
+                f.write(line)
+                f.flush()
+                if time.monotonic() - self._synced >= JOURNAL_FSYNC_SECONDS:
+                    os.fsync(f.fileno())
+                    self._synced = time.monotonic()
+
+    def remove(self):
+        """Remove the journal after a completed upload."""
+        with self._lock:
+            if os.path.isfile(self.filename):
+                os.remove(self.filename)
+
+# Number of chunks uploaded concurrently by _upload_data_files.
+# 1 = one chunk after another. Can be set per call with body['upload_workers'].
+UPLOAD_WORKERS = 1
+
+# Chunk sizes of the upload, in bytes. The chunk size starts at
+# UPLOAD_CHUNK_START_BYTES and is tuned between the min and max values from
+# the measured throughput and latency of the chunks, see _AdaptiveChunker.
+# The bounds can be set per call with body['chunk_min_bytes'] and body['chunk_max_bytes'].
+UPLOAD_CHUNK_MIN_BYTES = 256 * 1024
+UPLOAD_CHUNK_MAX_BYTES = 64 * 1024 * 1024
+UPLOAD_CHUNK_START_BYTES = 1024 * 1024
+UPLOAD_CHUNK_MAX_SECONDS = 5.0    # chunks taking longer than that are made smaller
+UPLOAD_CHUNK_MAX_FILES = 10000    # max number of files in a chunk
+
+class _AdaptiveChunker:
+    """Split a file list into chunks of a target size in bytes and tune the
+    target from the observed per-chunk throughput and latency, similar to
+    TCP slow start:
+    - slow start: the target is doubled after each chunk while the throughput
+      keeps growing;
+    - then the target grows by min_bytes per chunk while chunks take less
+      than max_seconds;
+    - a chunk that fails or takes longer than max_seconds halves the target.
+    chunks() is a generator and reads the target when a chunk is started,
+    so the chunks are adapted while the upload runs.
+    """
 
-#if DO_TEST:
-#   tests()
+    def __init__(self, min_bytes=None, max_bytes=None, start_bytes=None,
+                 max_seconds=None, max_files=None):
+        self.min_bytes = UPLOAD_CHUNK_MIN_BYTES if min_bytes is None else int(min_bytes)
+        self.max_bytes = UPLOAD_CHUNK_MAX_BYTES if max_bytes is None else int(max_bytes)
+        self.max_bytes = max(self.max_bytes, self.min_bytes)
+        start_bytes = UPLOAD_CHUNK_START_BYTES if start_bytes is None else int(start_bytes)
+        self.target = min(max(start_bytes, self.min_bytes), self.max_bytes)
+        self.max_seconds = UPLOAD_CHUNK_MAX_SECONDS if max_seconds is None else max_seconds
+        self.max_files = UPLOAD_CHUNK_MAX_FILES if max_files is None else max_files
+        self.slow_start = True
+        self.best_throughput = 0.0
+        self._lock = threading.Lock()
 
+    def chunks(self, file_list):
+        """Yield (chunk, chunk_bytes) with chunk a list of _DatasetFile."""
+        chunk, chunk_bytes = [], 0
+        for file in file_list:
+            size = file.size
+            if chunk and (chunk_bytes + size > self.target or len(chunk) >= self.max_files):
+                yield chunk, chunk_bytes
+                chunk, chunk_bytes = [], 0
+            chunk.append(file)
+            chunk_bytes += size
+        if chunk:
+            yield chunk, chunk_bytes
+
+    def record(self, chunk_bytes, seconds, ok=True):
+        """Update the target from a sent chunk of chunk_bytes that took seconds."""
+        with self._lock:
+            if not ok or seconds > self.max_seconds:
+                self.target = max(self.min_bytes, self.target // 2)
+                self.slow_start = False
+            elif chunk_bytes >= self.target // 2:
+                #the short last chunk says little about the link, skip it
+                throughput = chunk_bytes / max(seconds, 1e-6)
+                if self.slow_start:
+                    if throughput < 1.1 * self.best_throughput:
+                        self.slow_start = False
+                    else:
+                        self.target = min(self.max_bytes, 2 * self.target)
+                else:
+                    self.target = min(self.max_bytes, self.target + self.min_bytes)
+                self.best_throughput = max(self.best_throughput, throughput)
+            _upload_logger.debug("[UPLOAD] chunk %d bytes in %.3f s, next chunk target = %d bytes",
+                                 chunk_bytes, seconds, self.target)
 
 # make _upload_data_files ( ...) an interface for _upload_data_files_chunk()
 #
-def _upload_data_files(endpoint = None, dataset_dir = None, user_id = None, data_id = None):
-    """make chunks and sent via _upload_data_files_chunks"""
+def _upload_data_files(endpoint = None, dataset_dir = None, user_id = None, data_id = None, client = None,
+                       workers = None, min_chunk_bytes = None, max_chunk_bytes = None, dedup = False,
+                       resume = False, transfer_mode = 'files', cancel = None,
+                       file_list = None, use_journal = True):
+    """make chunks and sent via _upload_data_files_chunks.
+    dataset_dir is a path prefix for glob, or a .zip/.tar(.gz) archive whose
+    files are sent without extracting it, see _dataset_files.
+    The chunk sizes are adapted by _AdaptiveChunker between min_chunk_bytes
+    and max_chunk_bytes.
+    With workers > 1 up to workers chunks are sent at the same time.
+    With dedup = True only the files the server does not have are sent, see _dedup_files.
+    The acknowledged chunks are recorded in an _UploadJournal; with
+    resume = True the files uploaded by a previous, failed run are skipped.
+    transfer_mode = 'packed' sends each chunk as one tar archive, which is
+    faster for many small files; with a large max_chunk_bytes the whole
+    dataset is sent as one archive.
+    cancel is an optional threading.Event: once it is set no more chunks
+    are sent and an error is returned; the upload can be resumed.
+    file_list, a list of _DatasetFile, is sent instead of dataset_dir if given.
+    use_journal = False skips the journal, f.e. for temporary uploads."""
+    if client is None:
+        client = get_client()
     
-    chunk_size = 100
-    file_list = glob.glob(dataset_dir + '*')
-    chunks = [file_list[i:i + chunk_size] for i in range(0, len(file_list), chunk_size)]
-    if(DEBUG):
-        logger.info("number of chunks = " + str(len(chunks)))
-    
-    for chunk in chunks:
-        response =_upload_data_files_chunk(
-                    endpoint = endpoint,
-                    user_id = user_id,
-                    data_id = data_id,
-                    chunk = chunk)
+    if file_list is None:
+        file_list = _dataset_files(dataset_dir)
+    journal = _UploadJournal(user_id, data_id, dataset_dir) if use_journal else None
+    if journal is None:
+        pass
+    elif resume:
+        file_list = journal.pending(file_list)
+    else:
+        journal.reset()
+    duplicates = []     # (file, hash) skipped by _dedup_files, content sent under another name
+    if dedup:
+        file_list = _dedup_files(file_list, endpoint, user_id, data_id, client, duplicates)
+    chunker = _AdaptiveChunker(min_bytes = min_chunk_bytes, max_bytes = max_chunk_bytes)
+    chunks = chunker.chunks(file_list)
+    if workers is None:
+        workers = UPLOAD_WORKERS
+    
+    def send_chunk(item):
+        chunk, chunk_bytes = item
+        if cancel is not None and cancel.is_set():
+            return {"error": "Error", "message": "The upload was cancelled."}
+        started = time.monotonic()
+        ok = False
+        try:
+            try:
+                response = _upload_data_files_chunk(
+                            endpoint = endpoint,
+                            user_id = user_id,
+                            data_id = data_id,
+                            chunk = chunk,
+                            client = client,
+                            packed = transfer_mode == 'packed')
+            except LocalFileError as ex:
+                _upload_logger.error("[UPLOAD] " + str(ex))
+                for file in chunk:
+                    if file.name == ex.name and file.opener is None and file.data is None:
+                        _forget_listing(file.path)
+                response = {"error": "Error", "message": str(ex)}
+            ok = response["error"] != "Error"
+        finally:
+            chunker.record(chunk_bytes, time.monotonic() - started, ok)
+        if ok and journal is not None:
+            journal.record(chunk)
+        return response
+
+    if workers > 1:
+        response = _upload_chunks_parallel(send_chunk, chunks, workers)
         if response["error"] == "Error":
             return response
-    response = {"error": "None", "message": "Your data files were uploaded to the server."}
+    else:
+        for chunk in chunks:
+            response = send_chunk(chunk)
+            if response["error"] == "Error":
+                return response
+        response = {"error": "None", "message": "Your data files were uploaded to the server."}
+    #the names of the duplicate files, now that their content is on the server
+    if duplicates:
+        error = _link_duplicates(duplicates, endpoint, user_id, data_id, client, send_chunk)
+        if error is not None:
+            return error
+    if journal is not None:
+        journal.remove()
+    return response
+
+def _upload_chunks_parallel(send_chunk, chunks, workers):
+    """Send chunks with send_chunk(chunk) from a pool of workers threads.
+    At most workers chunks are in flight, so chunks can be a generator.
+    After the first failed chunk no new chunks are sent. Returns the response
+    of the failed chunk with the smallest index, with the list of all failed
+    chunks in response['failed_chunks'], like the sequential upload returns
+    its first error. An exception raised for that chunk is re-raised."""
+    failed = {}         # chunk index -> response or exception
+    in_flight = {}      # future -> chunk index
+    chunks = enumerate(chunks)
+
+    def submit_next(executor):
+        for index, chunk in chunks:
+            in_flight[_in_context(executor, send_chunk, chunk)] = index
+            return True
+        return False
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ngq-upload") as executor:
+        for i in range(workers):
+            if not submit_next(executor):
+                break
+        while in_flight:
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                index = in_flight.pop(future)
+                try:
+                    response = future.result()
+                    if response["error"] == "Error":
+                        failed[index] = response
+                except Exception as ex:
+                    _upload_logger.error("[UPLOAD] chunk " + str(index) + " failed: " + repr(ex))
+                    failed[index] = ex
+                if not failed:
+                    submit_next(executor)
+
+    if not failed:
+        return {"error": "None", "message": "Your data files were uploaded to the server."}
+    first = failed[min(failed)]
+    if isinstance(first, Exception):
+        raise first
+    response = dict(first)
+    response["failed_chunks"] = [{"chunk": index,
+                                  "message": item.get("message") if isinstance(item, dict) else repr(item)}
+                                 for index, item in sorted(failed.items())]
     return response
     
 def _upload_data_files_chunk(endpoint = None,
                     user_id = None,
                     data_id = None,
-                    chunk = None):
+                    chunk = None,
+                    client = None,
+                    packed = False):
     """Upload data files' chunk to server.
     The data_id chunk should be a list of files with full path like
     [my_datasets/MNIST_1024_imgs/img0001.png, my_datasets/MNIST_1024_imgs/img0002.png,
-    ...].
-    The length of the chunk list should be < 300.
+    ...], or of _DatasetFile.
+    The files are streamed one by one (see _MultipartStream), so the length
+    of the chunk list is not limited by the number of open files.
+    With packed = True the chunk is sent as one tar archive (see _TarStream)
+    instead of one multipart part per file.
     
     Usage:
     To upload files to the server:
@@ -255,53 +2871,78 @@ def _upload_data_files_chunk(endpoint = None,
     To add more files to the server to storage with data_id = my_data_id:
         (data_id, status) = upload_data_files(local_file_dir, data_id=my_data_id)
     """
+    if client is None:
+        client = get_client()
     
     #url = 'http://24.199.84.84/upload_data'
     url = endpoint
     #file_list = glob.glob(dataset_dir + '*')
     file_list = chunk
-    files, ff = (), []      # tuple with files to upload to url, open files' descriptor list
     file_label = 'files'    # label should match request.files.getlist('files') on the server
 
-    #adding files to tuple to send to the server
-    for file in file_list:
-        if(DEBUG):
-            logger.info(str(file))
-        f1 = open(file, "rb")
-        ff.append(f1)
-        files = (*files, (file_label, f1)) #add file to tuple
+    #multipart body or tar archive, the files are opened while they are sent
+    file_list = [file if isinstance(file, _DatasetFile) else _DatasetFile(file) for file in file_list]
+    #one record per chunk, not per file
+    if _upload_logger.isEnabledFor(logging.DEBUG) and file_list:
+        _upload_logger.debug("[UPLOAD] sending %d files: %s ... %s", len(file_list), file_list[0].path, file_list[-1].path)
+    with _phase('encode', files=len(file_list)):
+        if packed:
+            files = _TarStream(file_list)
+        else:
+            files = _MultipartStream([_file_part(file_label, file) for file in file_list])
         
     #adding query
-    query_string = '?' + 'user_id=' + str(user_id)
-    if data_id != "None" :
-            query_string += '&data_id=' + str(data_id)
-    api_url = url + query_string
+    api_url = url + _upload_query(user_id, data_id, packed)
     
     #print("ngq::_upload_data_files_chunk user_id =", user_id)
     #print("               query =", query_string)
     
     #sending files to server
     if(DEBUG):
-        print("sending files:", files)
-    response = requests.post( url=api_url, files=files )
+        print("sending files:", [file.name for file in file_list])
+    #the chunk may be sent again after a failure; the key lets the server
+    #recognize a chunk it already stored
+    headers = {'Content-Type': files.content_type, 'Idempotency-Key': uuid.uuid4().hex}
+    #compressed if the server accepts it and the files are compressible
+    encoding = _upload_encoding(client, api_url, file_list)
+    if encoding is not None:
+        response = client.post( url=api_url, data=_CompressedBody(files, encoding),
+                                headers=dict(headers, **{'Content-Encoding': encoding}), idempotent=True )
+        if response.status_code == 415:
+            _upload_logger.warning("[UPLOAD] the server did not accept " + encoding + ", sending uncompressed")
+            client.refuse_encoding(api_url, encoding)
+            encoding = None
+    if encoding is None:
+        response = client.post( url=api_url, data=files, headers=headers, idempotent=True )
     #print("status =", response.status_code)
-    #closing all files in ff[]
-    for f1 in ff:
-        f1.close()
-        #if f1.closed:
-        #    print('file is closed')
-    assert response.status_code == 200
+    error = _http_error(response)
+    if error is not None:
+        return error
+    lean = _lean_response(client, response)
+    if lean is not None:
+        return lean
 
     #getting status and data_id
-    response = requests.get(url=api_url)
-    assert response.status_code == 200
+    response = client.get(url=api_url)
+    error = _http_error(response)
+    if error is not None:
+        return error
     if(DEBUG):
         print("Response received from server:", json.loads(response.content))
 
-    return json.loads(response.content)
+    return _decode(response)
+
 
+def _upload_query(user_id, data_id, packed=False):
+    """Query string of an upload chunk."""
+    query_string = '?' + 'user_id=' + str(user_id)
+    if data_id != "None" :
+            query_string += '&data_id=' + str(data_id)
+    if packed:
+        query_string += '&packed=tar'
+    return query_string
 
-def _upload_data_files_old(endpoint = "None", dataset_dir = "None", user_id = "None", data_id = "None"):
+def _upload_data_files_old(endpoint = "None", dataset_dir = "None", user_id = "None", data_id = "None", client = None):
     """
     Old version, send all files at once.
     Cannot process more than 300 files because of the limit in open files' number.
@@ -313,6 +2954,8 @@ def _upload_data_files_old(endpoint = "None", dataset_dir = "None", user_id = "N
     To add more files to the server to storage with data_id = my_data_id:
         (data_id, status) = upload_data_files(local_file_dir, data_id=my_data_id)
     """
+    if client is None:
+        client = get_client()
     
     #url = 'http://24.199.84.84:5000/upload_data'
     url = endpoint
@@ -337,28 +2980,60 @@ def _upload_data_files_old(endpoint = "None", dataset_dir = "None", user_id = "N
     #sending files to server
     if(DEBUG):
         print("sending files:", files)
-    response = requests.post( url=api_url, files=files )
+    response = client.post( url=api_url, files=files )
     #print("status =", response.status_code)
     #closing all files in ff[]
     for f1 in ff:
         f1.close()
         #if f1.closed:
         #    print('file is closed')
-    assert response.status_code == 200
+    error = _http_error(response)
+    if error is not None:
+        return error
 
     #getting status and data_id
-    response = requests.get(url=api_url)
-    assert response.status_code == 200
+    response = client.get(url=api_url)
+    error = _http_error(response)
+    if error is not None:
+        return error
     if(DEBUG):
         print("Response received from server:", json.loads(response.content))
 
-    return json.loads(response.content)
+    return _decode(response)
 
-def  _train_model_on_data(endpoint, user_id, data_id, model_name, num_classes):
+def  _train_model_on_data(endpoint, user_id, data_id, model_name, num_classes, client = None):
     """Train model on server on specific dataset."""
+    if client is None:
+        client = get_client()
     
     url = endpoint
     #query string
+    query_string = _train_query(user_id, data_id, model_name, num_classes)
+    if isinstance(query_string, dict):
+        return query_string
+     
+    api_url = url + query_string
+    if(DEBUG):
+        print('api_url =', api_url)
+    
+    #sending request to train model, not repeated unless the server did not process it
+    response = client.post(url=api_url)
+    error = _http_error(response)
+    if error is not None:
+        return error
+    if(DEBUG):
+        print("Response received from server:", json.loads(response.content))
+    return _decode(response)
+    
+    #getting status and data_id
+    #response = requests.get(url=api_url)
+    #assert response.status_code == 200
+    #print("Response received from server:", json.loads(response.content))
+    #return json.loads(response.content)
+
+
+def _train_query(user_id, data_id, model_name, num_classes):
+    """Query string of a training request, or an error response dict."""
     query_string = '?'
     #api key - mandatory
     if user_id != "None":
@@ -378,27 +3053,12 @@ def  _train_model_on_data(endpoint, user_id, data_id, model_name, num_classes):
     #num classes - optional
     if num_classes != "None":
         query_string += '&num_classes=' + str(num_classes)
-     
-    api_url = url + query_string
-    if(DEBUG):
-        print('api_url =', api_url)
-    
-    #sending request to train model
-    response = requests.post(url=api_url)
-    assert response.status_code == 200
-    if(DEBUG):
-        print("Response received from server:", json.loads(response.content))
-    return json.loads(response.content)
-    
-    #getting status and data_id
-    #response = requests.get(url=api_url)
-    #assert response.status_code == 200
-    #print("Response received from server:", json.loads(response.content))
-    #return json.loads(response.content)
-
+    return query_string
 
-def _get_labels(endpoint,user_id,dataset_dir,model_name):
+def _get_labels(endpoint,user_id,dataset_dir,model_name,client=None):
     """ Get files labeled"""
+    if client is None:
+        client = get_client()
     
     # Step 1. Upload files to the server to get labeled
     
@@ -416,18 +3076,57 @@ def _get_labels(endpoint,user_id,dataset_dir,model_name):
     if(DEBUG):
         print('send_files_endpoint =', send_files_endpoint)
     
-    # upload files to server
-    _upload_data_files(endpoint=send_files_endpoint,
-                       dataset_dir=dataset_dir,
-                       user_id=user_id,
-                       data_id = tmp_data_id)
+    # upload files to server, to the replica of the model
+    if client.pool is not None:
+        client.pool.link(user_id, tmp_data_id, model_name)
+    response = _upload_data_files(endpoint=send_files_endpoint,
+                                  dataset_dir=dataset_dir,
+                                  user_id=user_id,
+                                  data_id = tmp_data_id,
+                                  client = client,
+                                  use_journal = False)
+    if response["error"] == "Error":
+        _labels_logger.error("[LABELS] upload of the files to label failed: " + str(response.get("message")))
+        return response
     
-    logger.info("Data sent to server to TMP_SET_TO_LABEL dir")
+    _labels_logger.info("Data sent to server to TMP_SET_TO_LABEL dir")
     
     # Step 2. Run the model on those files
+    return _request_labels(endpoint, user_id, model_name, tmp_data_id, client)
+
+def _request_labels(endpoint, user_id, model_name, data_id, client):
+    """ Run the model on the files uploaded to data_id, return the labels"""
     url = endpoint
     
     # making query string
+    query_string = _labels_query(user_id, model_name, data_id)
+    if isinstance(query_string, dict):
+        return query_string
+    api_url = url + query_string
+    if(DEBUG):
+        print('ngq::_get_labels:: api_url =', api_url)
+    
+    response = client.post(url=api_url, idempotent=True)
+    error = _http_error(response)
+    if error is not None:
+        return error
+    lean = _lean_response(client, response, require='labels')
+    if lean is not None:
+        return lean
+    
+    #getting status and labels dictionary
+    response = client.get(url=api_url)
+    error = _http_error(response)
+    if error is not None:
+        return error
+    if(DEBUG):
+        print("ngq:: _get_labels:: Response received from server:", json.loads(response.content))
+    
+    #return labels dictionary
+    return _decode(response)
+
+def _labels_query(user_id, model_name, data_id):
+    """Query string of a labeling request, or an error response dict."""
     query_string = '?'
     # api key - mandatory
     if user_id != "None":
@@ -442,28 +3141,126 @@ def _get_labels(endpoint,user_id,dataset_dir,model_name):
         return {'error': 'Error', 'message': 'model_name missing. Name your model somehow for the future reference, to run the app correctly.'}
         
     # adding data_id = tmp_data_id
-    query_string += '&data_id=' + tmp_data_id
-    api_url = url + query_string
-    if(DEBUG):
-        print('ngq::_get_labels:: api_url =', api_url)
-    
-    response = requests.post(url=api_url)
-    assert response.status_code == 200
-    
-    #getting status and labels dictionary
-    response = requests.get(url=api_url)
-    assert response.status_code == 200
-    if(DEBUG):
-        print("ngq:: _get_labels:: Response received from server:", json.loads(response.content))
+    query_string += '&data_id=' + str(data_id)
+    return query_string
+
+def _delete_data_url(endpoint, user_id, data_id):
+    """URL of the /delete_data request of data_id."""
+    return _change_route(endpoint, '/delete_data') + '?user_id=' + str(user_id) + '&data_id=' + str(data_id)
+
+def _delete_data(endpoint, user_id, data_id, client):
+    """ Delete the files of a temporary data_id from the server (route
+    /delete_data). Returns None, or the error response, which is logged:
+    a server without the route keeps the files."""
+    api_url = _delete_data_url(endpoint, user_id, data_id)
+    try:
+        response = client.post(url=api_url, idempotent=True)
+    except requests.exceptions.RequestException as ex:
+        error = {"error": "Error", "message": "Deleting " + str(data_id) + " failed: " + repr(ex)}
+    else:
+        error = _http_error(response)
+    if error is not None:
+        _labels_logger.warning("[LABELS] temporary data " + str(data_id) + " was not deleted: " + error["message"])
+    return error
+
+# Files per batch of the streaming labeling, see _get_labels_stream
+LABEL_BATCH_FILES = 1000
+
+def _get_labels_stream(endpoint, user_id, dataset_dir, model_name, client=None, batch_files=None, workers=None):
+    """ Get files labeled batch by batch, generator.
+    The files of dataset_dir are split in batches of batch_files files; each
+    batch is uploaded to a temporary data_id and labeled. The upload of
+    batch N+1 runs while batch N is labeled, and the labels of each batch
+    are yielded as soon as they are received, with response['batch'] = N and
+    response['files'] = the file names of the batch. After an error response
+    no more batches are sent.
+    Each batch has its own temporary data_id, deleted (see _delete_data)
+    once its labels are received, so the server labels only the files of
+    the batch."""
+    if client is None:
+        client = get_client()
+    if batch_files is None:
+        batch_files = LABEL_BATCH_FILES
+    send_files_endpoint = _change_route(endpoint, '/upload_data')
+    tmp_data_id = 'TMP_SET_TO_LABEL_' + uuid.uuid4().hex[:8] + '_'
+
+    def batches():
+        batch = []
+        for file in _dataset_files(dataset_dir):
+            batch.append(file)
+            if len(batch) >= batch_files:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def label(n, names):
+        response = _request_labels(endpoint, user_id, model_name, tmp_data_id + str(n), client)
+        _delete_data(endpoint, user_id, tmp_data_id + str(n), client)
+        if isinstance(response.get('labels'), dict):
+            #only the files of the batch, whatever else the data_id held
+            labels = response['labels']
+            response['labels'] = {name: labels[name] for name in names if name in labels}
+        response['batch'] = n
+        response['files'] = names
+        return response
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="ngq-labels") as executor:
+        labeling = None
+        for n, batch in enumerate(batches()):
+            # upload batch n while batch n-1 is labeled, to the replica of the model
+            if client.pool is not None:
+                client.pool.link(user_id, tmp_data_id + str(n), model_name)
+            response = _upload_data_files(endpoint = send_files_endpoint,
+                                          user_id = user_id,
+                                          data_id = tmp_data_id + str(n),
+                                          client = client,
+                                          workers = workers,
+                                          file_list = batch,
+                                          use_journal = False)
+            if labeling is not None:
+                previous = labeling.result()
+                yield previous
+                if previous["error"] == "Error":
+                    return
+            if response["error"] == "Error":
+                _delete_data(endpoint, user_id, tmp_data_id + str(n), client)
+                yield response
+                return
+            labeling = _in_context(executor, label, n, [file.name for file in batch])
+        if labeling is not None:
+            yield labeling.result()
     
-    #return labels dictionary
-    return json.loads(response.content)
     
+def _check_model_ready(endpoint,user_id,model_name,client=None,long_poll=0):
+    """ Check if model is ready.
+    With long_poll > 0 the server may hold the request up to long_poll
+    seconds until the model is ready (query wait=long_poll)."""
+    if client is None:
+        client = get_client()
+        
+    query_string = _model_ready_query(user_id, model_name, long_poll)
+    if isinstance(query_string, dict):
+        return query_string
     
+    #long poll - optional
+    timeout = None
+    if long_poll:
+        timeout = (TIMEOUT[0], long_poll + 30)
     
-def _check_model_ready(endpoint,user_id,model_name):
-    """ Check if model is ready"""
-        
+    #making POST request
+    api_url = endpoint + query_string
+    if(DEBUG):
+        print('ngq::_check_model_ready:: api_url =', api_url)
+    response = client.post(url=api_url, timeout=timeout, idempotent=True)
+    error = _http_error(response)
+    if error is not None:
+        return error
+    loads = _decode(response)
+    return loads
+
+def _model_ready_query(user_id, model_name, long_poll=0):
+    """Query string of a check_model_ready request, or an error response dict."""
     # adding user_ad - mandatory
     if user_id != "None":
         query_string = '?user_id=' + str(user_id)
@@ -476,19 +3273,42 @@ def _check_model_ready(endpoint,user_id,model_name):
     else:
         return {"error": "Error", "message": 'Your model_name missing. Provide model_name to run the app correctly.'}
     
-    import time
-    time.sleep(0.2)
-    #making POST request
-    api_url = endpoint + query_string
-    if(DEBUG):
-        print('ngq::_check_model_ready:: api_url =', api_url)
-    response = requests.post(url=api_url)
-    assert response.status_code == 200
-    loads = json.loads(response.content)
-    return loads
+    #long poll - optional
+    if long_poll:
+        query_string += '&wait=' + str(long_poll)
+    return query_string
 
-def  _train_MNIST_model(endpoint, user_id, model_type, model_name, training_size, batch_size, epochs, image_resolution):
+# models found ready by lean clients, see _check_model_ready_once
+_ready_models = {}
+_ready_models_lock = threading.Lock()
+
+def _check_model_ready_once(endpoint, user_id, model_name, client=None):
+    """ _check_model_ready(...); with a lean client a model found ready is
+    not checked again, until it is retrained through this module."""
+    if client is None:
+        client = get_client()
+    key = _PredictionCache.model_key(endpoint, user_id, model_name)
+    if client.lean:
+        with _ready_models_lock:
+            if key in _ready_models:
+                return _ready_models[key]
+    response = _check_model_ready(endpoint, user_id, model_name, client=client)
+    if client.lean and response["error"] == "None":
+        with _ready_models_lock:
+            _ready_models[key] = response
+    return response
+
+def _forget_model(endpoint, user_id, model_name):
+    """The model is retrained: drop its cached labels and readiness."""
+    key = _PredictionCache.model_key(endpoint, user_id, model_name)
+    _prediction_cache().invalidate(key)
+    with _ready_models_lock:
+        _ready_models.pop(key, None)
+
+def  _train_MNIST_model(endpoint, user_id, model_type, model_name, training_size, batch_size, epochs, image_resolution, client = None):
     """Train MNIST model on server."""
+    if client is None:
+        client = get_client()
     
     #user_id - mandatory
     if user_id != "None":
@@ -519,18 +3339,23 @@ def  _train_MNIST_model(endpoint, user_id, model_type, model_name, training_size
     if(DEBUG):
         print('ngq:: _train_MNIST_model:: api_url =', api_url)
     
-    #sending request to train model
-    response = requests.post(url=api_url)
-    assert response.status_code == 200
+    #sending request to train model, not repeated unless the server did not process it
+    response = client.post(url=api_url)
+    error = _http_error(response)
+    if error is not None:
+        return error
     if(DEBUG):
         print("Response received from server:", json.loads(response.content))
-    return json.loads(response.content)
+    return _decode(response)
     
     
 #########
 
-def  _download_MNIST_results(endpoint, user_id, model_name):
-    """Download MNISt traiuning results from the server."""
+def  _get_MNIST_results(endpoint, user_id, model_name, client = None):
+    """Request the MNIST training results from the server.
+    Returns the response, or an error response dict."""
+    if client is None:
+        client = get_client()
     
     #user_id - mandatory
     if user_id != "None":
@@ -547,11 +3372,20 @@ def  _download_MNIST_results(endpoint, user_id, model_name):
     # full api url request
     api_url = endpoint + query_string
     if(DEBUG):
-        print('ngq:: _download_MNIST_results:: api_url =', api_url)
+        print('ngq:: _get_MNIST_results:: api_url =', api_url)
     
     #sending request to the server
-    response = requests.post(url=api_url)
-    assert response.status_code == 200
+    response = client.post(url=api_url, idempotent=True)
+    error = _http_error(response)
+    if error is not None:
+        return error
+    return response
+
+def  _download_MNIST_results(endpoint, user_id, model_name, client = None):
+    """Download MNISt traiuning results from the server."""
+    response = _get_MNIST_results(endpoint, user_id, model_name, client)
+    if isinstance(response, dict):
+        return response
     
     #getting the filename to save the downloaded results
     def get_filename():
@@ -595,8 +3429,968 @@ def  _download_MNIST_results(endpoint, user_id, model_name):
     
     return {"error": "None", "message": "The file " + results_filename + " was downloaded."}
     
+########## PREPROCESSING ##########
+# Optional: decode, resize and normalize the images on the client and upload
+# one .npy tensor with a name index instead of the image files.
+# Needs numpy and Pillow: python3 -m pip install numpy Pillow
+PREPROCESS_BATCH = 256      # images per batch
+PREPROCESS_WORKERS = 1      # processes decoding batches, 1 = in this process
+_NPY_HEADER_SIZE = 128      # fixed .npy header size, rewritten when the shape is known
+
+def _import_numpy_pillow():
+    """Return (numpy, PIL.Image), or (None, error response) if not installed."""
+    try:
+        import numpy
+        from PIL import Image
+    except ImportError as e:
+        _preprocess_logger.error("[PREPROCESS] " + repr(e))
+        return None, {"error": "Error", "message": "Preprocessing needs \'numpy\' and \'Pillow\' modules. "
+                      "One-liner to install from a terminal is: python3 -m pip install numpy Pillow"}
+    return numpy, Image
+
+def _resize_matrix(n_in, n_out):
+    """(n_out, n_in) matrix of area weights, resizes an axis from n_in to n_out pixels."""
+    import numpy as np
+    edges_in = np.arange(n_in + 1, dtype=np.float64)
+    edges_out = np.linspace(0, n_in, n_out + 1)
+    lo = np.maximum(edges_out[:-1, None], edges_in[None, :-1])
+    hi = np.minimum(edges_out[1:, None], edges_in[None, 1:])
+    weights = np.clip(hi - lo, 0, None)
+    return (weights / weights.sum(axis=1, keepdims=True)).astype(np.float32)
+
+def _preprocess_batch(datas, resolution, color_mode):
+    """Decode a batch of encoded images, resize them to resolution x resolution
+    and scale to [0, 1]. Runs in the worker processes.
+    Returns (float32 array, indices of the images that could not be decoded)."""
+    import numpy as np
+    from PIL import Image
+    images, failed = [], []
+    for i, data in enumerate(datas):
+        try:
+            images.append(np.asarray(Image.open(io.BytesIO(data)).convert(color_mode)))
+        except Exception:
+            failed.append(i)
+    channels = () if color_mode == 'L' else (len(color_mode),)
+    out = np.empty((len(images), resolution, resolution) + channels, dtype=np.float32)
+    #images of the same size are resized together
+    shapes = {}
+    for k, image in enumerate(images):
+        shapes.setdefault(image.shape, []).append(k)
+    for shape, ks in shapes.items():
+        stack = np.stack([images[k] for k in ks]).astype(np.float32)
+        stack = np.einsum('ij,njk...->nik...', _resize_matrix(shape[0], resolution), stack)
+        stack = np.einsum('lk,nik...->nil...', _resize_matrix(shape[1], resolution), stack)
+        out[ks] = stack * (1.0 / 255.0)
+    return out, failed
+
+def _npy_header(dtype, shape):
+    """.npy version 1.0 header of _NPY_HEADER_SIZE bytes."""
+    header = "{'descr': '" + dtype.str + "', 'fortran_order': False, 'shape': " + repr(tuple(shape)) + ", }"
+    header = header.ljust(_NPY_HEADER_SIZE - 11) + '\n'
+    return b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin1')
+
+def preprocess_dataset(dataset_dir, image_resolution, output_dir, name='images',
+                       color_mode='L', workers=None, batch_size=None, keep_skipped=False):
+    """Decode the images of dataset_dir (see _dataset_files), resize
+    them to image_resolution x image_resolution, scale to [0, 1] and write
+    them as one float32 tensor output_dir/<name>.npy, shape (n, r, r) for
+    color_mode 'L' or (n, r, r, 3) for 'RGB'. The file names, in the tensor
+    order, go to output_dir/<name>.index.json. The tensor can be read with
+    numpy.load(..., mmap_mode='r').
+    Files that are not images (f.e. labels.csv) are skipped, or copied to
+    output_dir with keep_skipped = True.
+    With workers > 1 the batches are decoded in a pool of processes.
+    Returns a response dict with 'tensor_file' and 'index_file'.
+    """
+    np, Image = _import_numpy_pillow()
+    if np is None:
+        return Image
+    resolution = int(image_resolution)
+    workers = PREPROCESS_WORKERS if workers is None else int(workers)
+    batch_size = PREPROCESS_BATCH if batch_size is None else int(batch_size)
+    os.makedirs(output_dir, exist_ok=True)
+    tensor_file = os.path.join(output_dir, name + '.npy')
+    index_file = os.path.join(output_dir, name + '.index.json')
+    channels = () if color_mode == 'L' else (len(color_mode),)
+
+    def batches():
+        batch = []
+        for file in _dataset_files(dataset_dir):
+            with file.open() as f:
+                batch.append((file.name, f.read()))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def results():
+        """(batch, (array, failed)) in the batch order"""
+        if workers <= 1:
+            for batch in batches():
+                yield batch, _preprocess_batch([data for _, data in batch], resolution, color_mode)
+            return
+        #at most 2 * workers batches are read ahead
+        pending = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for batch in batches():
+                pending.append((batch, executor.submit(_preprocess_batch, [data for _, data in batch], resolution, color_mode)))
+                if len(pending) >= 2 * workers:
+                    batch, future = pending.pop(0)
+                    yield batch, future.result()
+            for batch, future in pending:
+                yield batch, future.result()
+
+    names, skipped = [], []
+    dtype = np.dtype(np.float32)
+    with open(tensor_file, 'wb') as f:
+        f.write(_npy_header(dtype, (0, resolution, resolution) + channels))
+        for batch, (array, failed) in results():
+            failed = set(failed)
+            for i, (file_name, data) in enumerate(batch):
+                if i not in failed:
+                    names.append(file_name)
+                    continue
+                skipped.append(file_name)
+                if keep_skipped:
+                    skipped_file = os.path.join(output_dir, file_name)
+                    #the name may have subdirectories, f.e. with class_subdirs
+                    os.makedirs(os.path.dirname(skipped_file), exist_ok=True)
+                    with open(skipped_file, 'wb') as g:
+                        g.write(data)
+            f.write(array.tobytes())
+        f.seek(0)
+        f.write(_npy_header(dtype, (len(names), resolution, resolution) + channels))
+    with open(index_file, 'w') as f:
+        json.dump({'names': names, 'skipped': skipped, 'image_resolution': resolution,
+                   'color_mode': color_mode}, f)
+    if skipped:
+        _preprocess_logger.warning("[PREPROCESS] " + str(len(skipped)) + " files could not be decoded and were skipped")
+    return {"error": "None",
+            "message": str(len(names)) + " images were preprocessed, " + str(len(skipped)) + " skipped.",
+            "tensor_file": tensor_file,
+            "index_file": index_file}
+
+########## PRE-FLIGHT ##########
+# Optional check of a dataset before it is uploaded: each file is hashed and
+# its format and headers are checked (a truncated PNG or JPEG, a BMP shorter
+# than its header says, an unknown format), in a pool of processes. The
+# hashes and the results go to the hash cache, so the dedup, the prediction
+# cache and the next pre-flight do not read the unchanged files again, and
+# to a manifest, one JSON line per file.
+PREFLIGHT_WORKERS = None        # processes, None = os.cpu_count(), 1 = in this process
+PREFLIGHT_BATCH = 256           # files per batch sent to a process
+PREFLIGHT_REPORTED = 100        # invalid files listed in the response
+TEXT_EXTENSIONS = ('.csv', '.json', '.txt')     # label files, accepted as format 'text'
+
+def _jpeg_size(data):
+    """(width, height) from the SOF segment of a JPEG, None if there is none."""
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        length = int.from_bytes(data[i + 2:i + 4], 'big')
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return int.from_bytes(data[i + 7:i + 9], 'big'), int.from_bytes(data[i + 5:i + 7], 'big')
+        i += 2 + length
+    return None
+
+def _check_image(name, data):
+    """(format, width, height, problem) of the bytes of a file; problem is
+    None for a valid file, else the reason. Only the headers and the end
+    markers are checked, not the pixels."""
+    if not data:
+        return None, None, None, 'empty file'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        if len(data) < 33 or data[12:16] != b'IHDR':
+            return 'png', None, None, 'PNG header is truncated'
+        width, height = int.from_bytes(data[16:20], 'big'), int.from_bytes(data[20:24], 'big')
+        if data[-12:-8] != b'\x00\x00\x00\x00' or data[-8:-4] != b'IEND':
+            return 'png', width, height, 'PNG is truncated, no IEND chunk'
+        return 'png', width, height, None
+    if data[:3] == b'\xff\xd8\xff':
+        size = _jpeg_size(data)
+        width, height = size if size else (None, None)
+        if size is None:
+            return 'jpeg', None, None, 'JPEG has no frame header'
+        if b'\xff\xd9' not in data[-1024:]:
+            return 'jpeg', width, height, 'JPEG is truncated, no end of image marker'
+        return 'jpeg', width, height, None
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        width, height = int.from_bytes(data[6:8], 'little'), int.from_bytes(data[8:10], 'little')
+        if not data.rstrip(b'\x00').endswith(b'\x3b'):
+            return 'gif', width, height, 'GIF is truncated, no trailer'
+        return 'gif', width, height, None
+    if data[:2] == b'BM' and len(data) >= 26:
+        width, height = int.from_bytes(data[18:22], 'little', signed=True), int.from_bytes(data[22:26], 'little', signed=True)
+        if int.from_bytes(data[2:6], 'little') > len(data):
+            return 'bmp', width, abs(height), 'BMP is shorter than its header says'
+        return 'bmp', width, abs(height), None
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        if int.from_bytes(data[4:8], 'little') + 8 > len(data):
+            return 'webp', None, None, 'WEBP is shorter than its header says'
+        return 'webp', None, None, None
+    if data[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'tiff', None, None, None
+    if data[:6] == b'\x93NUMPY':
+        return 'npy', None, None, None
+    if name.lower().endswith(TEXT_EXTENSIONS):
+        try:
+            data.decode('utf-8')
+        except UnicodeDecodeError:
+            return 'text', None, None, 'text file is not UTF-8'
+        return 'text', None, None, None
+    return None, None, None, 'unknown format'
+
+def _preflight_batch(items, decode):
+    """Check a batch of (name, path, data) in a worker process: data is None
+    for a file on disk, read from path. Returns [(hash, (format, width,
+    height, problem, decoded))]."""
+    if decode:
+        from PIL import Image
+    results = []
+    for name, path, data in items:
+        if data is None:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError as ex:
+                results.append((None, (None, None, None, 'cannot read: ' + str(ex), decode)))
+                continue
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        format, width, height, problem = _check_image(name, data)
+        if decode and problem is None and format not in (None, 'text', 'npy'):
+            try:
+                with Image.open(io.BytesIO(data)) as image:
+                    image.load()
+            except Exception as ex:
+                problem = 'cannot be decoded: ' + repr(ex)
+        results.append((digest, (format, width, height, problem, decode)))
+    return results
+
+def preflight_dataset(dataset_dir, workers=None, batch_size=None, formats=None, decode=False, manifest_file=None):
+    """Check and hash the files of dataset_dir (see _dataset_files) before
+    they are uploaded, with workers processes.
+
+    formats is a list of the accepted formats ('png', 'jpeg', 'gif', 'bmp',
+    'webp', 'tiff', 'npy', 'text'); None accepts all of them. decode = True
+    also decodes the images with Pillow, which finds damaged pixel data the
+    header checks do not. Files unchanged since an earlier pre-flight are
+    not read again. Each file gets a line in the manifest (by default in
+    CACHE_DIR/manifests) with its name, path, size, hash, format, width,
+    height and problem (None if the file is valid).
+
+    Returns a response dict: 'error' is "Warning" if there are invalid
+    files, 'files', 'invalid' (numbers), 'invalid_files' (up to
+    PREFLIGHT_REPORTED of [name, problem]), 'formats' ({format: files}),
+    'manifest' (the manifest file).
+    """
+    if decode:
+        try:
+            import PIL
+        except ImportError:
+            return {"error": "Error", "message": "decode = True needs \'Pillow\' module. "
+                    "One-liner to install from a terminal is: python3 -m pip install Pillow"}
+    workers = PREFLIGHT_WORKERS if workers is None else int(workers)
+    workers = workers or os.cpu_count() or 1
+    batch_size = PREFLIGHT_BATCH if batch_size is None else int(batch_size)
+    formats = None if formats is None else set(formats)
+    if manifest_file is None:
+        key = hashlib.sha1(repr(dataset_dir if isinstance(dataset_dir, DatasetScan) else os.path.abspath(dataset_dir)).encode('utf-8')).hexdigest()
+        manifest_file = os.path.join(CACHE_DIR, "manifests", key + ".jsonl")
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_file)), exist_ok=True)
+    cache = _hash_cache()
+
+    def batches():
+        """[(file, known result or None)], with the files to check in the batch"""
+        batch, todo = [], 0
+        for file in _dataset_files(dataset_dir):
+            known = cache.check(file)
+            digest = cache.cached(file)
+            if known is not None and digest is not None and (known[4] or not decode):
+                batch.append((file, (digest, known)))
+            else:
+                batch.append((file, None))
+                todo += 1
+            if todo >= batch_size or len(batch) >= 16 * batch_size:
+                yield batch
+                batch, todo = [], 0
+        if batch:
+            yield batch
+
+    def items(batch):
+        """(name, path, data) of the files to check: files on disk are read
+        by the workers, archive members here"""
+        todo = []
+        for file, known in batch:
+            if known is not None:
+                continue
+            if file.data is None and file.opener is None:
+                todo.append((file.name, file.path, None))
+            else:
+                with file.open() as f:
+                    todo.append((file.name, None, f.read()))
+        return todo
+
+    def checked(batch, results):
+        results = iter(results)
+        return [(file, known if known is not None else next(results)) for file, known in batch]
+
+    def results():
+        """(file, (hash, result)) in the dataset order"""
+        if workers <= 1:
+            for batch in batches():
+                yield from checked(batch, _preflight_batch(items(batch), decode))
+            return
+        #at most 2 * workers batches are read ahead; the processes are
+        #started only if there are files to check
+        pending = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for batch in batches():
+                todo = items(batch)
+                pending.append((batch, executor.submit(_preflight_batch, todo, decode) if todo else None))
+                if len(pending) >= 2 * workers:
+                    batch, future = pending.pop(0)
+                    yield from checked(batch, future.result() if future is not None else [])
+            for batch, future in pending:
+                yield from checked(batch, future.result() if future is not None else [])
+
+    files, invalid, invalid_files, format_counts = 0, 0, [], collections.Counter()
+    with open(manifest_file, 'w') as manifest:
+        for file, (digest, result) in results():
+            format, width, height, problem = result[:4]
+            if digest is not None:
+                cache.put(file, digest)
+                cache.put_check(file, result)
+            if problem is None and formats is not None and format not in formats:
+                problem = 'format ' + str(format) + ' is not accepted'
+            files += 1
+            format_counts[format] += 1
+            if problem is not None:
+                invalid += 1
+                if len(invalid_files) < PREFLIGHT_REPORTED:
+                    invalid_files.append([file.name, problem])
+            manifest.write(json.dumps({'name': file.name, 'path': file.path, 'size': file.size,
+                                       'mtime_ns': file.mtime_ns, 'hash': digest, 'format': format,
+                                       'width': width, 'height': height, 'problem': problem}) + '\n')
+            if files % 10000 == 0:
+                cache.commit()
+    cache.commit()
+    if invalid:
+        _upload_logger.warning("[PREFLIGHT] " + str(invalid) + " of " + str(files) + " files are invalid, see " + manifest_file)
+    return {"error": "Warning" if invalid else "None",
+            "message": str(files) + " files were checked, " + str(invalid) + " are invalid.",
+            "files": files,
+            "invalid": invalid,
+            "invalid_files": invalid_files,
+            "formats": {str(format): n for format, n in format_counts.items()},
+            "manifest": manifest_file}
+
+def _invalid_keys(manifest_file):
+    """(path, size, mtime_ns) of the invalid files of a pre-flight manifest."""
+    keys = set()
+    with open(manifest_file) as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry['problem'] is not None:
+                keys.add((entry['path'], entry['size'], entry['mtime_ns']))
+    return keys
+
+########## PREDICTION CACHE ##########
+# Labels of files already labeled by a model, keyed by (model, model version,
+# content hash). Used by get_labels_api with body['cache'] = 'True'.
+# A model's entries are dropped when it is retrained through this module.
+PREDICTION_CACHE = False                    # default of body['cache']
+PREDICTION_CACHE_SIZE = 100000              # entries kept in memory (LRU)
+PREDICTION_CACHE_DISK = False               # True: also keep entries in CACHE_DIR/predictions.sqlite
+PREDICTION_CACHE_DISK_ENTRIES = 10000000    # max entries on disk, least recently used are evicted
+PREDICTION_CACHE_TTL = 7 * 24 * 3600.0      # seconds an entry stays valid
+
+class _PredictionCache:
+    """Two-tier cache of predicted labels: an in-memory LRU of size entries
+    and, with disk = True, an sqlite database with TTL and size eviction.
+    Keys are (model, version, hash): model identifies the server, user and
+    model name; version changes each time the model is retrained, see
+    invalidate().
+
+    Usage:
+        cache = _prediction_cache()
+        model = cache.model_key(endpoint, user_id, model_name)
+        label = cache.get(model, digest)     # _PredictionCache.MISSING if not cached
+        cache.put(model, digest, label)
+    """
+
+    MISSING = object()
+
+    def __init__(self, size=None, disk=None, disk_entries=None, ttl=None, filename=None):
+        self.size = PREDICTION_CACHE_SIZE if size is None else size
+        self.disk_entries = PREDICTION_CACHE_DISK_ENTRIES if disk_entries is None else disk_entries
+        self.ttl = PREDICTION_CACHE_TTL if ttl is None else ttl
+        self.filename = filename or os.path.join(CACHE_DIR, "predictions.sqlite")
+        self._memory = collections.OrderedDict()    # (model, version, hash) -> (label, stored_at)
+        self._versions = {}                         # model -> version
+        self._lock = threading.Lock()
+        self._db = None
+        self._puts = 0
+        if PREDICTION_CACHE_DISK if disk is None else disk:
+            try:
+                import sqlite3
+                os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+                self._db = sqlite3.connect(self.filename, check_same_thread=False)
+                self._db.execute("CREATE TABLE IF NOT EXISTS predictions (model TEXT, version TEXT, hash TEXT, "
+                                 "label TEXT, stored REAL, used REAL, PRIMARY KEY (model, version, hash))")
+                self._db.execute("CREATE INDEX IF NOT EXISTS predictions_used ON predictions (used)")
+                self._db.execute("CREATE TABLE IF NOT EXISTS versions (model TEXT PRIMARY KEY, version TEXT)")
+                self._db.commit()
+            except Exception as ex:
+                _cache_logger.warning("[CACHE] cannot open the prediction cache " + self.filename + ", using memory: " + repr(ex))
+                self._db = None
+
+    @staticmethod
+    def model_key(endpoint, user_id, model_name):
+        from urllib.parse import urlparse
+        return urlparse(endpoint).netloc + '/' + str(user_id) + '/' + str(model_name)
+
+    def version(self, model):
+        """Current version of model, '0' until it is retrained."""
+        with self._lock:
+            if model not in self._versions and self._db is not None:
+                row = self._db.execute("SELECT version FROM versions WHERE model = ?", (model,)).fetchone()
+                if row is not None:
+                    self._versions[model] = row[0]
+            return self._versions.get(model, '0')
+
+    def invalidate(self, model, version=None):
+        """Model was retrained: drop its entries and start a new version."""
+        version = version or uuid.uuid4().hex
+        with self._lock:
+            self._versions[model] = version
+            for key in [key for key in self._memory if key[0] == model]:
+                del self._memory[key]
+            if self._db is not None:
+                self._db.execute("DELETE FROM predictions WHERE model = ?", (model,))
+                self._db.execute("INSERT OR REPLACE INTO versions VALUES (?, ?)", (model, version))
+                self._db.commit()
+
+    def get(self, model, digest):
+        key = (model, self.version(model), digest)
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                if now - item[1] <= self.ttl:
+                    self._memory.move_to_end(key)
+                    return item[0]
+                del self._memory[key]
+            if self._db is None:
+                return self.MISSING
+            row = self._db.execute("SELECT label, stored FROM predictions WHERE model = ? AND version = ? AND hash = ?",
+                                   key).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                return self.MISSING
+            self._db.execute("UPDATE predictions SET used = ? WHERE model = ? AND version = ? AND hash = ?", (now,) + key)
+            label = json.loads(row[0])
+            self._remember(key, label, row[1])
+            return label
+
+    def _remember(self, key, label, stored):
+        self._memory[key] = (label, stored)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.size:
+            self._memory.popitem(last=False)
+
+    def put(self, model, digest, label):
+        key = (model, self.version(model), digest)
+        now = time.time()
+        with self._lock:
+            self._remember(key, label, now)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?)",
+                                 key + (json.dumps(label), now, now))
+                self._puts += 1
+
+    def commit(self):
+        """Write the new entries to disk and evict the expired and the least recently used ones."""
+        with self._lock:
+            if self._db is None:
+                return
+            now = time.time()
+            self._db.execute("DELETE FROM predictions WHERE stored < ?", (now - self.ttl,))
+            if self._puts:
+                count = self._db.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+                if count > self.disk_entries:
+                    self._db.execute("DELETE FROM predictions WHERE rowid IN "
+                                     "(SELECT rowid FROM predictions ORDER BY used LIMIT ?)", (count - self.disk_entries,))
+                self._puts = 0
+            self._db.commit()
+
+_prediction_cache_instance = None
+_prediction_cache_lock = threading.Lock()
+
+def _prediction_cache():
+    """Return the process-wide _PredictionCache, create it on first use."""
+    global _prediction_cache_instance
+    if _prediction_cache_instance is None:
+        with _prediction_cache_lock:
+            if _prediction_cache_instance is None:
+                _prediction_cache_instance = _PredictionCache()
+    return _prediction_cache_instance
+
+def _get_labels_cached(endpoint, user_id, dataset_dir, model_name, client=None):
+    """ Get files labeled, with the prediction cache.
+    Only the files whose content has no cached label for the model are
+    uploaded (each content once) and labeled; when all are cached there is
+    no request at all. The server response is expected to have the labels
+    in response['labels'] = {file name: label}; other responses are
+    returned as they are and not cached. The returned response has the
+    labels of all files and response['cached'] = number of cached labels."""
+    if client is None:
+        client = get_client()
+    cache = _prediction_cache()
+    model = cache.model_key(endpoint, user_id, model_name)
+    hashes = _hash_cache()
+    
+    labels, misses, unique = {}, [], {}    # unique: hash -> file to upload
+    for file in _dataset_files(dataset_dir):
+        digest = hashes.hash(file)
+        label = cache.get(model, digest)
+        if label is _PredictionCache.MISSING:
+            misses.append((file.name, digest))
+            unique.setdefault(digest, file)
+        else:
+            labels[file.name] = label
+    hashes.commit()
+    num_cached = len(labels)
+    if not misses:
+        return {"error": "None", "message": "All labels were found in the prediction cache.",
+                "labels": labels, "cached": num_cached}
+    
+    response = _check_model_ready_once(endpoint = _change_route(endpoint, '/check_model_ready'),
+                                       user_id = user_id,
+                                       model_name = model_name,
+                                       client = client)
+    if response["error"] != "None":
+        return response
+    
+    tmp_data_id = 'TMP_SET_TO_LABEL'
+    response = _upload_data_files(endpoint = _change_route(endpoint, '/upload_data'),
+                                  user_id = user_id,
+                                  data_id = tmp_data_id,
+                                  client = client,
+                                  file_list = list(unique.values()),
+                                  use_journal = False)
+    if response["error"] == "Error":
+        return response
+    response = _request_labels(endpoint, user_id, model_name, tmp_data_id, client)
+    new_labels = response.get('labels')
+    if not isinstance(new_labels, dict):
+        return response
+    
+    for digest, file in unique.items():
+        if file.name in new_labels:
+            cache.put(model, digest, new_labels[file.name])
+    cache.commit()
+    for name, digest in misses:
+        uploaded = unique[digest].name
+        if uploaded in new_labels:
+            labels[name] = new_labels[uploaded]
+    response['labels'] = labels
+    response['cached'] = num_cached
+    return response
+
+########## WAITING FOR MODELS ##########
+# Polling of check_model_ready while a model is trained: exponential backoff
+# with jitter, up to an overall deadline.
+WAIT_INITIAL_DELAY = 0.5    # seconds before the 2nd check
+WAIT_MAX_DELAY = 8.0        # max seconds between checks
+WAIT_BACKOFF = 2.0          # delay growth factor
+WAIT_JITTER = 0.5           # delays are drawn from [(1 - jitter) * delay, delay]
+WAIT_DEADLINE = 80.0        # default overall deadline, seconds
+WAIT_LONG_POLL = 0          # > 0: ask the server to hold each check up to that many seconds
+
+def _backoff_delays(initial=None, maximum=None, factor=None, jitter=None):
+    """Infinite generator of retry delays: exponential backoff with jitter."""
+    import random
+    delay = WAIT_INITIAL_DELAY if initial is None else initial
+    maximum = WAIT_MAX_DELAY if maximum is None else maximum
+    factor = WAIT_BACKOFF if factor is None else factor
+    jitter = WAIT_JITTER if jitter is None else jitter
+    while True:
+        yield min(delay, maximum) * (1.0 - jitter * random.random())
+        delay = min(delay * factor, maximum)
+
+def wait_model_ready(endpoint, user_id, model_name, client=None, deadline=None, long_poll=None, on_retry=None):
+    """Check the model until it is ready, an error is returned, or deadline
+    seconds (default WAIT_DEADLINE) have passed. The checks are spaced with
+    exponential backoff and jitter. With long_poll > 0 each check asks the
+    server to hold the request until the model is ready; no extra delay is
+    added when the server did hold it.
+    on_retry(response, delay) is called before each wait.
+    Returns the last check_model_ready response: error 'Warning' means the
+    model was still in training at the deadline."""
+    deadline = WAIT_DEADLINE if deadline is None else deadline
+    long_poll = WAIT_LONG_POLL if long_poll is None else long_poll
+    stop_at = time.monotonic() + deadline
+    delays = _backoff_delays()
+    while True:
+        started = time.monotonic()
+        poll = round(min(long_poll, max(0.0, stop_at - started)), 1) if long_poll else 0
+        response = _check_model_ready(endpoint = endpoint,
+                                      user_id = user_id,
+                                      model_name = model_name,
+                                      client = client,
+                                      long_poll = poll)
+        if response["error"] != "Warning":
+            return response
+        now = time.monotonic()
+        if now >= stop_at:
+            return response
+        delay = next(delays)
+        if poll and now - started >= poll / 2:
+            #the server held the request, ask again at once
+            delay = 0.0
+        delay = min(delay, stop_at - now)
+        if on_retry is not None:
+            on_retry(response, delay)
+        time.sleep(delay)
+
+class ModelWaiter:
+    """Waits for many models at once from one scheduler thread.
+
+        waiter = ngq.ModelWaiter()
+        futures = [waiter.wait(endpoint, user_id, name) for name in model_names]
+        for future in concurrent.futures.as_completed(futures):
+            print(future.result())
+
+    wait() returns a concurrent.futures.Future, resolved with the
+    check_model_ready response once the model is ready, an error is returned,
+    or the deadline has passed. Each model is checked on its own backoff
+    schedule; the checks run in the scheduler thread, one at a time.
+    Cancelled futures are not checked anymore.
+    """
+
+    def __init__(self, client=None):
+        self.client = client
+        self._heap = []     # (next check time, sequence number, entry)
+        self._count = 0
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def wait(self, endpoint, user_id, model_name, deadline=None):
+        """Future of the model's readiness response."""
+        deadline = WAIT_DEADLINE if deadline is None else deadline
+        future = concurrent.futures.Future()
+        entry = {'endpoint': endpoint, 'user_id': user_id, 'model_name': model_name,
+                 'stop_at': time.monotonic() + deadline, 'delays': _backoff_delays(), 'future': future}
+        with self._cond:
+            self._push(time.monotonic(), entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ngq-waiter", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def _push(self, when, entry):
+        self._count += 1
+        heapq.heappush(self._heap, (when, self._count, entry))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._heap:
+                    self._thread = None
+                    return
+                when, _, entry = self._heap[0]
+                now = time.monotonic()
+                if when > now:
+                    self._cond.wait(when - now)
+                    continue
+                heapq.heappop(self._heap)
+            #the future stays pending between the checks, so it can be cancelled
+            future = entry['future']
+            if future.cancelled():
+                continue
+            try:
+                response = _check_model_ready(endpoint = entry['endpoint'],
+                                              user_id = entry['user_id'],
+                                              model_name = entry['model_name'],
+                                              client = self.client)
+            except Exception as ex:
+                self._resolve(future, exception=ex)
+                continue
+            now = time.monotonic()
+            if response["error"] != "Warning" or now >= entry['stop_at']:
+                self._resolve(future, response=response)
+                continue
+            with self._cond:
+                self._push(now + min(next(entry['delays']), entry['stop_at'] - now), entry)
+
+    @staticmethod
+    def _resolve(future, response=None, exception=None):
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(response)
+        except concurrent.futures.InvalidStateError:
+            #cancelled meanwhile
+            pass
+
+########## HYPERPARAMETER SWEEPS ##########
+# A grid of train_MNIST_model_api parameters trained as separate models,
+# see SweepScheduler.
+SWEEP_CONCURRENCY = 4           # models trained at the same time
+SWEEP_RATE = 1.0                # training requests per second at most, None = no limit
+SWEEP_DEADLINE = 3600.0         # seconds a model may train
+SWEEP_GRID_KEYS = ('model_type', 'training_set_size', 'batch_size', 'epochs', 'image_resolution')
+SWEEP_BUDGET_KEYS = ('training_set_size', 'epochs', 'image_resolution')    # more = slower, not worse
+
+class SweepJob:
+    """One configuration of a sweep.
+    config: the grid values of the job, f.e. {'epochs': 10, 'batch_size': 32, ...}
+    body: the train_MNIST_model_api body of the job
+    state: 'pending', 'training', 'done', 'failed', 'pruned' or 'cancelled'
+    response: the last response of the server (error responses of failed jobs)
+    results: the downloaded results, text; score: score_fn(job)"""
+
+    def __init__(self, index, config, body):
+        self.index = index
+        self.config = config
+        self.body = body
+        self.model_name = body['model_name']
+        self.state = 'pending'
+        self.response = None
+        self.results = None
+        self.score = None
+        self.submitted_at = None
+        self.finished_at = None
+        self._future = None
+
+    def __repr__(self):
+        return 'SweepJob(' + self.model_name + ', ' + self.state + ', score=' + str(self.score) + ')'
+
+class SweepScheduler:
+    """Hyperparameter sweep of train_MNIST_model_api.
+
+    Each combination of the lists given in body for SWEEP_GRID_KEYS is
+    trained as its own model, named body['model_name'] + '_' + the job
+    number. At most concurrency models train at the same time, and at most
+    rate training requests are sent per second. The readiness of the models
+    is checked by one ModelWaiter; the results of each ready model are
+    downloaded (as text, not to results.txt) and scored with score_fn(job),
+    higher is better.
+
+    A pending configuration is pruned, that is never trained, when it is
+    dominated: a finished job with the same other parameters and at least
+    the same budget (SWEEP_BUDGET_KEYS: training set size, epochs,
+    resolution) scored lower than the best score so far minus margin. The
+    rule assumes that a smaller budget does not score better; list the
+    larger values first in the grid to prune early. prune_fn(job, finished)
+    replaces the rule. Nothing is pruned without score_fn.
+
+    Usage:
+        def accuracy(job):
+            return float(job.results.split('accuracy = ')[-1].split()[0])
+        body['epochs'] = [50, 20, 10]
+        sweep = ngq.SweepScheduler(body, concurrency=4, rate=2.0, score_fn=accuracy)
+        for job in sweep.as_completed():
+            print(job.config, job.state, job.score)
+        print(sweep.best())
+
+    Trainings already started on the server are not stopped by cancel() or
+    pruning; only the waiting for them stops. Without body['endpoint'] the
+    models are trained on SERVER_URL.
+    """
+
+    def __init__(self, body, concurrency=None, rate=None, deadline=None, score_fn=None, prune_fn=None,
+                 margin=0.0, client=None):
+        self.concurrency = SWEEP_CONCURRENCY if concurrency is None else concurrency
+        self.rate = SWEEP_RATE if rate is None else rate
+        self.deadline = SWEEP_DEADLINE if deadline is None else deadline
+        self.score_fn = score_fn
+        self.prune_fn = prune_fn
+        self.margin = margin
+        self.client = client if client is not None else body.get('client')
+        #the train_mnist_model route, of SERVER_URL by default
+        self.endpoint = body.get('endpoint') or SERVER_URL + '/train_mnist_model'
+        self.user_id = body.get('user_id', 'None')
+        self.jobs = self._expand(body)
+        self._waiter = ModelWaiter(client=self.client)
+        self._cond = threading.Condition()
+        self._ready = []            # jobs whose readiness check finished
+        self._completed = queue.Queue()
+        self._cancelled = False
+        self._thread = None
+
+    def _expand(self, body):
+        """The jobs of the grid of body, in grid order."""
+        import itertools
+        grid = [(key, body[key] if isinstance(body[key], (list, tuple)) else [body[key]])
+                for key in SWEEP_GRID_KEYS if key in body]
+        name = body.get('model_name', 'my_mnist_model')
+        jobs = []
+        for index, values in enumerate(itertools.product(*[values for _, values in grid])):
+            config = dict(zip([key for key, _ in grid], values))
+            job_body = dict(body, endpoint=self.endpoint, model_name=name + '_' + str(index))
+            for key, value in config.items():
+                #the server expects lists, except for model_type
+                job_body[key] = value if key == 'model_type' else [value]
+            jobs.append(SweepJob(index, config, job_body))
+        return jobs
+
+    def start(self):
+        """Start the sweep in a background thread, returns self."""
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=contextvars.copy_context().run, args=(self._run,),
+                                                name="ngq-sweep", daemon=True)
+                self._thread.start()
+        return self
+
+    def as_completed(self, timeout=None):
+        """Generator of the jobs as they finish (done, failed, pruned or
+        cancelled); starts the sweep if needed."""
+        self.start()
+        for _ in self.jobs:
+            yield self._completed.get(timeout=timeout)
+
+    def results(self, timeout=None):
+        """Wait for all jobs, return them in grid order."""
+        for _ in self.as_completed(timeout):
+            pass
+        return self.jobs
+
+    def best(self):
+        """The done job with the highest score, None if there is none."""
+        scored = [job for job in self.jobs if job.state == 'done' and job.score is not None]
+        return max(scored, key=lambda job: job.score) if scored else None
+
+    def cancel(self):
+        """Do not train the pending jobs, stop waiting for the training ones."""
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify()
+
+    def _finish(self, job, state, response=None):
+        job.state = state
+        if response is not None:
+            job.response = response
+        job.finished_at = time.monotonic()
+        _sweep_logger.info("[SWEEP] " + job.model_name + " " + state + (" score " + str(job.score) if job.score is not None else ""))
+        self._completed.put(job)
+
+    def _dominated(self, job, finished):
+        if self.prune_fn is not None:
+            return self.prune_fn(job, finished)
+        scored = [other for other in finished if other.score is not None]
+        if not scored:
+            return False
+        best = max(other.score for other in scored)
+        for other in scored:
+            if other.score >= best - self.margin:
+                continue
+            same = all(other.config[key] == value for key, value in job.config.items() if key not in SWEEP_BUDGET_KEYS)
+            larger = all(other.config[key] >= value for key, value in job.config.items() if key in SWEEP_BUDGET_KEYS)
+            if same and larger:
+                return True
+        return False
+
+    def _submit(self, job):
+        """Send the training request of job, wait for the model in the background."""
+        job.submitted_at = time.monotonic()
+        response = train_MNIST_model_api(job.body)
+        if response["error"] != "None":
+            self._finish(job, 'failed', response)
+            return
+        job.state = 'training'
+        job.response = response
+        job._future = self._waiter.wait(_change_route(self.endpoint, '/check_model_ready'), self.user_id,
+                                        job.model_name, deadline=self.deadline)
+        def ready(future, job=job):
+            with self._cond:
+                self._ready.append(job)
+                self._cond.notify()
+        job._future.add_done_callback(ready)
+
+    def _collect(self, job):
+        """job's model finished training: download and score its results."""
+        future = job._future
+        if future.cancelled():
+            return self._finish(job, 'cancelled')
+        if future.exception() is not None:
+            return self._finish(job, 'failed', {"error": "Error", "message": repr(future.exception())})
+        response = future.result()
+        if response["error"] != "None":
+            return self._finish(job, 'failed', response)
+        results = _get_MNIST_results(_change_route(self.endpoint, '/download_mnist_results'), self.user_id,
+                                     job.model_name, self.client)
+        if isinstance(results, dict):
+            return self._finish(job, 'failed', results)
+        job.results = results.text
+        if self.score_fn is not None:
+            try:
+                job.score = self.score_fn(job)
+            except Exception as ex:
+                return self._finish(job, 'failed', {"error": "Error", "message": "score_fn: " + repr(ex)})
+        self._finish(job, 'done', response)
+
+    def _run(self):
+        pending = collections.deque(self.jobs)
+        training = 0
+        next_submit = time.monotonic()
+        finished = []
+        while True:
+            with self._cond:
+                if self._cancelled:
+                    for job in pending:
+                        self._finish(job, 'cancelled')
+                    pending.clear()
+                    for job in self.jobs:
+                        if job.state == 'training':
+                            job._future.cancel()
+                ready, self._ready = self._ready, []
+                if not ready:
+                    now = time.monotonic()
+                    if not pending and training == 0:
+                        return
+                    if not pending or training >= self.concurrency:
+                        self._cond.wait()
+                        continue
+                    if now < next_submit:
+                        self._cond.wait(next_submit - now)
+                        continue
+            for job in ready:
+                training -= 1
+                try:
+                    self._collect(job)
+                except Exception as ex:
+                    self._finish(job, 'failed', {"error": "Error", "message": repr(ex)})
+                finished.append(job)
+            if ready:
+                continue
+            job = pending.popleft()
+            if self.score_fn is not None or self.prune_fn is not None:
+                if self._dominated(job, finished):
+                    self._finish(job, 'pruned')
+                    continue
+            training += 1
+            try:
+                self._submit(job)
+            except Exception as ex:
+                self._finish(job, 'failed', {"error": "Error", "message": repr(ex)})
+            if job.state != 'training':
+                training -= 1
+                finished.append(job)
+            if self.rate:
+                next_submit = time.monotonic() + 1.0 / self.rate
+
 ##################### API WRAPPERS #####################
 
+@_traced
 def upload_dataset_to_server_api(body):
     """ API wrapper.
     Take the api request and send a request to server to transfer files
@@ -619,9 +4413,9 @@ def upload_dataset_to_server_api(body):
     else:
         user_id = 'None'
         
-    #checking 'dataset_dir'
+    #checking 'dataset_dir', and the scan options of DatasetScan - optional
     if 'dataset_dir' in keys_list:
-        dataset_dir = body['dataset_dir']
+        dataset_dir = _dataset_from_body(body, body['dataset_dir'])
     else:
         dataset_dir = 'None'
     
@@ -631,13 +4425,169 @@ def upload_dataset_to_server_api(body):
     else:
         data_id = 'None'
     
-    response = _upload_data_files(endpoint = endpoint,
-                                  dataset_dir = dataset_dir,
-                                  user_id = user_id,
-                                  data_id = data_id)
+    #checking 'client' - optional, get_client() is used by default
+    if 'client' in keys_list:
+        client = body['client']
+    else:
+        client = None
+    
+    #checking 'upload_workers' - optional, number of chunks sent at the same time
+    if 'upload_workers' in keys_list:
+        workers = int(body['upload_workers'])
+    else:
+        workers = None
+    
+    #checking 'chunk_min_bytes' and 'chunk_max_bytes' - optional, bounds of the chunk size
+    if 'chunk_min_bytes' in keys_list:
+        min_chunk_bytes = int(body['chunk_min_bytes'])
+    else:
+        min_chunk_bytes = None
+    if 'chunk_max_bytes' in keys_list:
+        max_chunk_bytes = int(body['chunk_max_bytes'])
+    else:
+        max_chunk_bytes = None
+    
+    #checking 'dedup' - optional, 'True' to skip the files the server already has
+    if 'dedup' in keys_list:
+        dedup = str(body['dedup']) == 'True'
+    else:
+        dedup = False
+    
+    #checking 'resume' - optional, 'True' to continue a failed upload
+    if 'resume' in keys_list:
+        resume = str(body['resume']) == 'True'
+    else:
+        resume = False
+    
+    #checking 'transfer_mode' - optional, 'files' (default) or 'packed'
+    if 'transfer_mode' in keys_list:
+        transfer_mode = body['transfer_mode']
+        if transfer_mode not in ('files', 'packed'):
+            return {"error": "Error", "message": "Transfer mode \'" + str(transfer_mode) + "\' is not supported. Use \'files\' or \'packed\'."}
+    else:
+        transfer_mode = 'files'
+    
+    #checking 'preflight' - optional, check the files before they are sent, see preflight_dataset
+    file_list = None
+    if str(body.get('preflight')) == 'True':
+        response = preflight_dataset(dataset_dir = dataset_dir,
+                                     workers = body.get('preflight_workers'),
+                                     formats = _patterns_from_body(body, 'accepted_formats') or None,
+                                     decode = str(body.get('preflight_decode')) == 'True')
+        if response["error"] == "Error":
+            return response
+        if response["invalid"] and str(body.get('skip_invalid')) != 'True':
+            response["error"] = "Error"
+            response["message"] += " Nothing was uploaded; fix the files, or add \'skip_invalid\': \'True\' to upload the valid ones."
+            return response
+        if response["invalid"]:
+            invalid = _invalid_keys(response["manifest"])
+            file_list = (file for file in _dataset_files(dataset_dir) if file.key() not in invalid)
+    
+    #checking 'image_resolution' - optional, preprocess the images and upload a tensor
+    #the tensor is written to CACHE_DIR/tensors and removed after the upload
+    output_dir = None
+    if 'image_resolution' in keys_list:
+        tensor_key = str(data_id) if str(data_id) != 'None' else 'None\n' + _dataset_fingerprint(dataset_dir)
+        output_dir = os.path.join(CACHE_DIR, "tensors",
+                                  hashlib.sha1((str(user_id) + '\n' + tensor_key).encode('utf-8')).hexdigest())
+        shutil.rmtree(output_dir, ignore_errors=True)
+        #the tensor is named after data_id, else after the dataset directory
+        if str(data_id) != 'None':
+            tensor_name = str(data_id)
+        else:
+            directory = dataset_dir.directory if isinstance(dataset_dir, DatasetScan) else str(dataset_dir)
+            tensor_name = os.path.basename(os.path.normpath(directory)) or 'images'
+        response = preprocess_dataset(dataset_dir = dataset_dir,
+                                      image_resolution = body['image_resolution'],
+                                      output_dir = output_dir,
+                                      name = tensor_name,
+                                      color_mode = body.get('color_mode', 'L'),
+                                      workers = body.get('preprocess_workers'),
+                                      keep_skipped = True)
+        if response["error"] != "None":
+            shutil.rmtree(output_dir, ignore_errors=True)
+            return response
+        dataset_dir = output_dir + os.sep
+        file_list = None
+    
+    try:
+        response = _upload_data_files(endpoint = endpoint,
+                                      dataset_dir = dataset_dir,
+                                      user_id = user_id,
+                                      data_id = data_id,
+                                      client = client,
+                                      workers = workers,
+                                      min_chunk_bytes = min_chunk_bytes,
+                                      max_chunk_bytes = max_chunk_bytes,
+                                      dedup = dedup,
+                                      resume = resume,
+                                      transfer_mode = transfer_mode,
+                                      cancel = body.get('cancel_event'),
+                                      file_list = file_list)
+    finally:
+        #the tensor is made again by the next upload, f.e. a resumed one
+        if output_dir is not None:
+            shutil.rmtree(output_dir, ignore_errors=True)
+    return response
+    
+
+@_traced
+def preprocess_dataset_api(body):
+    """ Preprocess images to a tensor file. API wrapper for preprocess_dataset(...)"""
+    
+    #check keys in body dict
+    keys_list = body.keys()
+    
+    #checking 'dataset_dir' - mandatory
+    if 'dataset_dir' in keys_list:
+        dataset_dir = _dataset_from_body(body, body['dataset_dir'])
+    else:
+        return {"error": "Error", "message": "Please provide dataset_dir."}
+    
+    #checking 'image_resolution' - mandatory
+    if 'image_resolution' in keys_list:
+        image_resolution = body['image_resolution']
+    else:
+        return {"error": "Error", "message": "Please provide image_resolution, f.e. 28."}
+    
+    #checking 'output_dir' - optional
+    if 'output_dir' in keys_list:
+        output_dir = body['output_dir']
+    else:
+        output_dir = 'preprocessed'
+    
+    response = preprocess_dataset(dataset_dir = dataset_dir,
+                                  image_resolution = image_resolution,
+                                  output_dir = output_dir,
+                                  name = body.get('name', 'images'),
+                                  color_mode = body.get('color_mode', 'L'),
+                                  workers = body.get('preprocess_workers'))
+    return response
+    
+
+@_traced
+def preflight_dataset_api(body):
+    """ Check and hash the files of a dataset. API wrapper for preflight_dataset(...)"""
+    
+    #check keys in body dict
+    keys_list = body.keys()
+    
+    #checking 'dataset_dir', and the scan options of DatasetScan - mandatory
+    if 'dataset_dir' in keys_list:
+        dataset_dir = _dataset_from_body(body, body['dataset_dir'])
+    else:
+        return {"error": "Error", "message": "Please provide dataset_dir."}
+    
+    response = preflight_dataset(dataset_dir = dataset_dir,
+                                 workers = body.get('preflight_workers'),
+                                 formats = _patterns_from_body(body, 'accepted_formats') or None,
+                                 decode = str(body.get('preflight_decode')) == 'True',
+                                 manifest_file = body.get('manifest_file'))
     return response
     
 
+@_traced
 def train_model_on_data_api(body):
     """API wrapper for _train_model_on_data(...)"""
     
@@ -675,17 +4625,25 @@ def train_model_on_data_api(body):
     else:
         num_classes = 'None'
     
+    #checking 'client' - optional, get_client() is used by default
+    if 'client' in keys_list:
+        client = body['client']
+    else:
+        client = None
+    
     response = _train_model_on_data(endpoint = endpoint,
                                     user_id = user_id,
                                     data_id = data_id,
                                     model_name = model_name,
-                                    num_classes = num_classes)
-    import time
-    time.sleep(1.0)
+                                    num_classes = num_classes,
+                                    client = client)
+    #the cached labels and readiness of the old model are not valid anymore
+    _forget_model(endpoint, user_id, model_name)
     
     return response
     
 
+@_traced
 def get_labels_api(body):
     """ Get files labeled. API wrapper for _get_labels(...)"""
     
@@ -705,9 +4663,9 @@ def get_labels_api(body):
     else:
         user_id = 'None'
     
-    #checking 'dataset_dir'
+    #checking 'dataset_dir', and the scan options of DatasetScan - optional
     if 'dataset_dir' in keys_list:
-        dataset_dir = body['dataset_dir']
+        dataset_dir = _dataset_from_body(body, body['dataset_dir'])
     else:
         dataset_dir = 'None'
         
@@ -717,6 +4675,24 @@ def get_labels_api(body):
     else:
         model_name = 'None'
     
+    #checking 'client' - optional, get_client() is used by default
+    if 'client' in keys_list:
+        client = body['client']
+    else:
+        client = None
+    
+    #checking 'cache' - optional, 'True' to use the prediction cache
+    if 'cache' in keys_list:
+        use_cache = str(body['cache']) == 'True'
+    else:
+        use_cache = PREDICTION_CACHE
+    if use_cache and 'batch_callback' not in keys_list:
+        return _get_labels_cached(endpoint = endpoint,
+                                  user_id = user_id,
+                                  dataset_dir = dataset_dir,
+                                  model_name = model_name,
+                                  client = client)
+    
     #check if model exists and ready
     def change_endpoint(endpoint, new_route):
         """Change endpoint. Example:
@@ -742,22 +4718,73 @@ def get_labels_api(body):
                                     endpoint=endpoint,
                                     new_route='/check_model_ready')
     #now checking if model is ready
-    response = _check_model_ready(
+    response = _check_model_ready_once(
                     endpoint=check_model_ready_endpoint,
                     user_id=user_id,
-                    model_name=model_name)
+                    model_name=model_name,
+                    client=client)
     if response["error"] != "None":
         if(DEBUG):
             print("Model is not ready")
         return response
     
+    #checking 'batch_callback' - optional, streaming mode: callback(response)
+    #is called with the labels of each batch, see get_labels_stream_api
+    if 'batch_callback' in keys_list:
+        num_batches = 0
+        for response in _get_labels_stream(endpoint = endpoint,
+                                           user_id = user_id,
+                                           dataset_dir = dataset_dir,
+                                           model_name = model_name,
+                                           client = client,
+                                           batch_files = body.get('batch_files')):
+            body['batch_callback'](response)
+            if response["error"] == "Error":
+                return response
+            num_batches += 1
+        return {"error": "None", "message": str(num_batches) + " batches of files were labeled."}
+    
     #get labels from server
     response = _get_labels(endpoint = endpoint,
                            user_id = user_id,
                            dataset_dir = dataset_dir,
-                           model_name = model_name)
+                           model_name = model_name,
+                           client = client)
     return response
+
+def get_labels_stream_api(body):
+    """ Get files labeled batch by batch. Generator version of get_labels_api:
+    yields the labels response of each batch of body['batch_files'] files
+    (default LABEL_BATCH_FILES) as soon as it is ready, while the next batch
+    is uploaded. Each response has 'batch' (the batch number) and 'files'
+    (the file names of the batch).
     
+    Usage:
+        for response in ngq.get_labels_stream_api(body_get_labels):
+            print(response)
+    """
+    #checking the body keys, with the defaults of get_labels_api
+    endpoint = body.get('endpoint', 'https://24.199.84.84/get_labels')
+    user_id = body.get('user_id', 'None')
+    model_name = body.get('model_name', 'None')
+    client = body.get('client')
+    
+    #check if model exists and ready
+    response = _check_model_ready_once(endpoint = _change_route(endpoint, '/check_model_ready'),
+                                       user_id = user_id,
+                                       model_name = model_name,
+                                       client = client)
+    if response["error"] != "None":
+        yield response
+        return
+    yield from _get_labels_stream(endpoint = endpoint,
+                                  user_id = user_id,
+                                  dataset_dir = _dataset_from_body(body, body.get('dataset_dir', 'None')),
+                                  model_name = model_name,
+                                  client = client,
+                                  batch_files = body.get('batch_files'))
+    
+@_traced
 def check_model_ready_api(body):
     """ Check if model is trained."""
     
@@ -783,34 +4810,43 @@ def check_model_ready_api(body):
     else:
         model_name = 'None'
         
+    #checking 'client' - optional, get_client() is used by default
+    if 'client' in keys_list:
+        client = body['client']
+    else:
+        client = None
+    
     #checking 'keep_trying'
-    MAX_TRIES = 20 #max number of tries
-    TIME_OUT  = 4.0  #in seconds
-    num_tries = 1
+    keep_trying = False
     if 'keep_trying' in keys_list:
         if body['keep_trying'] == 'True':
-            num_tries = MAX_TRIES
+            keep_trying = True
+    
+    #checking 'deadline' and 'long_poll' - optional, see wait_model_ready
+    deadline = float(body['deadline']) if 'deadline' in keys_list else None
+    long_poll = float(body['long_poll']) if 'long_poll' in keys_list else WAIT_LONG_POLL
     
-    #trying num_tries times
-    if num_tries == 1:
+    #trying once, or until ready
+    if not keep_trying:
         response = _check_model_ready(endpoint = endpoint,
                            user_id = user_id,
-                           model_name = model_name)
+                           model_name = model_name,
+                           client = client)
         return response
-    else:
-        for i in range(num_tries):
-            response = _check_model_ready(endpoint = endpoint,
-                               user_id = user_id,
-                               model_name = model_name)
-            if response["error"] == "Warning":
-                print("    ** Training in progress. Will authomatically retry in", TIME_OUT, "seconds.")
-                time.sleep(TIME_OUT)
-            else:
-                return response
-    return response
+    
+    def report(response, delay):
+        print("    ** Training in progress. Will authomatically retry in", round(delay, 1), "seconds.")
+    return wait_model_ready(endpoint = endpoint,
+                            user_id = user_id,
+                            model_name = model_name,
+                            client = client,
+                            deadline = deadline,
+                            long_poll = long_poll,
+                            on_retry = report)
         
 
 
+@_traced
 def train_MNIST_model_api(body):
     """ Train MNIST model on the server, Berk version"""
     
@@ -871,6 +4907,12 @@ def train_MNIST_model_api(body):
     else:
         image_resolution = [4, 7, 14, 28] #default value
       
+    #checking 'client' - optional, get_client() is used by default
+    if 'client' in keys_list:
+        client = body['client']
+    else:
+        client = None
+    
     response = _train_MNIST_model(endpoint = endpoint,
                             user_id = user_id,
                             model_type = model_type,
@@ -878,12 +4920,68 @@ def train_MNIST_model_api(body):
                             training_size = training_size,
                             batch_size = batch_size,
                             epochs = epochs,
-                            image_resolution = image_resolution)
+                            image_resolution = image_resolution,
+                            client = client)
+    #the cached labels and readiness of the old model are not valid anymore
+    _forget_model(endpoint, user_id, model_name)
     
     return response
     
+@_traced
+def train_MNIST_sweep_api(body):
+    """ Train one MNIST model per combination of the lists in body, see
+    SweepScheduler. Waits until all models are trained and returns
+    response['jobs'] = [{'model_name', 'config', 'state', 'score', 'message'}]
+    and response['best'] = the model_name with the highest score."""
+    
+    #check keys in body dict
+    keys_list = body.keys()
+    
+    #checking endpoint - optional, the train_mnist_model route
+    if 'endpoint' in keys_list:
+        endpoint = body['endpoint']
+    else:
+        endpoint = SERVER_URL + '/train_mnist_model'
+    
+    #checking 'sweep_concurrency' - optional, models trained at the same time
+    if 'sweep_concurrency' in keys_list:
+        concurrency = int(body['sweep_concurrency'])
+    else:
+        concurrency = None
+    
+    #checking 'sweep_rate' - optional, training requests per second
+    if 'sweep_rate' in keys_list:
+        rate = float(body['sweep_rate'])
+    else:
+        rate = None
+    
+    #checking 'sweep_deadline' - optional, seconds a model may train
+    if 'sweep_deadline' in keys_list:
+        deadline = float(body['sweep_deadline'])
+    else:
+        deadline = None
+    
+    #checking 'score_fn' - optional, score_fn(job) of the downloaded results, higher is better
+    if 'score_fn' in keys_list:
+        score_fn = body['score_fn']
+    else:
+        score_fn = None
+    
+    sweep = SweepScheduler(dict({key: value for key, value in body.items() if key != 'score_fn'}, endpoint=endpoint),
+                           concurrency=concurrency, rate=rate, deadline=deadline, score_fn=score_fn)
+    jobs = sweep.results()
+    best = sweep.best()
+    failed = [job for job in jobs if job.state == 'failed']
+    response = {"error": "Warning" if failed else "None",
+                "message": str(len(jobs)) + " models in the sweep, " + str(len(failed)) + " failed.",
+                "jobs": [{'model_name': job.model_name, 'config': job.config, 'state': job.state, 'score': job.score,
+                          'message': job.response.get('message') if isinstance(job.response, dict) else None}
+                         for job in jobs],
+                "best": best.model_name if best is not None else None}
+    return response
  
 #######
+@_traced
 def download_MNIST_results_api(body):
     """ Train MNIST model on the server, Berk version"""
     
@@ -909,9 +5007,542 @@ def download_MNIST_results_api(body):
     else:
         return{"error": "Error", "message": "Please provide model_name."}
     
+    #checking 'client' - optional, get_client() is used by default
+    if 'client' in keys_list:
+        client = body['client']
+    else:
+        client = None
+    
     response = _download_MNIST_results(endpoint = endpoint,
                             user_id = user_id,
-                            model_name = model_name)
+                            model_name = model_name,
+                            client = client)
     
     return response
-  
+
+##################### ASYNCIO API #####################
+# AsyncNgqClient sends its requests with httpx (python3 -m pip install httpx),
+# imported when the first async request is sent.
+ASYNC_MAX_CONCURRENCY = 32     # requests in flight at the same time in an AsyncNgqClient
+
+def _httpx():
+    """The httpx module; ImportError with the install hint if it is missing."""
+    try:
+        import httpx
+    except ImportError:
+        raise ImportError("ngq.AsyncNgqClient needs httpx: python3 -m pip install httpx")
+    return httpx
+
+class _AsyncResponse:
+    """An httpx response with the attributes of a requests.Response used by
+    _http_error, _decode, _lean_response and RetryPolicy."""
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.reason = response.reason_phrase
+        self.url = str(response.url)
+        self.headers = response.headers
+        self.content = response.content
+
+    def json(self):
+        return json.loads(self.content)
+
+class _AsyncBody:
+    """Async iterable of a request body (_MultipartStream, _TarStream): the
+    files are read in a worker thread, so the event loop does not wait for
+    the disk. Like the body, it can be iterated again to retry a request.
+    The send phase is timed as by _TimedBody."""
+
+    def __init__(self, body):
+        self.body = body
+        self.sent = 0
+        self.send_seconds = 0.0
+        self.finished = None    # perf_counter() after the last piece
+
+    async def __aiter__(self):
+        import asyncio
+        self.sent, self.send_seconds, self.finished = 0, 0.0, None
+        blocks = iter(self.body)
+        end = object()
+        try:
+            while True:
+                block = await asyncio.to_thread(next, blocks, end)
+                if block is end:
+                    break
+                started = _perf_counter()
+                #a block of the reused read buffer is only valid until the next one is read
+                yield bytes(block)
+                self.send_seconds += _perf_counter() - started
+                self.sent += len(block)
+            self.finished = _perf_counter()
+        finally:
+            try:
+                blocks.close()
+            except ValueError:
+                #cancelled while next() runs in its thread, the files are closed with the generator
+                pass
+
+class AsyncNgqClient:
+    """asyncio client of the ngq server, with the body dicts and responses
+    of the *_api functions:
+
+        async with ngq.AsyncNgqClient(max_concurrency=64) as api:
+            response = await api.upload_dataset_to_server(body_upload)
+            response = await api.train_model_on_data(body_train)
+            response = await api.check_model_ready(body_check)
+            response = await api.get_labels(body_get_labels)
+            async for response in api.get_labels_stream(body_get_labels):
+                print(response)
+
+    The requests are sent with one httpx.AsyncClient, so many calls run
+    concurrently in one thread. At most max_concurrency requests are in
+    flight, on as many pooled connections; the others wait for their turn.
+    Failed requests are retried following retry (a RetryPolicy), with a
+    CircuitBreaker per server, as by NgqClient; the delays are awaited.
+    Cancelling a call (task.cancel(), asyncio.wait_for) closes the
+    connections of its requests at once; a cancelled upload can be resumed
+    with body['resume'] = 'True'. Only the reads of the uploaded files run
+    in worker threads.
+
+    The uploads are not compressed, and 'dedup', 'preflight' and
+    'image_resolution' are only supported by upload_dataset_to_server_api;
+    the prediction cache of get_labels_api is not used. Server replicas
+    (ServerPool) are not supported.
+    """
+
+    def __init__(self, max_concurrency=None, timeout=None, lean=None, retry=None, circuit_breaker=True):
+        self.max_concurrency = ASYNC_MAX_CONCURRENCY if max_concurrency is None else max_concurrency
+        self.timeout = TIMEOUT if timeout is None else timeout
+        self.lean = LEAN_PROTOCOL if lean is None else lean
+        self.retry = RetryPolicy() if retry is None else retry
+        self.circuit_breaker = circuit_breaker
+        self._breakers = {}         # server (scheme://host:port) -> CircuitBreaker
+        self._http = None
+        self._semaphore = None
+
+    def _session(self):
+        """The httpx.AsyncClient and the semaphore of the client, made on first use."""
+        import asyncio
+        if self._http is None:
+            httpx = _httpx()
+            _ensure_logging()
+            limits = httpx.Limits(max_connections=self.max_concurrency,
+                                  max_keepalive_connections=self.max_concurrency)
+            self._http = httpx.AsyncClient(limits=limits, timeout=self._timeout(self.timeout))
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._http
+
+    @staticmethod
+    def _timeout(timeout):
+        """httpx.Timeout of a requests timeout, seconds or (connect, read); no pool timeout,
+        the requests wait for the semaphore instead."""
+        httpx = _httpx()
+        if isinstance(timeout, tuple):
+            return httpx.Timeout(None, connect=timeout[0], read=timeout[1])
+        return httpx.Timeout(timeout, pool=None)
+
+    def breaker(self, url):
+        """The CircuitBreaker of the server of url, None if they are off."""
+        if not self.circuit_breaker:
+            return None
+        server = NgqClient._server(url)
+        breaker = self._breakers.get(server)
+        if breaker is None:
+            breaker = self._breakers[server] = CircuitBreaker()
+        return breaker
+
+    def _retry_exception(self, retry, exception, attempt, idempotent):
+        """RetryPolicy.retry_exception for the httpx exceptions."""
+        httpx = _httpx()
+        if attempt >= retry.retries:
+            return False
+        if isinstance(exception, httpx.ConnectTimeout):
+            return True
+        if isinstance(exception, httpx.TransportError):
+            return idempotent
+        return False
+
+    async def request(self, method, url, idempotent=None, retry=None, timeout=None, **kwargs):
+        """Send a request, see httpx.AsyncClient.request; returns an
+        _AsyncResponse. Retried and idempotent as NgqClient.request.
+        Raises CircuitOpenError while the circuit of the server is open."""
+        import asyncio
+        httpx = _httpx()
+        session = self._session()
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        if retry is None:
+            retry = self.retry
+        timeout = self._timeout(self.timeout if timeout is None else timeout)
+        attempt = 0
+        while True:
+            breaker = self.breaker(url)
+            if breaker is not None and not breaker.allow():
+                raise CircuitOpenError("The server of " + url + " is not available, next try in "
+                                       + str(round(breaker.retry_in(), 1)) + " s.")
+            try:
+                async with self._semaphore:
+                    started = _perf_counter()
+                    response = _AsyncResponse(await session.request(method, url, timeout=timeout, **kwargs))
+                    finished = _perf_counter()
+            except (asyncio.CancelledError, LocalFileError):
+                #not a failure of the server; a trial request lets the next one through
+                if breaker is not None:
+                    breaker.abandon()
+                raise
+            except httpx.HTTPError as ex:
+                local = _local_error(ex)
+                if local is not None:
+                    if breaker is not None:
+                        breaker.abandon()
+                    raise local
+                if breaker is not None:
+                    breaker.record_failure()
+                if not self._retry_exception(retry, ex, attempt, idempotent):
+                    raise
+                delay = retry.delay(attempt)
+                _http_logger.warning("[RETRY] " + method + " " + url + " failed: " + repr(ex) + ", retry in %.2f s", delay)
+            else:
+                if METRICS:
+                    body = kwargs.get('content')
+                    if isinstance(body, _AsyncBody) and body.finished is not None:
+                        _record('send', body.send_seconds, nbytes=body.sent)
+                        _record('server_wait', finished - body.finished)
+                    else:
+                        _record('server_wait', finished - started)
+                if breaker is not None:
+                    if response.status_code >= 500:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                if not retry.retry_response(response, attempt, idempotent):
+                    return response
+                delay = retry.delay(attempt, response)
+                _http_logger.warning("[RETRY] " + method + " " + url + " answered " + str(response.status_code)
+                               + ", retry in %.2f s", delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    ########## upload ##########
+    async def _upload_chunk(self, endpoint, user_id, data_id, chunk, packed=False):
+        """async _upload_data_files_chunk(...), without compression."""
+        if packed:
+            files = _TarStream(chunk)
+        else:
+            files = _MultipartStream([_file_part('files', file) for file in chunk])
+        api_url = endpoint + _upload_query(user_id, data_id, packed)
+        #the key lets the server recognize a chunk sent again after a failure
+        headers = {'Content-Type': files.content_type, 'Content-Length': str(len(files)),
+                   'Idempotency-Key': uuid.uuid4().hex}
+        response = await self.post(api_url, content=_AsyncBody(files), headers=headers, idempotent=True)
+        error = _http_error(response)
+        if error is not None:
+            return error
+        lean = _lean_response(self, response)
+        if lean is not None:
+            return lean
+        #getting status and data_id
+        response = await self.get(api_url)
+        error = _http_error(response)
+        if error is not None:
+            return error
+        return _decode(response)
+
+    async def _upload_files(self, endpoint, user_id, data_id, file_list, workers=None, min_chunk_bytes=None,
+                            max_chunk_bytes=None, resume=False, packed=False, journal=None):
+        """async _upload_data_files(...): up to workers chunks are sent at the
+        same time; after the first failed chunk no new chunks are sent."""
+        import asyncio
+        if journal is None:
+            pass
+        elif resume:
+            file_list = journal.pending(file_list)
+        else:
+            journal.reset()
+        chunker = _AdaptiveChunker(min_bytes = min_chunk_bytes, max_bytes = max_chunk_bytes)
+        chunks = chunker.chunks(file_list)
+        workers = UPLOAD_WORKERS if workers is None else max(1, int(workers))
+
+        async def send_chunk(chunk, chunk_bytes):
+            started = time.monotonic()
+            ok = False
+            try:
+                try:
+                    response = await self._upload_chunk(endpoint, user_id, data_id, chunk, packed)
+                except LocalFileError as ex:
+                    _upload_logger.error("[UPLOAD] " + str(ex))
+                    for file in chunk:
+                        if file.name == ex.name and file.opener is None and file.data is None:
+                            _forget_listing(file.path)
+                    response = {"error": "Error", "message": str(ex)}
+                ok = response["error"] != "Error"
+            finally:
+                chunker.record(chunk_bytes, time.monotonic() - started, ok)
+            if ok and journal is not None:
+                journal.record(chunk)
+            return response
+
+        running = set()
+        failed = []
+        try:
+            while not failed:
+                #the files are listed in a worker thread, like they are read
+                item = await asyncio.to_thread(next, chunks, None)
+                if item is None:
+                    break
+                running.add(asyncio.ensure_future(send_chunk(*item)))
+                if len(running) >= workers:
+                    done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    failed += [task.result() for task in done if task.result()["error"] == "Error"]
+            if running:
+                done, running = await asyncio.wait(running)
+                failed += [task.result() for task in done if task.result()["error"] == "Error"]
+        finally:
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.wait(running)
+        if failed:
+            return failed[0]
+        if journal is not None:
+            journal.remove()
+        return {"error": "None", "message": "Your data files were uploaded to the server."}
+
+    async def upload_dataset_to_server(self, body):
+        """async upload_dataset_to_server_api(body), see the class docstring for the options it lacks."""
+        import asyncio
+        #checking the body keys, with the defaults of upload_dataset_to_server_api
+        unsupported = [key for key in ('image_resolution',) if key in body]
+        unsupported += [key for key in ('dedup', 'preflight') if str(body.get(key)) == 'True']
+        if unsupported:
+            return {"error": "Error", "message": "\'" + "\', \'".join(unsupported) + "\' is not supported by "
+                    "AsyncNgqClient, use upload_dataset_to_server_api."}
+        endpoint = body.get('endpoint', 'https://my-qml.org/upload_data')
+        user_id = body.get('user_id', 'None')
+        data_id = body.get('data_id', 'None')
+        transfer_mode = body.get('transfer_mode', 'files')
+        if transfer_mode not in ('files', 'packed'):
+            return {"error": "Error", "message": "Transfer mode \'" + str(transfer_mode) + "\' is not supported. Use \'files\' or \'packed\'."}
+        dataset_dir = _dataset_from_body(body, body.get('dataset_dir', 'None'))
+        journal = _UploadJournal(user_id, data_id, dataset_dir)
+        return await self._upload_files(endpoint, user_id, data_id,
+                                        file_list = await asyncio.to_thread(_dataset_files, dataset_dir),
+                                        workers = body.get('upload_workers'),
+                                        min_chunk_bytes = body.get('chunk_min_bytes'),
+                                        max_chunk_bytes = body.get('chunk_max_bytes'),
+                                        resume = str(body.get('resume')) == 'True',
+                                        packed = transfer_mode == 'packed',
+                                        journal = journal)
+
+    ########## training ##########
+    async def train_model_on_data(self, body):
+        """async train_model_on_data_api(body)"""
+        #checking the body keys, with the defaults of train_model_on_data_api
+        endpoint = body.get('endpoint', 'https://24.199.84.84/train_model_on_data')
+        user_id = body.get('user_id', 'None')
+        model_name = body.get('model_name', 'None')
+        query_string = _train_query(user_id, body.get('data_id', 'None'), model_name, body.get('num_classes', 'None'))
+        if isinstance(query_string, dict):
+            return query_string
+        #sending request to train model, not repeated unless the server did not process it
+        response = await self.post(endpoint + query_string)
+        #the cached labels and readiness of the old model are not valid anymore
+        _forget_model(endpoint, user_id, model_name)
+        error = _http_error(response)
+        if error is not None:
+            return error
+        return _decode(response)
+
+    ########## readiness ##########
+    async def _check_model_ready(self, endpoint, user_id, model_name, long_poll=0):
+        """async _check_model_ready(...)"""
+        query_string = _model_ready_query(user_id, model_name, long_poll)
+        if isinstance(query_string, dict):
+            return query_string
+        timeout = (TIMEOUT[0], long_poll + 30) if long_poll else None
+        response = await self.post(endpoint + query_string, timeout=timeout, idempotent=True)
+        error = _http_error(response)
+        if error is not None:
+            return error
+        return _decode(response)
+
+    async def _check_model_ready_once(self, endpoint, user_id, model_name):
+        """async _check_model_ready_once(...)"""
+        key = _PredictionCache.model_key(endpoint, user_id, model_name)
+        if self.lean:
+            with _ready_models_lock:
+                if key in _ready_models:
+                    return _ready_models[key]
+        response = await self._check_model_ready(endpoint, user_id, model_name)
+        if self.lean and response["error"] == "None":
+            with _ready_models_lock:
+                _ready_models[key] = response
+        return response
+
+    async def wait_model_ready(self, endpoint, user_id, model_name, deadline=None, long_poll=None):
+        """async wait_model_ready(...): the waits between the checks are awaited."""
+        import asyncio
+        deadline = WAIT_DEADLINE if deadline is None else deadline
+        long_poll = WAIT_LONG_POLL if long_poll is None else long_poll
+        stop_at = time.monotonic() + deadline
+        delays = _backoff_delays()
+        while True:
+            started = time.monotonic()
+            poll = round(min(long_poll, max(0.0, stop_at - started)), 1) if long_poll else 0
+            response = await self._check_model_ready(endpoint, user_id, model_name, long_poll=poll)
+            if response["error"] != "Warning":
+                return response
+            now = time.monotonic()
+            if now >= stop_at:
+                return response
+            delay = next(delays)
+            if poll and now - started >= poll / 2:
+                #the server held the request, ask again at once
+                delay = 0.0
+            await asyncio.sleep(min(delay, stop_at - now))
+
+    async def check_model_ready(self, body):
+        """async check_model_ready_api(body); with body['keep_trying'] = 'True'
+        the model is checked until it is ready, see wait_model_ready."""
+        #checking the body keys, with the defaults of check_model_ready_api
+        endpoint = body.get('endpoint', 'https://24.199.84.84/check_model_ready')
+        user_id = body.get('user_id', 'None')
+        model_name = body.get('model_name', 'None')
+        if body.get('keep_trying') != 'True':
+            return await self._check_model_ready(endpoint, user_id, model_name)
+        return await self.wait_model_ready(endpoint, user_id, model_name,
+                                           deadline = float(body['deadline']) if 'deadline' in body else None,
+                                           long_poll = float(body['long_poll']) if 'long_poll' in body else None)
+
+    ########## labeling ##########
+    async def _delete_data(self, endpoint, user_id, data_id):
+        """async _delete_data(...)"""
+        try:
+            response = await self.post(_delete_data_url(endpoint, user_id, data_id), idempotent=True)
+        except (_httpx().HTTPError, CircuitOpenError) as ex:
+            error = {"error": "Error", "message": "Deleting " + str(data_id) + " failed: " + repr(ex)}
+        else:
+            error = _http_error(response)
+        if error is not None:
+            _labels_logger.warning("[LABELS] temporary data " + str(data_id) + " was not deleted: " + error["message"])
+        return error
+
+    async def _label_files(self, endpoint, user_id, model_name, data_id, file_list, names=None):
+        """Upload file_list to the temporary data_id, label it and delete it.
+        With names, only the labels of those files are returned."""
+        import asyncio
+        response = await self._upload_files(_change_route(endpoint, '/upload_data'), user_id, data_id, file_list)
+        if response["error"] != "Error":
+            query_string = _labels_query(user_id, model_name, data_id)
+            if isinstance(query_string, dict):
+                response = query_string
+            else:
+                response = await self._request_labels(endpoint + query_string)
+        else:
+            _labels_logger.error("[LABELS] upload of the files to label failed: " + str(response.get("message")))
+        #the files are deleted even if the call is cancelled
+        await asyncio.shield(self._delete_data(endpoint, user_id, data_id))
+        if names is not None and isinstance(response.get('labels'), dict):
+            labels = response['labels']
+            response['labels'] = {name: labels[name] for name in names if name in labels}
+        return response
+
+    async def _request_labels(self, api_url):
+        """async _request_labels(...) of a labeling api_url"""
+        response = await self.post(api_url, idempotent=True)
+        error = _http_error(response)
+        if error is not None:
+            return error
+        lean = _lean_response(self, response, require='labels')
+        if lean is not None:
+            return lean
+        #getting status and labels dictionary
+        response = await self.get(api_url)
+        error = _http_error(response)
+        if error is not None:
+            return error
+        return _decode(response)
+
+    async def get_labels(self, body):
+        """async get_labels_api(body), without the prediction cache. The
+        files are uploaded to a temporary data_id of their own, so that
+        concurrent calls do not label each other's files."""
+        import asyncio
+        #checking the body keys, with the defaults of get_labels_api
+        endpoint = body.get('endpoint', 'https://24.199.84.84/get_labels')
+        user_id = body.get('user_id', 'None')
+        model_name = body.get('model_name', 'None')
+        #check if model exists and ready
+        response = await self._check_model_ready_once(_change_route(endpoint, '/check_model_ready'), user_id, model_name)
+        if response["error"] != "None":
+            return response
+        dataset_dir = _dataset_from_body(body, body.get('dataset_dir', 'None'))
+        file_list = await asyncio.to_thread(list, _dataset_files(dataset_dir))
+        return await self._label_files(endpoint, user_id, model_name,
+                                       'TMP_SET_TO_LABEL_' + uuid.uuid4().hex[:8], file_list)
+
+    async def get_labels_stream(self, body):
+        """async generator version of get_labels_stream_api(body): the
+        upload of batch N+1 runs while batch N is labeled."""
+        import asyncio
+        #checking the body keys, with the defaults of get_labels_api
+        endpoint = body.get('endpoint', 'https://24.199.84.84/get_labels')
+        user_id = body.get('user_id', 'None')
+        model_name = body.get('model_name', 'None')
+        batch_files = int(body.get('batch_files') or LABEL_BATCH_FILES)
+        response = await self._check_model_ready_once(_change_route(endpoint, '/check_model_ready'), user_id, model_name)
+        if response["error"] != "None":
+            yield response
+            return
+        files = iter(_dataset_files(_dataset_from_body(body, body.get('dataset_dir', 'None'))))
+        tmp_data_id = 'TMP_SET_TO_LABEL_' + uuid.uuid4().hex[:8] + '_'
+
+        async def label(n, batch):
+            names = [file.name for file in batch]
+            response = await self._label_files(endpoint, user_id, model_name, tmp_data_id + str(n), batch, names)
+            response['batch'] = n
+            response['files'] = names
+            return response
+
+        running = []    # the labeling of the last two batches, the oldest first
+        n = 0
+        try:
+            while True:
+                batch = await asyncio.to_thread(lambda: [file for _, file in zip(range(batch_files), files)])
+                if batch:
+                    running.append(asyncio.ensure_future(label(n, batch)))
+                    n += 1
+                elif not running:
+                    return
+                if len(running) >= 2 or not batch:
+                    response = await running.pop(0)
+                    yield response
+                    if response["error"] == "Error":
+                        return
+        finally:
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.wait(running)
+
+    async def close(self):
+        """Close the connections."""
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+_IMPORT_FINISHED = _perf_counter()
+if startup_time() > STARTUP_BUDGET:
+    _diagnostics_logger.warning("[IMPORT] import took %.3f s, startup budget is %.3f s", startup_time(), STARTUP_BUDGET)
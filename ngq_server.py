@@ -0,0 +1,505 @@
+# This software is distributed under MIT license, https://mit-license.org
+# The newest verion can be downloaded at https://github.com/gvkolmakov/qml-api
+# Please email G.Kolmakov with any questions at german@ngq.io
+
+"""
+Local stand-in for the ngq server, for testing and benchmarking ngq.py
+without my-qml.org. Nothing is trained: a model gets ready --train-seconds
+after the training request, and the label of a file is derived from the
+hash of its content, so the labels are reproducible.
+
+Usage:
+    python3 ngq_server.py --port 5000 --latency 0.02 --bandwidth 10M
+    python3 ngq_server.py --fail-rate 0.2 --retry-after 1    # fault injection
+    python3 ngq_server.py --no-compression                   # no gzip/zstd bodies
+
+    export NGQ_SERVER_URL=http://127.0.0.1:5000
+    and use http://127.0.0.1:5000/<route> as 'endpoint' in the api bodies.
+
+Routes: /upload_data, /upload_manifest, /delete_data, /train_model_on_data,
+/train_mnist_model, /check_model_ready, /get_labels, /server_version,
+/post_log, /download_mnist_results, /stats. Only the standard library is
+used; zstd bodies are supported if the 'zstandard' module is installed.
+"""
+
+import argparse, gzip, hashlib, io, json, random, re, sys, tarfile, threading, time, uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+SERVER_VERSION = "202506130"    # ngq.VERSION of the matching client
+SERVER_MINOR_VERSION = "stand-in"
+BLOCK_SIZE = 64 * 1024          # read/write block size, the unit of the bandwidth limit
+COMPRESS_MIN_BYTES = 1024       # smaller responses are not compressed
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ENCODINGS = ['zstd', 'gzip'] if zstandard is not None else ['gzip']
+
+def decode(body, encoding):
+    """body decoded from Content-Encoding encoding; ValueError if it is not supported."""
+    if encoding in ('', 'identity'):
+        return body
+    if encoding == 'gzip':
+        return gzip.decompress(body)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    raise ValueError('Unsupported Content-Encoding ' + encoding)
+
+def encode(data, encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+def mnist_accuracy(params):
+    """Made-up accuracy of an MNIST training, growing with the training set
+    size, the epochs and the resolution, as a string. The parameters are
+    lists as sent by the client, f.e. '[100]'; a list gives the first value."""
+    def first(key, default):
+        try:
+            return float(re.findall(r'[0-9.]+', params.get(key, ''))[0])
+        except IndexError:
+            return default
+    size, epochs, resolution = first('training_size', 1000), first('epochs', 10), first('image_resolution', 28)
+    accuracy = 0.99 * (1 - 1 / (1 + size / 500)) * (1 - 1 / (1 + epochs / 2)) * (1 - 1 / (1 + resolution / 4))
+    return '%.4f' % accuracy
+
+########## STATE ##########
+class _State:
+    """In-memory state of the server, shared by the handler threads."""
+
+    def __init__(self, train_seconds):
+        self.train_seconds = train_seconds
+        self.lock = threading.Lock()
+        self.datasets = {}      # (user_id, data_id): {filename: content hash}
+        self.blobs = set()      # content hashes received
+        self.models = {}        # (user_id, model_name): {'ready_at', 'num_classes', 'data_id'}
+        self.idempotency_keys = {}     # Idempotency-Key: response of the processed request
+        self.stats = {'requests': 0, 'bytes_in': 0, 'bytes_in_decoded': 0, 'bytes_out': 0, 'files': 0,
+                      'failures': 0, 'repeated_requests': 0, 'label_requests': 0, 'labeled_files': 0,
+                      'aborted_requests': 0}
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def add_files(self, user_id, data_id, files):
+        """files is a list of (filename, content bytes)."""
+        with self.lock:
+            dataset = self.datasets.setdefault((user_id, data_id), {})
+            for name, data in files:
+                digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+                dataset[name] = digest
+                self.blobs.add(digest)
+            self.stats['files'] += len(files)
+            return len(dataset)
+
+    def replay(self, key):
+        """The response to the processed request with this Idempotency-Key, else None."""
+        with self.lock:
+            response = self.idempotency_keys.get(key)
+            if response is not None:
+                self.stats['repeated_requests'] += 1
+            return response
+
+    def remember(self, key, response):
+        """The request with this Idempotency-Key was processed, with response."""
+        with self.lock:
+            self.idempotency_keys[key] = response
+
+    def delete(self, user_id, data_id):
+        """Remove the dataset, return the number of its files."""
+        with self.lock:
+            return len(self.datasets.pop((user_id, data_id), {}))
+
+    def link_files(self, user_id, data_id, manifest):
+        """Link the files of a manifest {filename: hash} to the blobs already
+        received, return the hashes that are missing."""
+        with self.lock:
+            dataset = self.datasets.setdefault((user_id, data_id), {})
+            missing = []
+            for name, digest in manifest.items():
+                if digest in self.blobs:
+                    dataset[name] = digest
+                else:
+                    missing.append(digest)
+            return sorted(set(missing))
+
+    def train(self, user_id, model_name, data_id, num_classes, params=None):
+        with self.lock:
+            self.models[(user_id, model_name)] = {'ready_at': time.monotonic() + self.train_seconds,
+                                                  'num_classes': num_classes,
+                                                  'data_id': data_id,
+                                                  'params': params or {}}
+
+    def model(self, user_id, model_name):
+        with self.lock:
+            return self.models.get((user_id, model_name))
+
+    def labels(self, user_id, data_id, num_classes):
+        with self.lock:
+            dataset = dict(self.datasets.get((user_id, data_id), {}))
+        return {name: str(int(digest, 16) % num_classes) for name, digest in sorted(dataset.items())}
+
+########## BODY PARSING ##########
+_FILENAME = re.compile(rb'filename="([^"]*)"')
+_NAME = re.compile(rb'\bname="([^"]*)"')
+
+def parse_multipart(body, content_type):
+    """Return [(field, filename or None, data)] of a multipart/form-data body.
+    Raises ValueError if the body ends before its closing boundary."""
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if match is None:
+        return []
+    delimiter = b'--' + match.group(1).encode('latin-1')
+    parts = []
+    for part in body.split(delimiter)[1:] + [None]:
+        if part is None:
+            raise ValueError('The multipart body ends before its closing boundary.')
+        if part.startswith(b'--'):
+            break
+        head, _, data = part.partition(b'\r\n\r\n')
+        if data.endswith(b'\r\n'):
+            data = data[:-2]
+        name = _NAME.search(head)
+        filename = _FILENAME.search(head)
+        parts.append((name.group(1).decode('utf-8') if name else None,
+                      filename.group(1).decode('utf-8') if filename else None,
+                      data))
+    return parts
+
+def parse_tar(body):
+    """Return [(filename, data)] of the regular files of a tar body."""
+    files = []
+    with tarfile.open(fileobj=io.BytesIO(body), mode='r:*') as archive:
+        for member in archive:
+            if member.isfile():
+                files.append((member.name, archive.extractfile(member).read()))
+    return files
+
+########## HANDLER ##########
+class Handler(BaseHTTPRequestHandler):
+    """Request handler; the server options are class attributes set by make_server."""
+
+    protocol_version = 'HTTP/1.1'   # keep-alive, as the real server
+    state = None
+    latency = 0.0                   # seconds added to each response
+    bandwidth = 0                   # bytes/s of each connection, 0 = unlimited
+    fail_rate = 0.0                 # fraction of the requests answered with fail_status
+    fail_status = 503
+    retry_after = None              # Retry-After header of the failed requests, seconds
+    compression = True              # accept and send gzip/zstd bodies
+    quiet = True
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _throttle(self, nbytes, started):
+        if self.bandwidth:
+            delay = nbytes / self.bandwidth - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+    def _read_exact(self, n):
+        """n bytes of the request body; EOFError if the client stops before."""
+        data = bytearray()
+        started = time.monotonic()
+        while len(data) < n:
+            block = self.rfile.read(min(BLOCK_SIZE, n - len(data)))
+            if not block:
+                raise EOFError('The request body ends after ' + str(len(data)) + ' of ' + str(n) + ' bytes.')
+            data += block
+            self._throttle(len(data), started)
+        return bytes(data)
+
+    def _read_body(self):
+        """Request body, with Content-Length or chunked transfer encoding;
+        EOFError if it is cut short."""
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            data = bytearray()
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    raise EOFError('The chunked request body ends without its last chunk.')
+                size = int(line.split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                data += self._read_exact(size)
+                self.rfile.readline()
+            body = bytes(data)
+        else:
+            body = self._read_exact(int(self.headers.get('Content-Length', 0)))
+        self.state.count('bytes_in', len(body))
+        return body
+
+    def _response_encoding(self, data):
+        """Encoding of the response, from the Accept-Encoding of the request; None = not compressed."""
+        if not self.compression or len(data) < COMPRESS_MIN_BYTES:
+            return None
+        accepted = [item.split(';')[0].strip().lower() for item in self.headers.get('Accept-Encoding', '').split(',')]
+        for encoding in ENCODINGS:
+            if encoding in accepted:
+                return encoding
+        return None
+
+    def _send(self, data, content_type='application/json', code=200, headers=None):
+        if self.latency:
+            time.sleep(self.latency)
+        encoding = self._response_encoding(data)
+        if encoding is not None:
+            data = encode(data, encoding)
+        self.send_response(code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if self.compression:
+            #encodings accepted in request bodies (RFC 7694)
+            self.send_header('Accept-Encoding', ', '.join(ENCODINGS))
+            self.send_header('Vary', 'Accept-Encoding')
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        started = time.monotonic()
+        for i in range(0, len(data), BLOCK_SIZE):
+            self.wfile.write(data[i:i + BLOCK_SIZE])
+            self._throttle(i + BLOCK_SIZE, started)
+        self.state.count('bytes_out', len(data))
+
+    def _reply(self, obj, code=200, headers=None):
+        self._replied = (obj, code)
+        self._send(json.dumps(obj).encode('utf-8'), code=code, headers=headers)
+
+    def do_GET(self):
+        self._dispatch('GET', b'')
+
+    def do_POST(self):
+        try:
+            body = self._read_body()
+        except (EOFError, ValueError) as e:
+            #an aborted body: nothing is processed, the Idempotency-Key stays unused
+            self.state.count('requests')
+            self.state.count('aborted_requests')
+            self.close_connection = True
+            try:
+                self._reply({'error': 'Error', 'message': str(e)}, code=400)
+            except OSError:
+                pass    # the client is gone
+            return
+        self._dispatch('POST', body)
+
+    def _dispatch(self, method, body):
+        self.state.count('requests')
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        route = getattr(self, 'route_' + url.path.strip('/'), None)
+        if route is None:
+            return self._reply({'error': 'Error', 'message': 'Unknown route ' + url.path}, code=404)
+        #compressed request body
+        encoding = self.headers.get('Content-Encoding', '').strip().lower()
+        if encoding:
+            try:
+                if not self.compression:
+                    raise ValueError('Compressed request bodies are not supported')
+                body = decode(body, encoding)
+            except (ValueError, OSError, EOFError) as e:
+                return self._reply({'error': 'Error', 'message': str(e)}, code=415)
+        self.state.count('bytes_in_decoded', len(body))
+        #fault injection: the request is read, then answered with an error and not processed
+        if self.fail_rate and route != self.route_stats and random.random() < self.fail_rate:
+            self.state.count('failures')
+            headers = {'Retry-After': str(self.retry_after)} if self.retry_after is not None else None
+            return self._reply({'error': 'Error', 'message': 'Injected failure.'}, code=self.fail_status, headers=headers)
+        #a repeated request (same Idempotency-Key) gets the response of the
+        #processed one, the files are not stored again
+        key = self.headers.get('Idempotency-Key') if method == 'POST' else None
+        if key is not None:
+            replied = self.state.replay(key)
+            if replied is not None:
+                return self._reply(replied)
+        self._replied = None
+        try:
+            route(method, query, body)
+        except ValueError as e:
+            return self._reply({'error': 'Error', 'message': str(e)}, code=400)
+        except Exception as e:
+            return self._reply({'error': 'Error', 'message': repr(e)}, code=500)
+        #the key is used once the request was processed
+        if key is not None and self._replied is not None and self._replied[1] == 200:
+            self.state.remember(key, self._replied[0])
+
+    def _missing(self, query, *keys):
+        """Error response for the first of keys missing in query, or None."""
+        for key in keys:
+            if key not in query:
+                return {'error': 'Error', 'message': key + ' missing.'}
+        return None
+
+    ########## ROUTES ##########
+    def route_upload_data(self, method, query, body):
+        error = self._missing(query, 'user_id')
+        if error:
+            return self._reply(error)
+        user_id = query['user_id']
+        data_id = query.get('data_id') or uuid.uuid4().hex[:12]
+        if method == 'POST':
+            if query.get('packed') == 'tar':
+                files = parse_tar(body)
+            else:
+                content_type = self.headers.get('Content-Type', '')
+                files = [(filename, data) for field, filename, data in parse_multipart(body, content_type)
+                         if filename is not None]
+            total = self.state.add_files(user_id, data_id, files)
+            return self._reply({'error': 'None', 'data_id': data_id,
+                                'message': str(len(files)) + ' files uploaded, ' + str(total) + ' files in ' + data_id})
+        total = len(self.state.datasets.get((user_id, data_id), {}))
+        self._reply({'error': 'None', 'data_id': data_id, 'message': str(total) + ' files in ' + data_id})
+
+    def route_upload_manifest(self, method, query, body):
+        error = self._missing(query, 'user_id', 'data_id')
+        if error:
+            return self._reply(error)
+        manifest = json.loads(body)
+        missing = self.state.link_files(query['user_id'], query['data_id'], manifest['files'])
+        self._reply({'error': 'None', 'missing': missing})
+
+    def route_train_model_on_data(self, method, query, body):
+        error = self._missing(query, 'user_id', 'data_id', 'model_name')
+        if error:
+            return self._reply(error)
+        if (query['user_id'], query['data_id']) not in self.state.datasets:
+            return self._reply({'error': 'Error', 'message': 'Dataset ' + query['data_id'] + ' not found.'})
+        self.state.train(query['user_id'], query['model_name'], query['data_id'],
+                         int(query.get('num_classes', 10)))
+        self._reply({'error': 'None', 'message': 'Training of ' + query['model_name'] + ' started.'})
+
+    def route_train_mnist_model(self, method, query, body):
+        error = self._missing(query, 'user_id', 'model_name')
+        if error:
+            return self._reply(error)
+        params = {key: query[key] for key in ('model_type', 'training_size', 'batch_size', 'epochs', 'image_resolution')
+                  if key in query}
+        self.state.train(query['user_id'], query['model_name'], 'MNIST', 10, params)
+        self._reply({'error': 'None', 'message': 'Training of ' + query['model_name'] + ' started.'})
+
+    def route_check_model_ready(self, method, query, body):
+        error = self._missing(query, 'user_id', 'model_name')
+        if error:
+            return self._reply(error)
+        model = self.state.model(query['user_id'], query['model_name'])
+        if model is None:
+            return self._reply({'error': 'Error', 'message': 'Model ' + query['model_name'] + ' not found.'})
+        #long poll: hold the request up to 'wait' seconds until the model is ready
+        deadline = time.monotonic() + float(query.get('wait', 0))
+        while time.monotonic() < min(deadline, model['ready_at']):
+            time.sleep(min(0.05, model['ready_at'] - time.monotonic()))
+        if time.monotonic() < model['ready_at']:
+            return self._reply({'error': 'Warning', 'message': 'Model ' + query['model_name'] + ' is training.'})
+        self._reply({'error': 'None', 'message': 'Model ' + query['model_name'] + ' is ready.'})
+
+    def route_get_labels(self, method, query, body):
+        error = self._missing(query, 'user_id', 'model_name', 'data_id')
+        if error:
+            return self._reply(error)
+        model = self.state.model(query['user_id'], query['model_name'])
+        if model is None:
+            return self._reply({'error': 'Error', 'message': 'Model ' + query['model_name'] + ' not found.'})
+        if time.monotonic() < model['ready_at']:
+            return self._reply({'error': 'Warning', 'message': 'Model ' + query['model_name'] + ' is training.'})
+        labels = self.state.labels(query['user_id'], query['data_id'], model['num_classes'])
+        self.state.count('label_requests')
+        self.state.count('labeled_files', len(labels))
+        self._reply({'error': 'None', 'message': str(len(labels)) + ' files labeled.', 'labels': labels})
+
+    def route_delete_data(self, method, query, body):
+        error = self._missing(query, 'user_id', 'data_id')
+        if error:
+            return self._reply(error)
+        removed = self.state.delete(query['user_id'], query['data_id'])
+        self._reply({'error': 'None', 'message': str(removed) + ' files deleted.'})
+
+    def route_server_version(self, method, query, body):
+        #like the real server, POST only
+        if method != 'POST':
+            return self._reply({'error': 'Error', 'message': 'Method not allowed.'}, code=405, headers={'Allow': 'POST'})
+        self._reply({'error': 'None', 'server_version': SERVER_VERSION,
+                     'server_minor_version': SERVER_MINOR_VERSION})
+
+    def route_post_log(self, method, query, body):
+        self._reply({'error': 'None', 'message': 'Log received.'})
+
+    def route_download_mnist_results(self, method, query, body):
+        error = self._missing(query, 'user_id', 'model_name')
+        if error:
+            return self._reply(error)
+        model = self.state.model(query['user_id'], query['model_name'])
+        if model is None:
+            return self._reply({'error': 'Error', 'message': 'Model ' + query['model_name'] + ' not found.'})
+        text = 'model_name = ' + query['model_name'] + '\naccuracy = ' + mnist_accuracy(model['params']) + '\n'
+        self._send(text.encode('utf-8'), content_type='text/plain')
+
+    def route_stats(self, method, query, body):
+        with self.state.lock:
+            stats = dict(self.state.stats)
+        self._reply(stats)
+
+def make_server(host='127.0.0.1', port=5000, latency=0.0, bandwidth=0, train_seconds=1.0, quiet=True,
+                fail_rate=0.0, fail_status=503, retry_after=None, compression=True):
+    """Return a ThreadingHTTPServer, not started yet; port 0 picks a free port."""
+    handler = type('Handler', (Handler,), {'state': _State(train_seconds),
+                                           'latency': latency,
+                                           'bandwidth': bandwidth,
+                                           'fail_rate': fail_rate,
+                                           'fail_status': fail_status,
+                                           'retry_after': retry_after,
+                                           'compression': compression,
+                                           'quiet': quiet})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+def _parse_bytes(text):
+    """'10M' -> 10485760"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.strip().upper()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(float(text))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local stand-in for the ngq server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to each response')
+    parser.add_argument('--bandwidth', type=_parse_bytes, default=0,
+                        help='bytes/s of each connection, f.e. 10M; 0 = unlimited')
+    parser.add_argument('--train-seconds', type=float, default=1.0, help='seconds until a model is ready')
+    parser.add_argument('--fail-rate', type=float, default=0.0,
+                        help='fraction of the requests answered with --fail-status, f.e. 0.1')
+    parser.add_argument('--fail-status', type=int, default=503)
+    parser.add_argument('--retry-after', type=float, default=None, help='Retry-After of the failed requests, seconds')
+    parser.add_argument('--no-compression', action='store_true',
+                        help='do not accept compressed request bodies, do not compress the responses')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the fault injection')
+    parser.add_argument('--verbose', action='store_true', help='log each request')
+    args = parser.parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+    server = make_server(args.host, args.port, args.latency, args.bandwidth, args.train_seconds,
+                         quiet=not args.verbose, fail_rate=args.fail_rate, fail_status=args.fail_status,
+                         retry_after=args.retry_after, compression=not args.no_compression)
+    print('ngq stand-in server at http://%s:%d' % server.server_address[:2], flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
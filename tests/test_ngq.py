@@ -0,0 +1,832 @@
+# This software is distributed under MIT license, https://mit-license.org
+# The newest verion can be downloaded at https://github.com/gvkolmakov/qml-api
+# Please email G.Kolmakov with any questions at german@ngq.io
+
+"""
+Tests of ngq.py against the local stand-in server ngq_server.py, started
+in this process on a free port. Run from the repository directory:
+    python3 -m pytest -q tests
+"""
+
+import io, json, os, random, sys, tempfile, threading, time, uuid
+
+#caches in a temporary directory, no log file; set before ngq is imported
+os.environ['NGQ_CACHE_DIR'] = tempfile.mkdtemp(prefix='ngq_test_cache_')
+os.environ['NGQ_LOG_FILE'] = ''
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import ngq
+import ngq_server
+
+USER_ID = 'test_user'
+
+########## FIXTURES ##########
+@pytest.fixture
+def start_server():
+    """start_server(**make_server options) -> (base url, Handler class of the server)"""
+    servers = []
+
+    def start(**options):
+        options.setdefault('train_seconds', 0)
+        server = ngq_server.make_server('127.0.0.1', 0, **options)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return 'http://127.0.0.1:%d' % server.server_address[1], server.RequestHandlerClass
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+@pytest.fixture
+def server(start_server):
+    return start_server()
+
+@pytest.fixture
+def client():
+    #no waiting between the retries
+    client = ngq.NgqClient(retry=ngq.RetryPolicy(backoff=0, jitter=0), servers=[])
+    yield client
+    client.close()
+
+def make_dataset(directory, n_files, size=256, seed=0):
+    """n_files files of random content in directory, returns the directory with a trailing '/'."""
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    for i in range(n_files):
+        with open(os.path.join(directory, 'file_%03d.png' % i), 'wb') as f:
+            f.write(bytes(rng.getrandbits(8) for _ in range(size)))
+    return str(directory) + '/'
+
+def stored_files(handler, data_id):
+    """Names of the files of data_id on the stand-in server."""
+    return sorted(handler.state.datasets.get((USER_ID, data_id), {}))
+
+def upload(url, dataset_dir, data_id, client, **options):
+    body = {'endpoint': url + '/upload_data', 'user_id': USER_ID, 'dataset_dir': dataset_dir,
+            'data_id': data_id, 'client': client}
+    body.update(options)
+    return ngq.upload_dataset_to_server_api(body)
+
+def train(url, data_id, model_name, client):
+    response = ngq.train_model_on_data_api({'endpoint': url + '/train_model_on_data', 'user_id': USER_ID,
+                                            'data_id': data_id, 'model_name': model_name, 'client': client})
+    assert response['error'] == 'None', response
+    return response
+
+########## RETRIES AND CIRCUIT BREAKER ##########
+def test_upload_succeeds_with_injected_failures(server, client, tmp_path):
+    url, handler = server
+    handler.fail_rate = 0.3
+    random.seed(1)
+    dataset_dir = make_dataset(tmp_path / 'data', 20)
+    response = upload(url, dataset_dir, 'flaky', client, chunk_min_bytes=1, chunk_max_bytes=1024)
+    assert response['error'] == 'None', response
+    assert handler.state.stats['failures'] > 0
+    assert len(stored_files(handler, 'flaky')) == 20
+
+def test_training_is_retried_only_if_not_processed(server, client, tmp_path):
+    url, handler = server
+    dataset_dir = make_dataset(tmp_path / 'data', 2)
+    assert upload(url, dataset_dir, 'd', client)['error'] == 'None'
+    body = {'endpoint': url + '/train_model_on_data', 'user_id': USER_ID, 'data_id': 'd',
+            'model_name': 'm', 'client': client}
+    handler.fail_rate = 1.0
+    #503: not processed, retried
+    handler.fail_status = 503
+    requests_before = handler.state.stats['requests']
+    response = ngq.train_model_on_data_api(body)
+    assert response['status_code'] == 503
+    assert handler.state.stats['requests'] - requests_before == client.retry.retries + 1
+    #500: may have been processed, not repeated
+    handler.fail_status = 500
+    requests_before = handler.state.stats['requests']
+    response = ngq.train_model_on_data_api(body)
+    assert response['status_code'] == 500
+    assert handler.state.stats['requests'] - requests_before == 1
+
+def test_retry_after_is_honoured():
+    class Response:
+        headers = {'Retry-After': '2'}
+    policy = ngq.RetryPolicy(backoff=0, jitter=0)
+    assert policy.delay(0, Response()) == 2.0
+    assert policy.delay(3) == 0.0
+
+def test_circuit_breaker_fails_fast():
+    client = ngq.NgqClient(retry=ngq.RetryPolicy(retries=0), servers=[])
+    dead = 'http://127.0.0.1:9/server_version'     # discard port, nothing listens
+    for _ in range(ngq.BREAKER_FAILURES):
+        with pytest.raises(ngq.requests.exceptions.ConnectionError):
+            client.get(dead)
+    assert client.breaker(dead).state == 'open'
+    with pytest.raises(ngq.CircuitOpenError):
+        client.get(dead)
+    client.close()
+
+def test_diagnostics_send_their_requests_once(server, monkeypatch):
+    url, handler = server
+    handler.fail_rate, handler.retry_after = 1.0, '5'
+    client = ngq.NgqClient(retry=ngq.RetryPolicy(retries=3), servers=[])
+    monkeypatch.setattr(ngq, '_client', client)
+    monkeypatch.setattr(ngq, 'SERVER_URL', url)
+    started = time.monotonic()
+    with pytest.raises(ngq.requests.exceptions.HTTPError):
+        ngq.check_server_version(timeout=2)
+    with pytest.raises(ngq.requests.exceptions.HTTPError):
+        ngq.client_post_log({}, timeout=2)
+    #no retries, which would wait for the Retry-After of the server
+    assert time.monotonic() - started < 2
+    assert handler.state.stats['requests'] == 2
+    client.close()
+
+def test_repeated_chunk_is_stored_once(server, client):
+    url, handler = server
+    body = ngq._MultipartStream([('files', 'a.png', 3, lambda: io.BytesIO(b'abc'))])
+    headers = {'Content-Type': body.content_type, 'Idempotency-Key': uuid.uuid4().hex}
+    api_url = url + '/upload_data?user_id=' + USER_ID + '&data_id=replay'
+    for _ in range(2):
+        assert client.post(api_url, data=body, headers=headers, idempotent=True).status_code == 200
+    assert handler.state.stats['repeated_requests'] == 1
+    assert handler.state.stats['files'] == 1
+
+def test_aborted_chunk_does_not_use_its_idempotency_key(server, client):
+    import socket
+    url, handler = server
+    body = ngq._MultipartStream([('files', 'a.png', 3, lambda: io.BytesIO(b'abc'))])
+    key = uuid.uuid4().hex
+    data = b''.join(bytes(block) for block in body)
+    path = '/upload_data?user_id=' + USER_ID + '&data_id=aborted'
+    #the connection is closed halfway through the chunked body
+    with socket.create_connection(('127.0.0.1', int(url.rsplit(':', 1)[1]))) as sock:
+        sock.sendall(('POST ' + path + ' HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n'
+                      'Content-Type: ' + body.content_type + '\r\nIdempotency-Key: ' + key + '\r\n\r\n').encode()
+                     + b'%x\r\n' % len(data) + data[:len(data) // 2])
+        sock.shutdown(socket.SHUT_WR)
+        assert b' 400 ' in sock.recv(4096).split(b'\r\n')[0] + b' '
+    assert stored_files(handler, 'aborted') == []
+    headers = {'Content-Type': body.content_type, 'Idempotency-Key': key}
+    response = client.post(url + path, data=body, headers=headers, idempotent=True)
+    assert response.status_code == 200
+    assert stored_files(handler, 'aborted') == ['a.png']
+    assert handler.state.stats['repeated_requests'] == 0
+
+def test_failed_upload_is_resumed(server, client, tmp_path):
+    url, handler = server
+    dataset_dir = make_dataset(tmp_path / 'data', 10)
+    #400: not retried, the upload stops with an error
+    handler.fail_rate, handler.fail_status = 0.5, 400
+    random.seed(3)
+    response = upload(url, dataset_dir, 'resumed', client, chunk_min_bytes=1, chunk_max_bytes=256)
+    assert response['error'] == 'Error'
+    sent_before = handler.state.stats['files']
+    assert sent_before < 10
+    handler.fail_rate = 0.0
+    response = upload(url, dataset_dir, 'resumed', client, resume='True', chunk_min_bytes=1, chunk_max_bytes=256)
+    assert response['error'] == 'None', response
+    assert len(stored_files(handler, 'resumed')) == 10
+    #only the files missing after the failure were sent again
+    assert handler.state.stats['files'] - sent_before == 10 - sent_before
+
+def test_journal_is_synced_in_batches(server, client, tmp_path, monkeypatch):
+    url, handler = server
+    dataset_dir = make_dataset(tmp_path / 'data', 10)
+    synced = []
+    monkeypatch.setattr(ngq.os, 'fsync', synced.append)
+    monkeypatch.setattr(ngq, 'JOURNAL_FSYNC_SECONDS', 60.0)
+    response = upload(url, dataset_dir, 'synced', client, chunk_min_bytes=1, chunk_max_bytes=256)
+    assert response['error'] == 'None', response
+    #one file per chunk
+    assert len(stored_files(handler, 'synced')) == 10
+    assert synced == []
+
+def test_journal_without_data_id_is_per_dataset(tmp_path):
+    first = ngq._UploadJournal(USER_ID, 'None', str(tmp_path / 'first') + '/')
+    second = ngq._UploadJournal(USER_ID, 'None', str(tmp_path / 'second') + '/')
+    scan = ngq._UploadJournal(USER_ID, 'None', ngq.DatasetScan(str(tmp_path / 'first'), recursive=True))
+    assert len({first.filename, second.filename, scan.filename}) == 3
+    assert ngq._UploadJournal(USER_ID, 'None', str(tmp_path / 'first') + '/').filename == first.filename
+    assert ngq._UploadJournal(USER_ID, 'd', str(tmp_path / 'first') + '/').filename == \
+           ngq._UploadJournal(USER_ID, 'd', str(tmp_path / 'second') + '/').filename
+
+########## DEDUP ##########
+@pytest.mark.parametrize('workers', [1, 4])
+def test_dedup_links_files_with_the_same_content(server, client, tmp_path, workers):
+    url, handler = server
+    dataset = tmp_path / 'data'
+    dataset.mkdir()
+    (dataset / 'a.txt').write_bytes(b'same content')
+    (dataset / 'b.txt').write_bytes(b'same content')
+    (dataset / 'c.txt').write_bytes(b'other content')
+    response = upload(url, str(dataset) + '/', 'dups', client, dedup='True', upload_workers=workers)
+    assert response['error'] == 'None', response
+    assert stored_files(handler, 'dups') == ['a.txt', 'b.txt', 'c.txt']
+    #the shared content was sent once
+    assert handler.state.stats['files'] == 2
+
+def test_dedup_skips_content_the_server_has(server, client, tmp_path):
+    url, handler = server
+    dataset_dir = make_dataset(tmp_path / 'data', 4)
+    assert upload(url, dataset_dir, 'first', client, dedup='True')['error'] == 'None'
+    assert upload(url, dataset_dir, 'second', client, dedup='True')['error'] == 'None'
+    assert stored_files(handler, 'second') == stored_files(handler, 'first')
+    assert handler.state.stats['files'] == 4
+
+########## LABELS ##########
+def test_labels_report_a_failed_upload(server, client, tmp_path):
+    url, handler = server
+    dataset_dir = make_dataset(tmp_path / 'data', 3)
+    assert upload(url, dataset_dir, 'd', client)['error'] == 'None'
+    train(url, 'd', 'm', client)
+    handler.fail_rate, handler.fail_status = 1.0, 400
+    response = ngq.get_labels_api({'endpoint': url + '/get_labels', 'user_id': USER_ID, 'dataset_dir': dataset_dir,
+                                   'model_name': 'm', 'client': client})
+    assert response['error'] == 'Error'
+    assert response['status_code'] == 400
+
+def test_prediction_cache_skips_labeled_files(server, client, tmp_path):
+    url, handler = server
+    dataset_dir = make_dataset(tmp_path / 'data', 5, seed=5)
+    assert upload(url, dataset_dir, 'd', client)['error'] == 'None'
+    train(url, 'd', 'cached_model', client)
+    body = {'endpoint': url + '/get_labels', 'user_id': USER_ID, 'dataset_dir': dataset_dir,
+            'model_name': 'cached_model', 'client': client, 'cache': 'True'}
+    first = ngq.get_labels_api(body)
+    assert first['error'] == 'None', first
+    assert len(first['labels']) == 5
+    files_sent = handler.state.stats['files']
+    second = ngq.get_labels_api(body)
+    assert second['labels'] == first['labels']
+    assert handler.state.stats['files'] == files_sent
+
+########## REPLICAS ##########
+def test_parallel_upload_stays_on_one_replica(start_server, tmp_path):
+    (url_1, handler_1), (url_2, handler_2) = start_server(latency=0.02), start_server(latency=0.02)
+    client = ngq.NgqClient(retry=ngq.RetryPolicy(backoff=0, jitter=0), servers=[url_1, url_2])
+    dataset_dir = make_dataset(tmp_path / 'data', 40)
+    try:
+        response = upload(url_1, dataset_dir, 'sticky', client, upload_workers=4,
+                          chunk_min_bytes=1, chunk_max_bytes=512)
+    finally:
+        client.close()
+    assert response['error'] == 'None', response
+    counts = sorted([len(stored_files(handler_1, 'sticky')), len(stored_files(handler_2, 'sticky'))])
+    assert counts == [0, 40]
+
+def test_route_is_reserved_by_the_first_request():
+    pool = ngq.ServerPool(['http://a', 'http://b'], interval=None)
+    for replica in pool.servers:
+        pool._update(replica, 0.1)
+    keys = pool.route_keys('http://a/upload_data?user_id=u&data_id=d')
+    server, reserved = pool.route(keys)
+    assert reserved
+    #a parallel request of the same data_id follows, although the other replica is less loaded
+    pool.started(server)
+    assert pool.route(keys) == (server, False)
+    #released when the first request fails
+    pool.release(keys, server)
+    pool.finished(server, None)
+    assert pool.route(keys) == ('http://b', True)
+
+def test_health_check_and_encoding_probe(start_server):
+    (url_1, _), (url_2, _) = start_server(), start_server()
+    client = ngq.NgqClient(servers=[url_1, url_2])
+    client.pool.interval = None         # no background checks
+    try:
+        assert client.pool.check(client.session) == 2
+        assert 'gzip' in client.accepted_encodings(url_1 + '/upload_data', probe=True)
+    finally:
+        client.close()
+
+########## SCANS ##########
+def test_file_rewritten_in_place_fails_then_is_listed_again(server, client, tmp_path):
+    url, handler = server
+    dataset = tmp_path / 'data'
+    dataset.mkdir()
+    (dataset / 'a.png').write_bytes(b'x' * 10)
+    #a directory changed in the last seconds is not indexed
+    os.utime(dataset, ns=(0, 10 ** 18))
+    scan = ngq.DatasetScan(str(dataset) + '/', use_index=True)
+    assert [file.size for file in scan] == [10]
+    with open(dataset / 'a.png', 'r+b') as f:
+        f.write(b'y' * 20)
+    #the unchanged directory is not listed again
+    assert [file.size for file in scan] == [10]
+    response = upload(url, scan, 'rewritten', client)
+    assert response['error'] == 'Error'
+    assert [file.size for file in scan] == [20]
+    assert upload(url, scan, 'rewritten', client, resume='True')['error'] == 'None'
+    assert stored_files(handler, 'rewritten') == ['a.png']
+
+def test_file_longer_than_its_size_fails():
+    with pytest.raises(IOError):
+        list(ngq._file_blocks(io.BytesIO(b'abcd'), 3, 'a.png'))
+    with tempfile.TemporaryFile() as f:
+        f.write(b'abcd')
+        f.seek(0)
+        with pytest.raises(IOError):
+            list(ngq._file_blocks(f, 3, 'a.png'))
+
+########## PREPROCESSING ##########
+def test_preprocess_keeps_skipped_files_in_subdirectories(tmp_path):
+    Image = pytest.importorskip('PIL.Image')
+    dataset = tmp_path / 'data' / 'cats'
+    dataset.mkdir(parents=True)
+    Image.new('L', (8, 8)).save(dataset / 'a.png')
+    (dataset / 'notes.txt').write_bytes(b'not an image')
+    scan = ngq.DatasetScan(str(tmp_path / 'data') + '/', recursive=True)
+    response = ngq.preprocess_dataset(scan, 4, str(tmp_path / 'out'), workers=1, keep_skipped=True)
+    assert response['error'] == 'None', response
+    assert (tmp_path / 'out' / 'cats' / 'notes.txt').read_bytes() == b'not an image'
+
+def test_preprocessed_upload_without_data_id_names_the_tensor_after_the_directory(server, client, tmp_path):
+    Image = pytest.importorskip('PIL.Image')
+    url, handler = server
+    dataset = tmp_path / 'digits'
+    dataset.mkdir()
+    Image.new('L', (8, 8)).save(dataset / 'a.png')
+    body = {'endpoint': url + '/upload_data', 'user_id': USER_ID, 'dataset_dir': str(dataset) + '/',
+            'image_resolution': 4, 'client': client}
+    assert ngq.upload_dataset_to_server_api(body)['error'] == 'None'
+    names = [name for files in handler.state.datasets.values() for name in files]
+    assert sorted(names) == ['digits.index.json', 'digits.npy']
+    #the tensor is not kept in the cache
+    assert os.listdir(os.path.join(ngq.CACHE_DIR, 'tensors')) == []
+
+########## ARCHIVES ##########
+def open_descriptors(path):
+    """Descriptors of this process open on path (Linux)."""
+    fd_dir = '/proc/self/fd'
+    if not os.path.isdir(fd_dir):
+        pytest.skip('needs /proc/self/fd')
+    links = []
+    for fd in os.listdir(fd_dir):
+        try:
+            links.append(os.readlink(os.path.join(fd_dir, fd)))
+        except OSError:
+            continue
+    return links.count(str(path))
+
+def test_zip_archive_is_closed_after_the_upload(server, client, tmp_path):
+    import zipfile
+    url, handler = server
+    dataset_dir = make_dataset(tmp_path / 'data', 10)
+    archive = tmp_path / 'data.zip'
+    with zipfile.ZipFile(archive, 'w') as zf:
+        for name in sorted(os.listdir(dataset_dir)):
+            zf.write(os.path.join(dataset_dir, name), name)
+    response = upload(url, str(archive), 'zipped', client, upload_workers=4, chunk_min_bytes=1, chunk_max_bytes=512)
+    assert response['error'] == 'None', response
+    assert len(stored_files(handler, 'zipped')) == 10
+    assert open_descriptors(archive) == 0
+    #members can be read after the listing is finished
+    files = list(ngq._dataset_files(str(archive)))
+    assert open_descriptors(archive) == 0
+    with files[0].open() as f:
+        assert len(f.read()) == 256
+    assert open_descriptors(archive) == 0
+
+def test_label_stream_labels_each_batch_once(server, client, tmp_path):
+    url, handler = server
+    dataset_dir = make_dataset(tmp_path / 'data', 40)
+    assert upload(url, dataset_dir, 'd', client)['error'] == 'None'
+    train(url, 'd', 'm', client)
+    body = {'endpoint': url + '/get_labels', 'user_id': USER_ID, 'dataset_dir': dataset_dir,
+            'model_name': 'm', 'client': client, 'batch_files': 4}
+    responses = list(ngq.get_labels_stream_api(body))
+    assert [response['error'] for response in responses] == ['None'] * 10
+    for response in responses:
+        assert sorted(response['labels']) == sorted(response['files'])
+    #the same number of files labeled by each request, no batch sees the earlier ones
+    stats = handler.state.stats
+    assert stats['labeled_files'] == 4 * stats['label_requests']
+    assert not [data_id for user_id, data_id in handler.state.datasets if data_id.startswith('TMP_SET_TO_LABEL')]
+
+########## SWEEPS ##########
+def test_sweep_without_endpoint_uses_the_server_url(monkeypatch):
+    monkeypatch.setattr(ngq, 'SERVER_URL', 'http://127.0.0.1:9')
+    sweep = ngq.SweepScheduler({'user_id': USER_ID, 'epochs': [1, 2]})
+    assert sweep.endpoint == 'http://127.0.0.1:9/train_mnist_model'
+    assert [job.body['endpoint'] for job in sweep.jobs] == [sweep.endpoint] * 2
+
+def test_file_changed_during_upload_is_not_a_server_failure(server, client, tmp_path):
+    url, handler = server
+    dataset_dir = make_dataset(tmp_path / 'data', 2)
+    files = list(ngq._dataset_files(dataset_dir))
+    #the file grew after it was listed
+    with open(files[0].path, 'ab') as f:
+        f.write(b'more')
+    response = ngq._upload_data_files(endpoint=url + '/upload_data', user_id=USER_ID, data_id='changed',
+                                      client=client, file_list=files, use_journal=False)
+    assert response['error'] == 'Error'
+    assert 'longer' in response['message']
+    #sent once, not retried, and the server is not blamed; the stand-in counts
+    #the aborted request once it sees the connection close, maybe after the client returned
+    deadline = time.monotonic() + 2
+    while handler.state.stats['requests'] < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert handler.state.stats['requests'] == 1
+    assert client.breaker(url)._failed == 0
+
+def make_archive(archive, members):
+    """A .zip or .tar.gz archive of members {path in the archive: content}."""
+    import tarfile, zipfile
+    if str(archive).endswith('.zip'):
+        with zipfile.ZipFile(archive, 'w') as zf:
+            for name, data in members.items():
+                zf.writestr(name, data)
+    else:
+        with tarfile.open(archive, 'w:gz') as tf:
+            for name, data in members.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tf.addfile(info, io.BytesIO(data))
+    return str(archive)
+
+@pytest.mark.parametrize('extension', ['.zip', '.tar.gz'])
+def test_archive_members_keep_their_path(server, client, tmp_path, extension):
+    url, handler = server
+    members = {'a/img.png': b'first', 'b/img.png': b'second', 'c.png': b'third'}
+    archive = make_archive(tmp_path / ('data' + extension), members)
+    response = upload(url, archive, 'nested', client, upload_workers=4, chunk_min_bytes=1, chunk_max_bytes=8)
+    assert response['error'] == 'None', response
+    assert stored_files(handler, 'nested') == ['a/img.png', 'b/img.png', 'c.png']
+    #same names and content as read from the archive
+    for file in ngq._dataset_files(archive):
+        with file.open() as f:
+            assert f.read() == members[file.name]
+
+@pytest.mark.parametrize('extension', ['.zip', '.tar.gz'])
+def test_archive_scan_options(tmp_path, extension):
+    members = {'top.png': b'1', 'top.txt': b'2', 'cats/c.png': b'3', 'dogs/d.png': b'4', 'dogs/deep/e.png': b'5'}
+    archive = make_archive(tmp_path / ('data' + extension), members)
+    def names(**options):
+        return sorted(file.name for file in ngq.DatasetScan(archive, **options))
+    assert names() == ['top.png', 'top.txt']
+    assert names(recursive=True, include=['*.png'], exclude=['dogs']) == ['cats/c.png', 'top.png']
+    assert names(class_subdirs=True, include=['*.png']) == ['cats/c.png', 'dogs/d.png', 'labels.csv', 'top.png']
+
+def test_tar_members_are_read_when_sent(tmp_path):
+    archive = make_archive(tmp_path / 'data.tar.gz', {'m%d.png' % i: bytes([i]) * 100 for i in range(5)})
+    files = list(ngq._dataset_files(archive))
+    assert all(file.data is None for file in files)
+    for i, file in enumerate(files):
+        with file.open() as f:
+            assert f.read() == bytes([i]) * 100
+
+def test_sweep_api_without_endpoint_uses_the_server_url(server, client, monkeypatch):
+    url, handler = server
+    monkeypatch.setattr(ngq, 'SERVER_URL', url)
+    response = ngq.train_MNIST_sweep_api({'user_id': USER_ID, 'model_name': 'sweep', 'model_type': 'simple', 'epochs': [1, 2],
+                                          'client': client})
+    assert response['error'] == 'None', response
+    assert sorted(job['model_name'] for job in response['jobs']) == ['sweep_0', 'sweep_1']
+    assert handler.state.model(USER_ID, 'sweep_1') is not None
+
+########## ASYNCIO ##########
+def async_client(**options):
+    pytest.importorskip('httpx')
+    #no waiting between the retries
+    return ngq.AsyncNgqClient(retry=ngq.RetryPolicy(backoff=0, jitter=0), **options)
+
+def test_async_client_uploads_trains_and_labels(server, tmp_path):
+    import asyncio
+    url, handler = server
+    dataset_dir = make_dataset(tmp_path / 'data', 10)
+
+    async def main():
+        async with async_client() as api:
+            response = await api.upload_dataset_to_server({'endpoint': url + '/upload_data', 'user_id': USER_ID,
+                                                           'dataset_dir': dataset_dir, 'data_id': 'd',
+                                                           'upload_workers': 4, 'chunk_max_bytes': 256})
+            assert response['error'] == 'None', response
+            response = await api.train_model_on_data({'endpoint': url + '/train_model_on_data', 'user_id': USER_ID,
+                                                      'data_id': 'd', 'model_name': 'm'})
+            assert response['error'] == 'None', response
+            response = await api.check_model_ready({'endpoint': url + '/check_model_ready', 'user_id': USER_ID,
+                                                    'model_name': 'm', 'keep_trying': 'True'})
+            assert response['error'] == 'None', response
+            body = {'endpoint': url + '/get_labels', 'user_id': USER_ID, 'dataset_dir': dataset_dir, 'model_name': 'm'}
+            #concurrent calls label their own files only
+            responses = await asyncio.gather(*[api.get_labels(body) for _ in range(3)])
+            for response in responses:
+                assert len(response['labels']) == 10, response
+            return [response async for response in api.get_labels_stream(dict(body, batch_files=4))]
+
+    responses = asyncio.run(main())
+    assert len(stored_files(handler, 'd')) == 10
+    assert [(response['batch'], len(response['labels'])) for response in responses] == [(0, 4), (1, 4), (2, 2)]
+    stats = handler.state.stats
+    #each labeling is a POST and a GET, of the files of the call or the batch only
+    assert stats['labeled_files'] == 2 * (3 * 10 + 10)
+    assert not [data_id for user_id, data_id in handler.state.datasets if data_id.startswith('TMP_SET_TO_LABEL')]
+
+def test_async_client_bounds_and_cancels_requests(start_server):
+    import asyncio
+    url, handler = start_server(train_seconds=30)
+    handler.state.datasets[(USER_ID, 'd')] = {}
+    body = {'endpoint': url + '/check_model_ready', 'user_id': USER_ID, 'model_name': 'm',
+            'keep_trying': 'True', 'long_poll': 20, 'deadline': 20}
+
+    async def main():
+        api = async_client(max_concurrency=3)
+        response = await api.train_model_on_data({'endpoint': url + '/train_model_on_data', 'user_id': USER_ID,
+                                                  'data_id': 'd', 'model_name': 'm'})
+        assert response['error'] == 'None', response
+        tasks = [asyncio.ensure_future(api.check_model_ready(body)) for _ in range(10)]
+        await asyncio.sleep(0.5)
+        #3 long polls held by the server, the other calls wait for their turn
+        assert handler.state.stats['requests'] == 1 + 3
+        started = time.monotonic()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await api.close()
+        return time.monotonic() - started
+
+    #the requests held by the server do not delay the cancellation
+    assert asyncio.run(main()) < 1
+
+def test_async_upload_is_cancelled_and_resumed(start_server, tmp_path):
+    import asyncio
+    url, handler = start_server(latency=0.05)
+    dataset_dir = make_dataset(tmp_path / 'data', 20)
+    body = {'endpoint': url + '/upload_data', 'user_id': USER_ID, 'dataset_dir': dataset_dir, 'data_id': 'resumed',
+            'chunk_min_bytes': 1, 'chunk_max_bytes': 256}
+
+    async def main():
+        async with async_client() as api:
+            task = asyncio.ensure_future(api.upload_dataset_to_server(body))
+            await asyncio.sleep(0.5)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            sent_before = len(stored_files(handler, 'resumed'))
+            assert 0 < sent_before < 20
+            response = await api.upload_dataset_to_server(dict(body, resume='True'))
+            assert response['error'] == 'None', response
+            return sent_before
+
+    sent_before = asyncio.run(main())
+    assert len(stored_files(handler, 'resumed')) == 20
+    #at most the chunk in flight at the cancellation was sent twice
+    assert handler.state.stats['files'] <= 20 + 1
+
+########## REQUEST BODIES ##########
+def test_multipart_stream_opens_one_file_at_a_time(tmp_path, monkeypatch):
+    monkeypatch.setattr(ngq, 'UPLOAD_BLOCK_SIZE', 4096)
+    files = list(ngq._dataset_files(make_dataset(tmp_path / 'data', 30, size=5000)))
+    open_files, most_open = [], []
+
+    class Tracked(io.FileIO):
+        def __init__(self, path):
+            super().__init__(path, 'rb')
+            open_files.append(self)
+            most_open.append(len(open_files))
+
+        def close(self):
+            if self in open_files:
+                open_files.remove(self)
+            super().close()
+
+    stream = ngq._MultipartStream([('files', file.name, file.size, lambda path=file.path: Tracked(path))
+                                   for file in files])
+    body = b''.join(bytes(block) for block in stream)
+    assert len(body) == len(stream)
+    assert max(most_open) == 1 and open_files == []
+    parsed = ngq_server.parse_multipart(body, stream.content_type)
+    assert [(field, name) for field, name, _ in parsed] == [('files', file.name) for file in files]
+    for (_, _, data), file in zip(parsed, files):
+        with open(file.path, 'rb') as f:
+            assert data == f.read()
+    #the body can be sent again, f.e. by a retry
+    assert b''.join(bytes(block) for block in stream) == body
+
+def test_adaptive_chunker_follows_the_throughput():
+    chunker = ngq._AdaptiveChunker(min_bytes=100, max_bytes=1000, start_bytes=200, max_seconds=1.0)
+    chunks = chunker.chunks(ngq._DatasetFile('f%d' % i, size=50, mtime_ns=0) for i in range(200))
+    sizes = []
+
+    def send(seconds, ok=True):
+        chunk, chunk_bytes = next(chunks)
+        assert chunk_bytes == 50 * len(chunk)
+        sizes.append(chunk_bytes)
+        chunker.record(chunk_bytes, seconds, ok)
+
+    send(0.1)               # slow start: doubled while the throughput grows
+    send(0.1)
+    send(0.4)               # the throughput stopped growing, end of the slow start
+    send(0.1)               # then grows by min_bytes
+    send(2.0)               # slower than max_seconds: halved
+    send(0.1, ok=False)     # failed: halved
+    assert sizes == [200, 400, 800, 800, 900, 450]
+    assert chunker.target == 225
+    for _ in range(5):
+        send(0.1, ok=False)
+    assert chunker.target == 100
+    chunker = ngq._AdaptiveChunker(min_bytes=100, max_bytes=1000, start_bytes=800)
+    chunker.record(800, 0.1)
+    assert chunker.target == 1000
+
+def test_packed_upload_stores_the_same_files(server, client, tmp_path):
+    url, handler = server
+    dataset_dir = make_dataset(tmp_path / 'data', 20)
+    make_dataset(tmp_path / 'data' / 'sub', 5, seed=1)
+    assert upload(url, dataset_dir, 'files', client, recursive='True')['error'] == 'None'
+    requests_before = handler.state.stats['requests']
+    response = upload(url, dataset_dir, 'packed', client, recursive='True', transfer_mode='packed')
+    assert response['error'] == 'None', response
+    datasets = handler.state.datasets
+    assert len(datasets[(USER_ID, 'packed')]) == 25 and 'sub/file_000.png' in datasets[(USER_ID, 'packed')]
+    assert datasets[(USER_ID, 'packed')] == datasets[(USER_ID, 'files')]
+    #all files in one archive: the POST and its status GET
+    assert handler.state.stats['requests'] - requests_before == 2
+
+########## WAITING FOR MODELS ##########
+def test_backoff_delays_grow_with_jitter():
+    delays = ngq._backoff_delays(initial=1.0, maximum=8.0, factor=2.0, jitter=0.5)
+    for expected in [1.0, 2.0, 4.0, 8.0, 8.0]:
+        assert expected * 0.5 <= next(delays) <= expected
+
+def test_model_readiness_is_waited_for(start_server, client):
+    url, handler = start_server(train_seconds=0.5)
+    handler.state.datasets[(USER_ID, 'd')] = {}
+    for model_name in ('a', 'b'):
+        train(url, 'd', model_name, client)
+    check_url = url + '/check_model_ready'
+    #the deadline passes before the model is ready
+    started = time.monotonic()
+    response = ngq.wait_model_ready(check_url, USER_ID, 'a', client=client, deadline=0.2)
+    assert response['error'] == 'Warning'
+    assert time.monotonic() - started < 0.5
+    #long poll: the server holds the check until the model is ready
+    requests_before = handler.state.stats['requests']
+    response = ngq.wait_model_ready(check_url, USER_ID, 'a', client=client, deadline=5, long_poll=5)
+    assert response['error'] == 'None'
+    assert handler.state.stats['requests'] - requests_before == 1
+    #one thread waits for several models
+    waiter = ngq.ModelWaiter(client)
+    futures = [waiter.wait(check_url, USER_ID, model_name, deadline=5) for model_name in ('b', 'missing')]
+    assert [future.result(timeout=10)['error'] for future in futures] == ['None', 'Error']
+
+########## LEAN PROTOCOL ##########
+def test_lean_protocol_skips_the_follow_up_requests(server, tmp_path):
+    url, handler = server
+    client = ngq.NgqClient(lean=True, retry=ngq.RetryPolicy(backoff=0, jitter=0), servers=[])
+    dataset_dir = make_dataset(tmp_path / 'data', 4)
+    stats = handler.state.stats
+    requests_before = stats['requests']
+    assert upload(url, dataset_dir, 'd', client, chunk_min_bytes=1, chunk_max_bytes=256)['error'] == 'None'
+    #one request per chunk, its status comes with the POST
+    assert stats['requests'] - requests_before == 4
+    train(url, 'd', 'm', client)
+    body = {'endpoint': url + '/get_labels', 'user_id': USER_ID, 'dataset_dir': dataset_dir,
+            'model_name': 'm', 'client': client}
+    requests_before = stats['requests']
+    assert len(ngq.get_labels_api(body)['labels']) == 4
+    #readiness check, upload, labels
+    assert stats['requests'] - requests_before == 3
+    requests_before = stats['requests']
+    assert len(ngq.get_labels_api(body)['labels']) == 4
+    #the model found ready is not checked again
+    assert stats['requests'] - requests_before == 2
+    #until it is retrained
+    train(url, 'd', 'm', client)
+    requests_before = stats['requests']
+    assert len(ngq.get_labels_api(body)['labels']) == 4
+    assert stats['requests'] - requests_before == 3
+    client.close()
+
+########## METRICS ##########
+def test_metrics_time_the_phases_of_a_call(server, client, tmp_path):
+    url, handler = server
+    dataset_dir = make_dataset(tmp_path / 'data', 10)
+    events = []
+    registry = ngq.enable_metrics(ngq.MetricsRegistry())
+    ngq.add_metrics_callback(events.append)
+    try:
+        response = upload(url, dataset_dir, 'd', client, upload_workers=2, chunk_min_bytes=1, chunk_max_bytes=1024)
+    finally:
+        ngq.disable_metrics()
+        ngq.remove_metrics_callback(events.append)
+    assert response['error'] == 'None', response
+    calls = [event for event in events if event['kind'] == 'call']
+    assert [call['name'] for call in calls] == ['upload_dataset_to_server_api']
+    #the phases of the worker threads count for the call
+    call = calls[0]
+    assert {'read', 'encode', 'send', 'server_wait'} <= set(call['phases'])
+    assert call['files'] == 10 and call['bytes'] > 10 * 256
+    assert call['error'] == 'None'
+    phases = [event for event in events if event['kind'] == 'phase']
+    assert {event['call'] for event in phases} == {'upload_dataset_to_server_api'}
+    histograms = registry.snapshot()['histograms']
+    assert histograms['upload_dataset_to_server_api']['count'] == 1
+    assert histograms['read']['count'] == 10
+
+########## LOGGING ##########
+def test_log_records_are_written_by_the_listener_thread(tmp_path):
+    previous = ngq._log_filename()
+    filename = str(tmp_path / 'ngq.log')
+    ngq.configure_logging(filename=filename, level='INFO', levels={'upload': 'DEBUG'})
+    try:
+        file_handler = ngq._log_listener.handlers[0]
+        written = []
+        emit = file_handler.emit
+
+        def slow_emit(record):
+            time.sleep(0.1)
+            written.append(record.getMessage())
+            emit(record)
+
+        file_handler.emit = slow_emit
+        started = time.monotonic()
+        ngq._upload_logger.debug('upload detail')
+        ngq._labels_logger.debug('labels detail')
+        for i in range(5):
+            ngq._labels_logger.info('record %d', i)
+        #the calling thread does not wait for the file
+        assert time.monotonic() - started < 0.1
+        ngq.flush_log()
+        assert written == ['upload detail'] + ['record %d' % i for i in range(5)]
+        with open(filename) as f:
+            lines = f.read().splitlines()
+        assert len(lines) == 6 and lines[0].endswith('DEBUG ngq.upload: upload detail')
+    finally:
+        ngq.configure_logging(filename=previous or '')
+        ngq._upload_logger.setLevel('NOTSET')
+
+########## FILE READS ##########
+def test_mmap_reads_send_the_file_content(server, client, tmp_path, monkeypatch):
+    import mmap
+    url, handler = server
+    window = 2 * mmap.ALLOCATIONGRANULARITY
+    monkeypatch.setattr(ngq, 'MMAP_READS', True)
+    monkeypatch.setattr(ngq, 'MMAP_MIN_BYTES', 1)
+    monkeypatch.setattr(ngq, 'MMAP_WINDOW', window)
+    monkeypatch.setattr(ngq, 'UPLOAD_BLOCK_SIZE', window // 4)
+    dataset_dir = make_dataset(tmp_path / 'data', 3, size=3 * window + 100)
+    path = dataset_dir + 'file_000.png'
+    with open(path, 'rb') as f:
+        content = f.read()
+    with open(path, 'rb') as f:
+        blocks = [(type(block.obj), bytes(block)) for block in ngq._file_blocks(f, len(content), 'file_000.png')]
+    assert {kind for kind, _ in blocks} == {mmap.mmap}
+    assert b''.join(data for _, data in blocks) == content
+    with open(path, 'rb') as f:
+        with pytest.raises(ngq.LocalFileError):
+            list(ngq._file_blocks(f, len(content) - 1, 'file_000.png'))
+    assert upload(url, dataset_dir, 'mapped', client)['error'] == 'None'
+    monkeypatch.setattr(ngq, 'MMAP_READS', False)
+    assert upload(url, dataset_dir, 'read', client)['error'] == 'None'
+    assert handler.state.datasets[(USER_ID, 'mapped')] == handler.state.datasets[(USER_ID, 'read')]
+
+########## PRE-FLIGHT ##########
+def test_preflight_in_worker_processes_finds_the_invalid_files(server, client, tmp_path):
+    Image = pytest.importorskip('PIL.Image')
+    url, handler = server
+    dataset = tmp_path / 'data'
+    dataset.mkdir()
+    for i in range(6):
+        Image.new('L', (4 + i, 4)).save(dataset / ('ok_%d.png' % i))
+    png = (dataset / 'ok_0.png').read_bytes()
+    (dataset / 'cut.png').write_bytes(png[:-10])
+    (dataset / 'empty.png').write_bytes(b'')
+    dataset_dir = str(dataset) + '/'
+    #two processes, batches of two files
+    response = ngq.preflight_dataset(dataset_dir, workers=2, batch_size=2)
+    assert response['error'] == 'Warning', response
+    assert (response['files'], response['invalid']) == (8, 2)
+    assert sorted(name for name, problem in response['invalid_files']) == ['cut.png', 'empty.png']
+    with open(response['manifest']) as f:
+        manifest = {entry['name']: entry for entry in map(json.loads, f)}
+    assert (manifest['ok_3.png']['format'], manifest['ok_3.png']['width']) == ('png', 7)
+    assert manifest['ok_3.png']['hash'] == ngq._hash_file(ngq._DatasetFile(dataset_dir + 'ok_3.png'))
+    #nothing is uploaded with invalid files, unless they are skipped
+    body = {'preflight': 'True', 'preflight_workers': 2}
+    assert upload(url, dataset_dir, 'checked', client, **body)['error'] == 'Error'
+    assert stored_files(handler, 'checked') == []
+    assert upload(url, dataset_dir, 'checked', client, skip_invalid='True', **body)['error'] == 'None'
+    assert stored_files(handler, 'checked') == ['ok_%d.png' % i for i in range(6)]
+
+########## COMPRESSION ##########
+def test_compressed_upload_round_trip(server, client, tmp_path):
+    import gzip, hashlib
+    url, handler = server
+    dataset = tmp_path / 'data'
+    dataset.mkdir()
+    contents = {'notes_%d.txt' % i: ('line %d of a text file\n' % i * 400).encode('ascii') for i in range(5)}
+    for name, data in contents.items():
+        (dataset / name).write_bytes(data)
+    dataset_dir = str(dataset) + '/'
+    stream = ngq._MultipartStream([ngq._file_part('files', file) for file in ngq._dataset_files(dataset_dir)])
+    assert gzip.decompress(b''.join(ngq._CompressedBody(stream, 'gzip'))) == b''.join(bytes(block) for block in stream)
+    expected = {name: hashlib.blake2b(data, digest_size=16).hexdigest() for name, data in contents.items()}
+    assert upload(url, dataset_dir, 'text', client)['error'] == 'None'
+    assert handler.state.datasets[(USER_ID, 'text')] == expected
+    stats = handler.state.stats
+    assert stats['bytes_in'] * 5 < stats['bytes_in_decoded']
+    #a server that refuses the compressed body gets it again as it is
+    handler.compression = False
+    assert upload(url, dataset_dir, 'plain', client)['error'] == 'None'
+    assert handler.state.datasets[(USER_ID, 'plain')] == expected
+    assert 'gzip' not in client.accepted_encodings(url + '/upload_data')